@@ -1,115 +1,1645 @@
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
-from datetime import datetime
-import pandas as pd
-from fpdf import FPDF, XPos, YPos
-import matplotlib.pyplot as plt
-import seaborn as sns
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
-import matplotlib
 import os
 import sys
-import numpy as np
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+import asyncio
 import base64
+import html
+import functools
+import hashlib
+import importlib
+import io
 import re
-from matplotlib.colors import LinearSegmentedColormap
 import json
-import google.auth.exceptions
-import anthropic  # Anthropic APIクライアント
+import math
+import queue
+import random
+import shutil
+import threading
+import time
+from contextlib import contextmanager
 
-# matplotlib設定を強化（日本語フォント対応）
-plt.rcParams['font.family'] = 'sans-serif'
-# フォント検索パスを追加
-matplotlib.font_manager.fontManager.addfont('/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc')
-plt.rcParams['font.sans-serif'] = ['Hiragino Sans GB', 'Hiragino Sans', 'MS Gothic', 'Meiryo', 'Arial']
+try:
+    import fcntl
+except ImportError:  # Windowsの場合
+    fcntl = None
+    import msvcrt
 
-# マイクロソフトの言語パックのフォントを使用
-plt.rcParams['font.family'] = 'sans-serif'
+class _LazyModule:
+    """初回の属性アクセス時にモジュールをインポートする代理オブジェクト
+
+    起動時間を短縮するため、描画・LLM・Google関連の重いライブラリは
+    実際に使われるまでインポートしない。
+    """
+
+    def __init__(self, module_name, on_load=None, before_load=None):
+        self._module_name = module_name
+        self._on_load = on_load
+        self._before_load = before_load
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    if self._before_load:
+                        self._before_load()
+                    module = importlib.import_module(self._module_name)
+                    if self._on_load:
+                        self._on_load(module)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+def _use_headless_backend():
+    """pyplotが未インポートの場合はGUI不要のAggバックエンドを使用する"""
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+
+def _configure_matplotlib(pyplot):
+    """matplotlib設定を強化（日本語フォント対応、初回のみ実行）"""
+    import matplotlib.font_manager as font_manager
+    
+    pyplot.rcParams['font.family'] = 'sans-serif'
+    font_families = ['Hiragino Sans GB', 'Hiragino Sans', 'MS Gothic', 'Meiryo', 'Arial']
+    
+    # フォント検索パスを追加（存在する場合のみ）
+    font_path = get_japanese_font_path()
+    if font_path:
+        try:
+            font_manager.fontManager.addfont(font_path)
+            font_families.insert(0, font_manager.FontProperties(fname=font_path).get_name())
+        except Exception as e:
+            print(f"matplotlibフォント登録エラー: {e}")
+    pyplot.rcParams['font.sans-serif'] = font_families
+
+# 重いライブラリは初回使用時に読み込む
+pd = _LazyModule('pandas')
+np = _LazyModule('numpy')
+plt = _LazyModule('matplotlib.pyplot', on_load=_configure_matplotlib,
+                  before_load=_use_headless_backend)
+sns = _LazyModule('seaborn', before_load=lambda: plt._load())
+anthropic = _LazyModule('anthropic')  # Anthropic APIクライアント
+httpx = _LazyModule('httpx')  # 非同期API（AsyncGmailAnalyzer）のHTTPクライアント
+google_auth_exceptions = _LazyModule('google.auth.exceptions')
+
+class FontResolver:
+    """日本語フォントの検索結果をレポート間で共有する
+
+    フォントは font_dir（未指定の場合は環境変数 GMAIL_ANALYZER_FONT_DIR）、
+    プロジェクト内の fonts/、OS標準の場所の順に探し、見つかったパスを記憶する。
+    PDFへの登録はfpdf2の add_font で行い、フォントの解析はPDFごとに1回行われる
+    （複数の送信者をまとめる BatchReportWriter は1つのPDFを使うため、バッチ全体で1回）。
+    PDFに埋め込まれるのは使用した文字だけのサブセット。
+    """
+
+    FONT_DIR_ENV = 'GMAIL_ANALYZER_FONT_DIR'
+    FONT_EXTENSIONS = ('.ttf', '.otf', '.ttc')
+    DEFAULT_FONT_PATHS = [
+        'fonts/ipaexg.ttf',  # プロジェクト内
+        '/usr/share/fonts/truetype/ipafont/ipag.ttf',  # Linux
+        '/usr/share/fonts/truetype/fonts-japanese-gothic.ttf',  # Linux
+        '/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc',  # macOS
+        '/Library/Fonts/Arial Unicode.ttf',  # macOS
+        'C:/Windows/Fonts/msgothic.ttc',  # Windows
+    ]
+
+    def __init__(self, font_dir=None):
+        self.font_dir = font_dir or os.environ.get(self.FONT_DIR_ENV)
+        self._lock = threading.Lock()
+        self._resolved = False
+        self._font_path = None
+
+    def candidates(self):
+        """探索するフォントファイルの候補を優先順に返す"""
+        paths = []
+        if self.font_dir:
+            font_dir = Path(self.font_dir)
+            if font_dir.is_file():
+                paths.append(str(font_dir))
+            elif font_dir.is_dir():
+                paths.extend(str(path) for path in sorted(font_dir.iterdir())
+                             if path.suffix.lower() in self.FONT_EXTENSIONS)
+        paths.extend(self.DEFAULT_FONT_PATHS)
+        return paths
+
+    def find_font_path(self):
+        """日本語フォントのパスを返す（見つからない場合はNone、結果は記憶する）"""
+        if not self._resolved:
+            with self._lock:
+                if not self._resolved:
+                    self._font_path = next((path for path in self.candidates() if Path(path).exists()), None)
+                    self._resolved = True
+        return self._font_path
+
+    def add_to_pdf(self, pdf, family, styles=('', 'B')):
+        """PDFに日本語フォントを登録する（フォントが見つからない場合はFalse）"""
+        font_path = self.find_font_path()
+        if not font_path:
+            return False
+        
+        for style in styles:
+            if f"{family.lower()}{style}" not in pdf.fonts:
+                pdf.add_font(family, style, font_path)
+        return True
+
+_font_resolvers = {}
+_font_resolvers_lock = threading.Lock()
+
+def get_font_resolver(font_dir=None):
+    """フォントディレクトリごとのFontResolverを返す（プロセス内で使い回す）"""
+    with _font_resolvers_lock:
+        if font_dir not in _font_resolvers:
+            _font_resolvers[font_dir] = FontResolver(font_dir)
+        return _font_resolvers[font_dir]
 
 # 日本語フォントへのパスを取得
 def get_japanese_font_path():
-    # OS判定
-    if sys.platform.startswith('win'):
-        # Windowsの場合
-        font_path = 'C:/Windows/Fonts/msgothic.ttc'
-    elif sys.platform.startswith('darwin'):
-        # macOSの場合
-        font_path = '/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc'
+    return get_font_resolver().find_font_path()
+
+# pyplotは現在の図をプロセス全体で共有するため、描画処理はこのロックで直列化する
+_pyplot_lock = threading.RLock()
+
+# フォントファイルのパス -> matplotlibのフォント名（プロセスごとに一度だけ登録する）
+_chart_fonts = {}
+
+def _use_chart_font(font_path):
+    """グラフの日本語フォントを指定したフォントファイルに切り替える
+
+    _configure_matplotlib は標準の場所のフォントしか登録しないため、アナライザーの
+    font_dir で見つけたフォントは描画の前にここで登録して優先順位の先頭に置く。
+    """
+    if not font_path:
+        return
+    plt._load()
+    with _pyplot_lock:
+        family = _chart_fonts.get(font_path)
+        if family is None:
+            import matplotlib.font_manager as font_manager
+            try:
+                font_manager.fontManager.addfont(font_path)
+                family = font_manager.FontProperties(fname=font_path).get_name()
+            except Exception as e:
+                print(f"matplotlibフォント登録エラー: {e}")
+                family = ''
+            _chart_fonts[font_path] = family
+        families = list(plt.rcParams['font.sans-serif'])
+        if family and families[:1] != [family]:
+            plt.rcParams['font.sans-serif'] = [family] + [f for f in families if f != family]
+
+def _render_with_font(font_path, func, args):
+    """フォントを切り替えてから描画関数を呼び出す（描画プロセスにも渡せるようにモジュール関数にする）"""
+    if not font_path:
+        return func(*args)
+    # 切り替えてから描画し終えるまでに他のスレッドがフォントを変えないようにする
+    with _pyplot_lock:
+        _use_chart_font(font_path)
+        return func(*args)
+
+def _pyplot_locked(func):
+    """pyplotを使う描画関数を他スレッドの描画と重ならないように実行する"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _pyplot_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+# グラフの出力形式（'svg' はPDFにベクター画像として埋め込む）
+CHART_FORMATS = ('png', 'svg')
+
+def _save_figure(image_format='png', **savefig_kwargs):
+    """描画中の図を画像のバッファに保存して閉じる（一時ファイルは作らない）
+
+    image_format='svg' の場合は文字をパスに変換したSVGを出力する。
+    fpdf2は埋め込みラスター画像を含むSVGを扱えないため、
+    カラーバーなどのラスター化指定は解除してすべてベクターで出力する。
+    """
+    image = io.BytesIO()
+    if image_format == 'svg':
+        figure = plt.gcf()
+        for artist in figure.findobj(lambda a: a.get_rasterized()):
+            artist.set_rasterized(False)
+        savefig_kwargs.pop('dpi', None)
+        with plt.rc_context({'svg.fonttype': 'path'}):
+            plt.savefig(image, format='svg', **savefig_kwargs)
+        # fpdf2が解釈しないメタデータ要素は取り除き、
+        # 塗りの指定がない文字がPDF側の塗り色を引き継がないよう既定の黒を明示する
+        data = re.sub(rb'<metadata>.*?</metadata>', b'', image.getvalue(), flags=re.S)
+        data = re.sub(rb'<svg ', b'<svg style="fill: #000000" ', data, count=1)
+        image = io.BytesIO(data)
     else:
-        # Linuxその他の場合
-        font_path = '/usr/share/fonts/truetype/fonts-japanese-gothic.ttf'
+        plt.savefig(image, format='png', **savefig_kwargs)
+    plt.close()
+    image.seek(0)
+    return image
+
+def estimate_tokens(text):
+    """Claudeの入力トークン数を概算する（ASCII文字は約3文字で1トークン、それ以外は1文字1トークン）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return math.ceil(ascii_chars / 3) + (len(text) - ascii_chars)
+
+def estimate_counts_with_ci(sample_counts, sample_size, population, z=1.96):
+    """サンプルの件数から母集団の件数と信頼区間を推定する
+
+    有限母集団修正を加えたWilsonスコア区間で各区分の比率を推定し、
+    母集団の件数に換算して (推定値, 下限, 上限) を返す。
+    """
+    counts = np.asarray(sample_counts, dtype=float)
+    if sample_size <= 0:
+        zeros = np.zeros_like(counts)
+        return zeros, zeros, zeros
+    
+    p = counts / sample_size
+    estimates = p * population
+    
+    # 全数取得の場合は区間幅ゼロ
+    if population <= sample_size or population <= 1:
+        return estimates, estimates.copy(), estimates.copy()
+    
+    # 有限母集団修正を実効サンプルサイズとして反映
+    n_eff = sample_size * (population - 1) / (population - sample_size)
+    denom = 1 + z ** 2 / n_eff
+    center = (p + z ** 2 / (2 * n_eff)) / denom
+    half = z * np.sqrt(p * (1 - p) / n_eff + z ** 2 / (4 * n_eff ** 2)) / denom
+    lower = np.clip(center - half, 0, 1) * population
+    upper = np.clip(center + half, 0, 1) * population
+    # 推定値が必ず区間内に収まるようにする
+    return estimates, np.minimum(lower, estimates), np.maximum(upper, estimates)
+
+@_pyplot_locked
+def render_hourly_chart(hourly_counts, figsize=(10, 6), sampling=None, image_format='png'):
+    """時間帯分布のグラフを描画（24時間分の件数から）"""
+    try:
+        # 24時間分のデータ
+        all_hours = pd.Series(list(hourly_counts), index=range(24))
+        
+        # サンプリング取得の場合は母集団の推定値と信頼区間を表示
+        if sampling:
+            estimates, lower, upper = estimate_counts_with_ci(
+                all_hours.values, sampling['sample_size'], sampling['population'])
+            all_hours = pd.Series(np.round(estimates).astype(int), index=all_hours.index)
+        
+        # グラフ作成
+        plt.figure(figsize=figsize)
+        ax = all_hours.plot(kind='bar', color='skyblue')
+        
+        if sampling:
+            ax.errorbar(range(24), estimates, yerr=[estimates - lower, upper - estimates],
+                        fmt='none', ecolor='#555555', elinewidth=1, capsize=2)
+            plt.title('時間帯別メール分布（推定値・95%信頼区間）', fontsize=14)
+        else:
+            plt.title('時間帯別メール分布', fontsize=14)
+        plt.xlabel('時間帯', fontsize=12)
+        plt.ylabel('メール数', fontsize=12)
+        plt.xticks(rotation=45)
+        plt.grid(axis='y', linestyle='--', alpha=0.7)
+        
+        # データラベル追加
+        for i, v in enumerate(all_hours):
+            ax.text(i, v + 0.1, str(v), ha='center')
+        
+        plt.tight_layout()
+        image = _save_figure(image_format)
+        
+    except Exception as e:
+        print(f"時間帯グラフ作成エラー: {e}")
+        # エラー時は空のグラフを作成
+        plt.figure(figsize=figsize)
+        plt.title('時間帯別分布 (利用不可)', fontsize=14)
+        image = _save_figure(image_format)
+    
+    return image
+
+@_pyplot_locked
+def render_weekday_chart(weekday_counts, figsize=(10, 6), sampling=None, image_format='png'):
+    """曜日分布のグラフを描画（月曜日から順の7日分の件数から、土日を青色で強調）"""
+    plt.figure(figsize=figsize)
+    
+    try:
+        # 曜日の順序を設定
+        ordered_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+        ordered_counts = pd.Series(list(weekday_counts), index=ordered_days)
+        
+        # サンプリング取得の場合は母集団の推定値と信頼区間を表示
+        if sampling:
+            estimates, lower, upper = estimate_counts_with_ci(
+                ordered_counts.values, sampling['sample_size'], sampling['population'])
+            ordered_counts = pd.Series(np.round(estimates).astype(int), index=ordered_days)
+        
+        # 土日とそれ以外で色を分ける
+        colors = ['#FF9999', '#FF9999', '#FF9999', '#FF9999', '#FF9999', '#6699CC', '#4477AA']
+        
+        # グラフ作成
+        ax = ordered_counts.plot(kind='bar', color=colors)
+        
+        if sampling:
+            ax.errorbar(range(7), estimates, yerr=[estimates - lower, upper - estimates],
+                        fmt='none', ecolor='#555555', elinewidth=1, capsize=3)
+            plt.title('曜日別メール分布（推定値・95%信頼区間）', fontsize=14)
+        else:
+            plt.title('曜日別メール分布', fontsize=14)
+        plt.xlabel('曜日', fontsize=12)
+        plt.ylabel('メール数', fontsize=12)
+        plt.xticks(rotation=45)
+        plt.grid(axis='y', linestyle='--', alpha=0.7)
+        
+        # データラベルを追加
+        for i, v in enumerate(ordered_counts):
+            ax.text(i, v + 0.1, str(v), ha='center')
+        
+    except Exception as e:
+        print(f"曜日グラフ作成エラー: {e}")
+        plt.title('曜日別データ (エラー発生)', fontsize=14)
+    
+    plt.tight_layout()
+    return _save_figure(image_format)
+
+@_pyplot_locked
+def render_monthly_chart(monthly_counts, figsize=(10, 6), image_format='png'):
+    """月別分布グラフを描画（1-12月の件数から）"""
+    try:
+        # 1-12月すべてを表示
+        full_months = pd.Series(list(monthly_counts), index=range(1, 13))
+        
+        # 月名のマッピング
+        month_names = ['1月', '2月', '3月', '4月', '5月', '6月', 
+                       '7月', '8月', '9月', '10月', '11月', '12月']
+        
+        # プロット
+        plt.figure(figsize=figsize)
+        bars = plt.bar(range(1, 13), full_months.values, color='#9b59b6')
+        
+        # 軸とタイトルの設定
+        plt.title('月別メール数', pad=10)
+        plt.xlabel('月')
+        plt.ylabel('メール数')
+        
+        # x軸のラベルを設定
+        plt.xticks(range(1, 13), month_names, rotation=45)
+        
+        # グリッド線の追加
+        plt.grid(axis='y', linestyle='--', alpha=0.7)
+        
+        # y軸を0から開始
+        plt.ylim(bottom=0)
+        
+        # データがあるバーにラベルを表示
+        for bar in bars:
+            height = bar.get_height()
+            if height > 0:
+                plt.text(bar.get_x() + bar.get_width()/2., height + 0.5,
+                        f'{int(height)}', ha='center', va='bottom')
+        
+        plt.tight_layout()
+        
+        # 画像バッファに保存
+        image = _save_figure(image_format)
+        
+        return image
+        
+    except Exception as e:
+        print(f"月別グラフ作成エラー: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+@_pyplot_locked
+def render_heatmap_chart(heatmap_counts, figsize=(10, 6), image_format='png'):
+    """曜日×時間帯のヒートマップを描画（7×24の件数から、月曜日が先頭）"""
+    try:
+        # 日本語の曜日名（月曜日から順）
+        jp_weekdays = ['月曜日', '火曜日', '水曜日', '木曜日', '金曜日', '土曜日', '日曜日']
+        pivot_data = pd.DataFrame(heatmap_counts, index=jp_weekdays, columns=range(24))
+        
+        # ヒートマップの作成
+        plt.figure(figsize=figsize)
+        
+        # カラーマップの設定
+        cmap = plt.cm.Blues
+        
+        # ヒートマップ描画
+        ax = sns.heatmap(
+            pivot_data, 
+            cmap=cmap,
+            linewidths=0.5,
+            linecolor='gray',
+            annot=True,
+            fmt='g',
+            annot_kws={"size": 9},
+            cbar_kws={'label': 'メール数', 'shrink': 0.8}
+        )
+        
+        # 軸ラベルの設定
+        plt.xlabel('時間帯（JST）', fontsize=12)
+        plt.ylabel('曜日', fontsize=12)
+        
+        # x軸のラベルを3時間ごとに表示
+        plt.xticks(
+            [i + 0.5 for i in range(0, 24, 3)], 
+            [f"{i}時" for i in range(0, 24, 3)],
+            rotation=0
+        )
+        
+        # タイトル設定
+        plt.title('曜日×時間帯の送信頻度（JST）', fontsize=14)
+        
+        # 業務時間帯（9-17時）を強調表示
+        ax.add_patch(plt.Rectangle((9, 0), 8, 5, fill=False, edgecolor='red', lw=2))
+        
+        # 時間帯の区切り線
+        for h in [6, 12, 18]:
+            plt.axvline(x=h, color='#9e9e9e', linestyle='--', alpha=0.3)
+        
+        # 週末の区切り線
+        plt.axhline(y=5, color='#9e9e9e', linestyle='--', alpha=0.5)
+        
+        plt.tight_layout()
+        
+        # 画像バッファに保存
+        image = _save_figure(image_format, dpi=150, bbox_inches='tight')
+        
+        print("ヒートマップを作成しました")
+        return image
+        
+    except Exception as e:
+        print(f"ヒートマップ作成エラー: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+class _FigureTemplate:
+    """グラフの骨組みを一度だけ作り、データ部分だけを描き直して画像にするテンプレートの基底クラス
+
+    軸・目盛り・タイトルなど変化しない部分は描画結果（背景）をキャッシュし、
+    棒やセルなどデータに依存する部分だけを背景の上に重ねて描く。
+    背景は目盛りの範囲などが同じ場合に使い回せるよう、キーごとに保持する。
+    """
+
+    MAX_BACKGROUNDS = 32
+
+    def __init__(self, figsize, dpi=100):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        
+        plt._load()  # rcParams（日本語フォント）を反映させてから図を作る
+        self.lock = threading.Lock()
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.dynamic_artists = []
+        self.backgrounds = {}
+
+    def _render(self, key):
+        """背景（キャッシュ）の上にデータ部分を描画し、PNG画像のバッファを返す"""
+        from PIL import Image
+        
+        cached = self.backgrounds.get(key)
+        if cached is None:
+            # データ部分を隠した状態でレイアウトを計算して背景を描画
+            for artist in self.dynamic_artists:
+                artist.set_visible(False)
+            self.figure.tight_layout()
+            self.canvas.draw()
+            params = self.figure.subplotpars
+            layout = {name: getattr(params, name)
+                      for name in ('left', 'right', 'bottom', 'top', 'wspace', 'hspace')}
+            cached = (self.canvas.copy_from_bbox(self.figure.bbox), layout)
+            if len(self.backgrounds) >= self.MAX_BACKGROUNDS:
+                self.backgrounds.clear()
+            self.backgrounds[key] = cached
+            for artist in self.dynamic_artists:
+                artist.set_visible(True)
+        else:
+            self.figure.subplots_adjust(**cached[1])
+        
+        background, _ = cached
+        self.canvas.restore_region(background)
+        for artist in self.dynamic_artists:
+            self.figure.draw_artist(artist)
+        
+        image = io.BytesIO()
+        width, height = self.canvas.get_width_height(physical=True)
+        Image.frombuffer('RGBA', (width, height), self.canvas.buffer_rgba(),
+                         'raw', 'RGBA', 0, 1).save(image, format='png')
+        image.seek(0)
+        return image
+
+class _BarChartTemplate(_FigureTemplate):
+    """棒グラフのテンプレート（棒の高さとデータラベルだけを更新する）"""
+
+    def __init__(self, figsize, title, xlabel, ylabel, positions, tick_labels, colors,
+                 width=0.8, label_offset=0.1, label_va='baseline', skip_zero_labels=False,
+                 title_kwargs=None, label_fontsize=None):
+        super().__init__(figsize)
+        self.label_offset = label_offset
+        self.skip_zero_labels = skip_zero_labels
+        
+        self.ax = self.figure.add_subplot()
+        self.bars = self.ax.bar(positions, [0] * len(positions), width=width, color=colors)
+        self.labels = [self.ax.text(x, 0, '', ha='center', va=label_va) for x in positions]
+        self.dynamic_artists = list(self.bars) + self.labels
+        
+        self.ax.set_title(title, **(title_kwargs or {}))
+        self.ax.set_xlabel(xlabel, fontsize=label_fontsize)
+        self.ax.set_ylabel(ylabel, fontsize=label_fontsize)
+        self.ax.set_xticks(positions)
+        self.ax.set_xticklabels(tick_labels, rotation=45)
+        self.ax.grid(axis='y', linestyle='--', alpha=0.7)
+        self.ax.set_axisbelow(True)
+
+    def render(self, counts):
+        with self.lock:
+            values = [int(v) for v in counts]
+            for bar, label, value in zip(self.bars, self.labels, values):
+                bar.set_height(value)
+                if self.skip_zero_labels and value <= 0:
+                    label.set_text('')
+                else:
+                    label.set_text(str(value))
+                    label.set_y(value + self.label_offset)
+            
+            # y軸の上限を目盛りの区切りに揃え、同じ上限の送信者では背景を使い回す
+            peak = max(values) if values else 0
+            upper = max(peak * 1.1, peak + self.label_offset * 5, 1)
+            top = float(self.ax.yaxis.get_major_locator().tick_values(0, upper)[-1])
+            self.ax.set_ylim(0, top)
+            return self._render(top)
+
+class _HeatmapTemplate(_FigureTemplate):
+    """曜日×時間帯ヒートマップのテンプレート（セルの値と注記だけを更新する）"""
+
+    def __init__(self, figsize):
+        from matplotlib.patches import Rectangle
+        
+        super().__init__(figsize, dpi=150)
+        self.ax = self.figure.add_subplot()
+        self.mesh = self.ax.pcolormesh(np.zeros((7, 24)), cmap='Blues',
+                                       edgecolors='gray', linewidth=0.5)
+        self.colorbar = self.figure.colorbar(self.mesh, ax=self.ax, shrink=0.8)
+        self.colorbar.set_label('メール数')
+        self.colorbar.outline.set_visible(False)
+        self.texts = [[self.ax.text(h + 0.5, d + 0.5, '', ha='center', va='center', fontsize=9)
+                       for h in range(24)] for d in range(7)]
+        
+        # seabornのheatmapと同じく先頭の曜日を上に表示する
+        self.ax.set_xlim(0, 24)
+        self.ax.set_ylim(7, 0)
+        for spine in self.ax.spines.values():
+            spine.set_visible(False)
+        jp_weekdays = ['月曜日', '火曜日', '水曜日', '木曜日', '金曜日', '土曜日', '日曜日']
+        self.ax.set_yticks([d + 0.5 for d in range(7)])
+        self.ax.set_yticklabels(jp_weekdays, rotation=0)
+        self.ax.set_xticks([i + 0.5 for i in range(0, 24, 3)])
+        self.ax.set_xticklabels([f"{i}時" for i in range(0, 24, 3)], rotation=0)
+        self.ax.tick_params(length=0)
+        self.ax.set_xlabel('時間帯（JST）', fontsize=12)
+        self.ax.set_ylabel('曜日', fontsize=12)
+        self.ax.set_title('曜日×時間帯の送信頻度（JST）', fontsize=14)
+        
+        # 業務時間帯（9-17時）の強調と区切り線（セルより手前に描くため毎回描き直す）
+        overlays = [self.ax.add_patch(Rectangle((9, 0), 8, 5, fill=False, edgecolor='red', lw=2))]
+        for h in [6, 12, 18]:
+            overlays.append(self.ax.axvline(x=h, color='#9e9e9e', linestyle='--', alpha=0.3))
+        overlays.append(self.ax.axhline(y=5, color='#9e9e9e', linestyle='--', alpha=0.5))
+        self.dynamic_artists = [self.mesh] + [t for row in self.texts for t in row] + overlays
+
+    def render(self, heatmap_counts):
+        with self.lock:
+            values = np.asarray(heatmap_counts, dtype=float).reshape(7, 24)
+            vmin, vmax = float(values.min()), float(values.max())
+            if vmax <= vmin:
+                vmax = vmin + 1
+            self.mesh.set_array(values.ravel())
+            self.mesh.set_clim(vmin, vmax)
+            
+            # セルの明るさに応じて注記の文字色を切り替える（seabornと同じ基準）
+            rgb = self.mesh.cmap(self.mesh.norm(values))[..., :3]
+            rgb = np.where(rgb <= .03928, rgb / 12.92, ((rgb + .055) / 1.055) ** 2.4)
+            luminance = rgb.dot([.2126, .7152, .0722])
+            for d in range(7):
+                for h in range(24):
+                    text = self.texts[d][h]
+                    text.set_text(f'{values[d, h]:g}')
+                    text.set_color('.15' if luminance[d, h] > .408 else 'w')
+            
+            # カラーバーの目盛りは値の範囲で決まるため、範囲ごとに背景を使い回す
+            return self._render((vmin, vmax))
+
+def _build_chart_template(kind, figsize):
+    """グラフ種別ごとのテンプレートを作成する（見た目は render_*_chart に合わせる）"""
+    if kind == 'hourly':
+        return _BarChartTemplate(
+            figsize, '時間帯別メール分布', '時間帯', 'メール数',
+            positions=list(range(24)), tick_labels=[str(h) for h in range(24)],
+            colors='skyblue', width=0.5, title_kwargs={'fontsize': 14}, label_fontsize=12)
+    if kind == 'weekday':
+        return _BarChartTemplate(
+            figsize, '曜日別メール分布', '曜日', 'メール数',
+            positions=list(range(7)),
+            tick_labels=['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+            colors=['#FF9999'] * 5 + ['#6699CC', '#4477AA'],
+            width=0.5, title_kwargs={'fontsize': 14}, label_fontsize=12)
+    if kind == 'monthly':
+        return _BarChartTemplate(
+            figsize, '月別メール数', '月', 'メール数',
+            positions=list(range(1, 13)), tick_labels=[f'{m}月' for m in range(1, 13)],
+            colors='#9b59b6', label_offset=0.5, label_va='bottom', skip_zero_labels=True,
+            title_kwargs={'pad': 10})
+    if kind == 'heatmap':
+        return _HeatmapTemplate(figsize)
+    raise ValueError(f"未対応のグラフ種別です: {kind}")
+
+# (グラフ種別, figsize) ごとのテンプレート（プロセス内で使い回す）
+_chart_templates = {}
+_chart_templates_lock = threading.Lock()
+
+def render_chart_from_template(kind, counts, figsize=(10, 6)):
+    """テンプレートの図にデータだけを差し替えてグラフを描画する
+
+    軸の作成・目盛りの書式・フォント解決・レイアウト計算は初回のみ行うため、
+    多数の送信者を続けて処理する場合に1枚あたりの描画時間を大きく短縮できる。
+    失敗した場合は通常の描画関数で作り直す。
+    """
+    # 骨組みにはフォントも含まれるため、フォントごとに別のテンプレートにする
+    key = (kind, tuple(figsize), plt.rcParams['font.sans-serif'][0])
+    try:
+        with _chart_templates_lock:
+            template = _chart_templates.get(key)
+            if template is None:
+                template = _chart_templates[key] = _build_chart_template(kind, figsize)
+        return template.render(counts)
+    except Exception as e:
+        print(f"テンプレート描画エラー（{kind}）: {e}（通常の描画に切り替えます）")
+        with _chart_templates_lock:
+            _chart_templates.pop(key, None)
+        fallback = {
+            'hourly': render_hourly_chart,
+            'weekday': render_weekday_chart,
+            'monthly': render_monthly_chart,
+            'heatmap': render_heatmap_chart,
+        }[kind]
+        return fallback(counts, figsize)
+
+_render_pool = None
+_render_pool_workers = 0
+_render_pool_lock = threading.Lock()
+
+def _init_render_worker():
+    """描画プロセスの初期化（Aggバックエンドとフォント設定を先に済ませる）"""
+    plt._load()
+
+def _get_render_pool(max_workers):
+    """描画用のプロセスプールを返す（プロセス内で1つを使い回す）
+
+    プロセス数が前回と異なる場合は、前のプールを（実行中の描画が終わってから）止めて作り直す。
+    """
+    global _render_pool, _render_pool_workers
+    with _render_pool_lock:
+        if _render_pool is not None and _render_pool_workers != max_workers:
+            _render_pool.shutdown(wait=False)
+            _render_pool = None
+        if _render_pool is None:
+            import atexit
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            
+            # スレッドを使う処理と共存できるようにspawnで起動
+            _render_pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_render_worker)
+            _render_pool_workers = max_workers
+            atexit.register(_render_pool.shutdown, wait=False)
+        return _render_pool
+
+def _reset_render_pool():
+    """異常終了したプロセスプールを破棄する"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False)
+            _render_pool = None
+
+_insight_executor = None
+_insight_executor_lock = threading.Lock()
+
+def _get_insight_executor():
+    """考察生成（Claude APIの呼び出し）用のスレッドプールを返す（プロセス内で1つを使い回す）"""
+    global _insight_executor
+    with _insight_executor_lock:
+        if _insight_executor is None:
+            _insight_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='insights')
+        return _insight_executor
+
+def _chart_tasks(aggregates, figsize, use_templates=False, image_format='png'):
+    """レポート用の各グラフについて (描画関数, 引数) を返す"""
+    sampling = aggregates['sampling']
+    tasks = {
+        'hourly': (render_hourly_chart, (aggregates['hourly'], figsize, sampling, image_format)),
+        'weekday': (render_weekday_chart, (aggregates['weekday'], figsize, sampling, image_format)),
+        'monthly': (render_monthly_chart, (aggregates['monthly'], figsize, image_format)),
+        'heatmap': (render_heatmap_chart, (aggregates['heatmap'], figsize, image_format)),
+    }
+    # テンプレートはラスター画像の差分描画なのでPNG出力の場合のみ使う
+    if use_templates and image_format == 'png':
+        for name in tasks:
+            if name in ('hourly', 'weekday') and sampling:
+                continue
+            tasks[name] = (render_chart_from_template, (name, aggregates[name], figsize))
+    return tasks
+
+def render_chart(name, aggregates, figsize=(5, 3), image_format='png', font_path=None):
+    """レポート用のグラフを1つだけ描画する（SVGが埋め込めなかった場合の再描画など）"""
+    func, args = _chart_tasks(aggregates, figsize, image_format=image_format)[name]
+    return _render_with_font(font_path, func, args)
+
+def render_charts(aggregates, figsize=(5, 3), max_workers=0, use_templates=False, image_format='png',
+                  names=None, font_path=None):
+    """レポート用の4つのグラフを描画し {'hourly', 'weekday', 'monthly', 'heatmap'} の結果を返す
+
+    各グラフは独立しているため、max_workers>0 の場合はプロセスプールで並列に描画する。
+    プロセスには集計済みの値（aggregates）のみを渡す。
+    use_templates=True の場合は使い回しのテンプレート図にデータを差し替えて描画する
+    （サンプリング取得で信頼区間を表示するグラフは通常の描画を使う）。
+    image_format='svg' の場合はPDFにベクター画像として埋め込めるSVGを返す。
+    namesを指定した場合はそのグラフだけを描画する。
+    font_path を指定した場合はそのフォントで描画する（描画プロセスでも同じフォントを登録する）。
+    """
+    tasks = _chart_tasks(aggregates, figsize, use_templates, image_format)
+    if names is not None:
+        tasks = {name: task for name, task in tasks.items() if name in names}
     
-    if Path(font_path).exists():
-        return font_path
+    if max_workers:
+        try:
+            pool = _get_render_pool(max_workers)
+            futures = {name: pool.submit(_render_with_font, font_path, func, args)
+                       for name, (func, args) in tasks.items()}
+            return {name: future.result() for name, future in futures.items()}
+        except Exception as e:
+            # プロセスプールが使えない場合は順番に描画する
+            print(f"並列描画エラー: {e}（順番に描画します）")
+            _reset_render_pool()
     
-    # デフォルトはArialに
-    return None
+    return {name: _render_with_font(font_path, func, args) for name, (func, args) in tasks.items()}
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
-class PDF(FPDF):
-    """PDFレポート生成用のカスタムクラス"""
-    def __init__(self):
-        super().__init__()
-        self.japanese_font_available = False
-        japanese_font = self.get_japanese_font_path()
-        if japanese_font:
-            self.japanese_font_available = True
-            self.add_font('japanese', '', japanese_font)
-            self.add_font('japanese', 'B', japanese_font)
-
-    def get_japanese_font_path(self):
-        """日本語フォントのパスを取得"""
+def _parse_query_date(value):
+    """datetime・date・'YYYY-MM-DD' を date に変換する"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value), '%Y-%m-%d').date()
+
+def _format_query_date(value):
+    """チェックポイントに保存できる 'YYYY-MM-DD' 形式にする（Noneはそのまま）"""
+    return None if value is None else _parse_query_date(value).isoformat()
+
+def _safe_filename(text):
+    """メールアドレスなどからファイル名に使えない文字を取り除く"""
+    return re.sub(r'[\\/*?:"<>|]', "_", text)
+
+# メタデータ形式で取得するヘッダー（本文はダウンロードしない）
+METADATA_HEADERS = ['Date', 'Subject', 'From', 'To']
+
+def _define_pdf_class():
+    """fpdf2を読み込んでPDFクラスを定義する（初回アクセス時のみ）"""
+    from fpdf import FPDF, XPos, YPos
+
+    class PDF(FPDF):
+        """PDFレポート生成用のカスタムクラス"""
+        def __init__(self, font_resolver=None):
+            super().__init__()
+            self.font_resolver = font_resolver or get_font_resolver()
+            self.japanese_font_available = self.font_resolver.add_to_pdf(self, 'japanese')
+
+        def get_japanese_font_path(self):
+            """日本語フォントのパスを取得"""
+            return self.font_resolver.find_font_path()
+
+        def section_title(self, x, y, title, width):
+            """セクションタイトルを描画"""
+            self.set_xy(x, y)
+            if self.japanese_font_available:
+                self.set_font('japanese', 'B', 11)
+            else:
+                self.set_font('Arial', 'B', 11)
+            self.set_fill_color(200, 220, 255)
+            self.cell(width, 7, title, 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L', fill=True)
+            return self.get_y()
+
+    return PDF
+
+def __getattr__(name):
+    # PDFクラスはfpdf2の読み込みを伴うため初回アクセス時に定義する
+    if name == 'PDF':
+        pdf_class = _define_pdf_class()
+        globals()['PDF'] = pdf_class
+        return pdf_class
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class QuotaExceededError(Exception):
+    """Gmail APIの日次クォータを超える呼び出しを行おうとした場合の例外"""
+
+
+class QuotaAccountant:
+    """Gmail APIのクォータ消費量を呼び出し種別ごとに記録し、レート制限内に収める
+
+    呼び出し前に charge() を呼ぶと、直近1秒間の消費量が毎秒の上限を超えないよう
+    必要に応じて待機し、日次の上限を超える場合は QuotaExceededError を送出する。
+    日次の集計はUTCの日付で区切る。
+    """
+    # 呼び出し種別ごとのクォータ単位（batchは内部のリクエスト1件あたり）
+    UNIT_COSTS = {
+        'list': 5,      # users.messages.list
+        'get': 5,       # users.messages.get
+        'batch': 5,     # バッチ内のusers.messages.get
+        'history': 2,   # users.history.list
+        'threads': 10,  # users.threads.get / list
+    }
+
+    def __init__(self, per_second_limit=250, per_day_limit=1000000000):
+        self.per_second_limit = per_second_limit
+        self.per_day_limit = per_day_limit
+        self.units_by_type = Counter()
+        self.calls_by_type = Counter()
+        self.units_today = 0
+        self._day = datetime.now(timezone.utc).date()
+        self._window = deque()  # (時刻, 単位数)
+        self._window_units = 0
+        self._lock = threading.Lock()
+
+    def cost(self, call_type, count=1):
+        """呼び出しに必要なクォータ単位を返す"""
+        return self.UNIT_COSTS[call_type] * count
+
+    def charge(self, call_type, count=1):
+        """呼び出し前にクォータを計上する（毎秒の上限を超える場合は待機）"""
+        while True:
+            wait = self.try_charge(call_type, count)
+            if wait == 0:
+                return self.cost(call_type, count)
+            time.sleep(wait)
+
+    def try_charge(self, call_type, count=1):
+        """待たずに計上できれば計上して0を、毎秒の上限を超える場合は待つべき秒数を返す
+
+        非同期処理からはこの秒数だけ await asyncio.sleep() してから呼び直す。
+        """
+        units = self.cost(call_type, count)
+        with self._lock:
+            # 日付が変わったら日次の集計をリセット
+            today = datetime.now(timezone.utc).date()
+            if today != self._day:
+                self._day = today
+                self.units_today = 0
+            
+            if self.units_today + units > self.per_day_limit:
+                raise QuotaExceededError(
+                    f"日次クォータの上限に達しました（本日の消費: {self.units_today}/{self.per_day_limit}単位）")
+            
+            # 直近1秒間の消費量が上限を超える場合は待ち時間を返す
+            now = time.monotonic()
+            while self._window and now - self._window[0][0] >= 1.0:
+                self._window_units -= self._window.popleft()[1]
+            if self._window and self._window_units + units > self.per_second_limit:
+                return max(1.0 - (now - self._window[0][0]), 0.001)
+            
+            self._window.append((now, units))
+            self._window_units += units
+            self.units_today += units
+            self.units_by_type[call_type] += units
+            self.calls_by_type[call_type] += 1
+        return 0
+
+    def remaining_today(self):
+        """本日の残りクォータ単位を返す"""
+        return max(0, self.per_day_limit - self.units_today)
+
+    def summary(self):
+        """セッション全体の消費量を辞書で返す"""
+        with self._lock:
+            return {
+                'units_by_type': dict(self.units_by_type),
+                'calls_by_type': dict(self.calls_by_type),
+                'total_units': sum(self.units_by_type.values()),
+                'units_today': self.units_today,
+                'remaining_today': max(0, self.per_day_limit - self.units_today),
+            }
+
+    def print_summary(self):
+        """消費量を表示する"""
+        summary = self.summary()
+        print('\n=== Gmail APIクォータ消費量 ===')
+        for call_type in self.UNIT_COSTS:
+            if call_type in summary['calls_by_type']:
+                print(f"{call_type}: {summary['calls_by_type'][call_type]}回 / {summary['units_by_type'][call_type]}単位")
+        print(f"合計: {summary['total_units']}単位（本日の残り: {summary['remaining_today']}単位）")
+
+
+class AuthenticationError(Exception):
+    """認証情報が無効で、再認証が必要な場合の例外"""
+
+
+class CredentialManager:
+    """OAuthトークンをスレッド・プロセス間で安全に共有し、期限前に更新する
+
+    token.json の読み書きはファイルロック（token.json.lock）の下で行う。有効期限の
+    refresh_margin 秒前になると先回りして更新し、他のプロセスが更新済みであれば
+    ファイルから読み直して使う。認証情報オブジェクトは1つを共有し、その場で更新する
+    ため、各スレッドのHTTP接続にも更新後のトークンが反映される。
+    非対話モードではブラウザでの認証を行わず AuthenticationError を送出する。
+    """
+
+    def __init__(self, token_path='token.json', credentials_path='credentials.json',
+                 interactive=None, refresh_margin=300):
+        self.token_path = token_path
+        self.credentials_path = credentials_path
+        if interactive is None:
+            # 端末から実行されている場合のみブラウザ認証を許可
+            interactive = sys.stdin is not None and sys.stdin.isatty()
+        self.interactive = interactive
+        self.refresh_margin = refresh_margin
+        self._credentials = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _file_lock(self):
+        """トークンファイルの排他ロック（プロセス間）"""
+        with open(f"{self.token_path}.lock", 'a+') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _needs_refresh(self, creds):
+        """更新が必要か（期限切れ、または期限までrefresh_margin秒未満）"""
+        if not creds.token:
+            return True
+        if creds.expiry is None:
+            return False
+        # google-authのexpiryはタイムゾーンなしのUTC
+        remaining = (creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+        return remaining < self.refresh_margin
+
+    def _load_token(self):
+        """トークンファイルを読み込む（なければNone）"""
+        from google.oauth2.credentials import Credentials
+        
+        if not os.path.exists(self.token_path):
+            return None
         try:
-            # Macの場合
-            font_path = '/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc'
-            if Path(font_path).exists():
-                return font_path
-            
-            # Windowsの場合
-            font_path = 'C:/Windows/Fonts/msgothic.ttc'
-            if Path(font_path).exists():
-                return font_path
-            
-            # Linuxの場合
-            font_path = '/usr/share/fonts/truetype/fonts-japanese-gothic.ttf'
-            if Path(font_path).exists():
-                return font_path
-            
+            with open(self.token_path, 'r') as f:
+                return Credentials.from_authorized_user_info(json.load(f), SCOPES)
+        except Exception as e:
+            print(f"トークンファイル読み込みエラー: {e}")
             return None
-        except:
+
+    def _save_token(self, creds):
+        """トークンファイルを保存する（書き込み途中の状態を他のプロセスに見せない）"""
+        tmp_path = f"{self.token_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(creds.to_json())
+        os.replace(tmp_path, self.token_path)
+
+    def _run_authorization_flow(self):
+        """ブラウザで新規に認証する（非対話モードでは失敗させる）"""
+        if not self.interactive:
+            raise AuthenticationError(
+                f"有効なトークンがありません（{self.token_path}）。"
+                "対話モードで一度認証を実行してトークンを作成してください。")
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        
+        flow = InstalledAppFlow.from_client_secrets_file(self.credentials_path, SCOPES)
+        return flow.run_local_server(port=0)
+
+    def get_credentials(self):
+        """有効な認証情報を返す（必要に応じてロック下で更新）"""
+        creds = self._credentials
+        if creds is not None and not self._needs_refresh(creds):
+            return creds
+        
+        with self._lock:
+            creds = self._credentials
+            if creds is not None and not self._needs_refresh(creds):
+                return creds
+            
+            with self._file_lock():
+                # 他のプロセスが更新済みであればファイルの内容を使う
+                file_creds = self._load_token()
+                if file_creds is not None and not self._needs_refresh(file_creds):
+                    fresh = file_creds
+                else:
+                    fresh = self._refresh(file_creds or creds)
+                    self._save_token(fresh)
+            
+            if self._credentials is None:
+                self._credentials = fresh
+            elif fresh is not self._credentials:
+                # 共有している認証情報オブジェクトをその場で更新する
+                self._credentials.token = fresh.token
+                self._credentials.expiry = fresh.expiry
+                if fresh.refresh_token and fresh.refresh_token != self._credentials.refresh_token:
+                    # リフレッシュトークンが新しくなった（古いものは無効になる）場合はそれも引き継ぐ
+                    self._credentials._refresh_token = fresh.refresh_token
+            return self._credentials
+
+    def _refresh(self, creds):
+        """リフレッシュトークンで更新し、できなければ新規に認証する"""
+        from google.auth.transport.requests import Request
+        
+        if creds is not None and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+                return creds
+            except google_auth_exceptions.RefreshError as e:
+                print(f"トークンリフレッシュエラー: {e}")
+        return self._run_authorization_flow()
+
+
+class GmailServiceFactory:
+    """Gmail APIのサービスオブジェクトを生成・再利用する
+
+    ディスカバリドキュメントはパッケージ同梱の静的ドキュメントをプロセス内で一度だけ
+    読み込んで共有する。httplib2.Httpはスレッドセーフではないため、HTTP接続は
+    スレッドごとに保持し、キープアライブで同じ接続を使い回す。
+    """
+    _discovery_document = None
+    _discovery_lock = threading.Lock()
+    # スレッドごとのHTTP接続（アナライザーを作り直してもTLS接続を再利用する）
+    _thread_local = threading.local()
+
+    def __init__(self, credentials, timeout=60):
+        self.credentials = credentials
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def get_discovery_document(cls):
+        """Gmail APIのディスカバリドキュメントを返す（プロセス内でキャッシュ）"""
+        if cls._discovery_document is None:
+            with cls._discovery_lock:
+                if cls._discovery_document is None:
+                    from googleapiclient import discovery_cache
+                    document = discovery_cache.get_static_doc('gmail', 'v1')
+                    if document is None:
+                        # 静的ドキュメントがない古いバージョンではネットワークから取得
+                        import httplib2
+                        _, content = httplib2.Http(timeout=60).request(
+                            'https://gmail.googleapis.com/$discovery/rest?version=v1')
+                        document = content.decode('utf-8')
+                    cls._discovery_document = json.loads(document)
+        return cls._discovery_document
+
+    @classmethod
+    def _get_thread_http(cls, timeout):
+        """現在のスレッド用のHTTP接続を返す"""
+        http = getattr(cls._thread_local, 'http', None)
+        if http is None:
+            import httplib2
+            http = httplib2.Http(timeout=timeout)
+            cls._thread_local.http = http
+        return http
+
+    def get_service(self):
+        """現在のスレッド用のサービスオブジェクトを返す"""
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            import google_auth_httplib2
+            from googleapiclient.discovery import build_from_document
+            
+            # 認証情報は共有し、HTTP接続のみスレッドごとに分ける
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials, http=self._get_thread_http(self.timeout))
+            service = build_from_document(self.get_discovery_document(), http=http)
+            self._local.service = service
+        return service
+
+
+class AnalysisCancelled(Exception):
+    """進捗のコールバックがFalseを返して分析が中断された場合の例外（内部で使用）"""
+
+
+class _ProgressReporter:
+    """analyze_emails_from_sender の進捗をコールバックに通知する
+
+    イベントは辞書で、共通のキー（type, sender, pages, listed, total, fetched, errors,
+    elapsed, eta）に種類ごとの値を加えたもの。コールバックが False を返すと分析を中断する。
+    メッセージ1件ごとに 'fetched'（失敗した場合は 'error'）を通知し、partial_interval 件ごとに
+    それに続けて途中までの集計値（'aggregate'）を通知する。集計値は取得のたびに更新する
+    件数から作るため、取得件数が多くても通知のたびに全体を集計し直さない。
+    前回からの分布の変化量（drift、0〜1）で分布が落ち着いたかを判断できるようにする。
+    """
+
+    WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+    def __init__(self, analyzer, callback, sender_email, partial_interval=100):
+        self.analyzer = analyzer
+        self.callback = callback
+        self.sender_email = sender_email
+        self.partial_interval = partial_interval
+        self.started = time.monotonic()
+        self.pages = 0
+        self.listed = 0
+        self.total = None
+        self.fetched = 0
+        self.errors = 0
+        self._fetch_started = None
+        self._fetched_before = 0  # チェックポイントから読み込んだ件数
+        self._last_distribution = None
+        # 途中経過の集計値（_compute_chart_aggregates と同じ区分。取得に失敗したメッセージは数えない）
+        self._counted = 0
+        self._hourly = [0] * 24
+        self._weekday = [0] * 7
+        self._monthly = [0] * 12
+        self._heatmap = [[0] * 24 for _ in range(7)]
+
+    def emit(self, event_type, **fields):
+        """イベントを通知する（コールバックが False を返した場合は AnalysisCancelled）"""
+        if self.callback is None:
+            return
+        event = {
+            'type': event_type,
+            'sender': self.sender_email,
+            'pages': self.pages,
+            'listed': self.listed,
+            'total': self.total,
+            'fetched': self.fetched,
+            'errors': self.errors,
+            'elapsed': round(time.monotonic() - self.started, 2),
+            'eta': self.eta(),
+        }
+        event.update(fields)
+        if self.callback(event) is False:
+            raise AnalysisCancelled(f"{self.sender_email}: 分析がキャンセルされました")
+
+    def eta(self):
+        """残りの取得にかかる秒数の見込み（まだ計算できない場合はNone）"""
+        if self._fetch_started is None or self.total is None:
             return None
+        done = self.fetched - self._fetched_before
+        if done <= 0:
+            return None
+        rate = done / max(time.monotonic() - self._fetch_started, 1e-6)
+        return round((self.total - self.fetched) / rate, 1)
+
+    def page_listed(self, count):
+        """一覧取得の1ページ分（サンプリングモードでは抽出前の件数）"""
+        self.pages += 1
+        self.listed += count
+        self.emit('listed')
+
+    def fetch_started(self, total, records):
+        """メッセージの取得開始（records はチェックポイントで取得済みのレコード）"""
+        self.total = total
+        self.fetched = self._fetched_before = len(records)
+        for record in records:
+            self._count(record)
+        self._fetch_started = time.monotonic()
+        self.emit('fetch_started')
 
-    def section_title(self, x, y, title, width):
-        """セクションタイトルを描画"""
-        self.set_xy(x, y)
-        if self.japanese_font_available:
-            self.set_font('japanese', 'B', 11)
+    def message_fetched(self, record, message_id, error=None):
+        """メッセージ1件の取得（失敗した場合はerror）"""
+        self.fetched += 1
+        if error is not None:
+            self.errors += 1
+            self.emit('error', message_id=message_id, error=str(error))
         else:
-            self.set_font('Arial', 'B', 11)
-        self.set_fill_color(200, 220, 255)
-        self.cell(width, 7, title, 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L', fill=True)
-        return self.get_y()
+            self._count(record)
+            self.emit('fetched', message_id=message_id)
+        if self.partial_interval and self.fetched % self.partial_interval == 0:
+            self.emit_partial()
+
+    def _count(self, record):
+        """取得したレコードを途中経過の集計値に加える"""
+        if self.callback is None or self.analyzer._is_error_record(record):
+            return
+        sent = pd.Timestamp(record['date'])
+        if pd.isna(sent):
+            return
+        weekday = record.get('weekday')
+        day = self.WEEKDAYS.index(weekday) if weekday in self.WEEKDAYS else sent.weekday()
+        self._counted += 1
+        self._hourly[sent.hour] += 1
+        self._weekday[day] += 1
+        self._monthly[sent.month - 1] += 1
+        self._heatmap[sent.weekday()][sent.hour] += 1
+
+    def emit_partial(self):
+        """途中までの集計値を通知する"""
+        if self.callback is None or not self._counted:
+            return
+        aggregates = {
+            'hourly': list(self._hourly),
+            'weekday': list(self._weekday),
+            'monthly': list(self._monthly),
+            'heatmap': [list(row) for row in self._heatmap],
+            'sampling': None,
+        }
+        # 時刻別・曜日別の構成比の変化量（全変動距離）の大きい方
+        distribution = [np.array(aggregates[name], dtype=float) / max(sum(aggregates[name]), 1)
+                        for name in ('hourly', 'weekday')]
+        drift = None
+        if self._last_distribution is not None:
+            drift = round(max(float(np.abs(new - old).sum()) / 2
+                              for new, old in zip(distribution, self._last_distribution)), 4)
+        self._last_distribution = distribution
+        self.emit('aggregate', aggregates=aggregates, drift=drift)
+
+
+class FetchCheckpoint:
+    """長時間のメール取得の進捗をディスクに保存し、中断後に再開できるようにする
+
+    state.json に取得条件とページトークン、message_ids.txt に一覧取得したID、
+    records.jsonl に取得済みのレコードを追記形式で保存する。サンプリングモードの一覧取得中は
+    sampling.json にページトークンと抽出途中のサンプル・乱数の状態を保存する。
+    """
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.state_path = self.checkpoint_dir / 'state.json'
+        self.sampling_path = self.checkpoint_dir / 'sampling.json'
+        self.ids_path = self.checkpoint_dir / 'message_ids.txt'
+        self.records_path = self.checkpoint_dir / 'records.jsonl'
+
+    def exists(self):
+        """チェックポイントが保存済みかどうか"""
+        return self.state_path.exists()
+
+    def load_state(self):
+        """取得条件と進捗を読み込む"""
+        with open(self.state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        """取得条件と進捗を保存する（書き込み途中で中断しても壊れないように置き換える）"""
+        self._write_json(self.state_path, state)
+
+    def load_sampling_state(self):
+        """サンプリングの一覧取得の途中経過を読み込む（保存されていない場合はNone）"""
+        if not self.sampling_path.exists():
+            return None
+        with open(self.sampling_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_sampling_state(self, sampling_state):
+        """サンプリングの一覧取得の途中経過を保存する"""
+        self._write_json(self.sampling_path, sampling_state)
+
+    def clear_sampling_state(self):
+        """一覧取得が終わったサンプリングの途中経過を削除する"""
+        try:
+            self.sampling_path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _write_json(self, path, data):
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load_message_ids(self, count):
+        """保存済みのIDを読み込む（状態に記録された件数まで）"""
+        if not self.ids_path.exists():
+            return []
+        with open(self.ids_path, 'r', encoding='utf-8') as f:
+            message_ids = [line.strip() for line in f if line.strip()]
+        # 状態の保存前に中断した場合の余分なIDは捨てる
+        message_ids = message_ids[:count]
+        with open(self.ids_path, 'w', encoding='utf-8') as f:
+            f.writelines(f"{msg_id}\n" for msg_id in message_ids)
+        return message_ids
+
+    def append_message_ids(self, message_ids):
+        """一覧取得したIDを追記する"""
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.ids_path, 'a', encoding='utf-8') as f:
+            f.writelines(f"{msg_id}\n" for msg_id in message_ids)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load_records(self):
+        """取得済みのレコードを読み込む"""
+        records = []
+        if not self.records_path.exists():
+            return records
+        with open(self.records_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で中断した最後の行は無視する
+                    continue
+                record['date'] = pd.Timestamp(record['date'])
+                records.append(record)
+        return records
+
+    def append_records(self, records):
+        """取得したレコードを追記する"""
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.records_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class _DiskCache:
+    """内容のハッシュをキーにしたディスクキャッシュ
+
+    1エントリ1ファイルで保存し、合計サイズが max_bytes を超えたら
+    最後に使われた時刻（ファイルの更新時刻、ヒットするたびに更新）が古いものから削除する。
+    書き込みは一時ファイルを置き換えるため、複数のプロセスで同じディレクトリを共有できる。
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None  # 初回の書き込み時にディレクトリを走査して求める
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts):
+        """JSONに変換できる値からキャッシュキー（sha256）を作る"""
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix=''):
+        return self.cache_dir / key[:2] / f"{key}{suffix}"
+
+    def get_path(self, key, suffix=''):
+        """キャッシュ済みのファイルのパスを返す（ない場合はNone）"""
+        path = self._path(key, suffix)
+        try:
+            os.utime(path)  # 最後に使われた時刻を更新
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def get_bytes(self, key, suffix=''):
+        """キャッシュ済みの内容を返す（ない場合はNone）"""
+        path = self.get_path(key, suffix)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def put_bytes(self, key, data, suffix=''):
+        """内容を保存してパスを返す"""
+        return self._store(key, suffix, lambda f: f.write(data))
+
+    def put_file(self, key, source_path, suffix=''):
+        """ファイルを複製して保存しパスを返す"""
+        def write(f):
+            with open(source_path, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        return self._store(key, suffix, write)
+
+    def _store(self, key, suffix, write):
+        path = self._path(key, suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        try:
+            old_size = path.stat().st_size
+        except OSError:
+            old_size = 0
+        os.replace(tmp_path, path)
+        self._added(path.stat().st_size - old_size)
+        return path
+
+    def _entries(self):
+        """(最終使用時刻, サイズ, パス) の一覧"""
+        entries = []
+        if not self.cache_dir.exists():
+            return entries
+        for path in self.cache_dir.glob('*/*'):
+            if path.name.endswith('.tmp'):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue  # 他のプロセスが削除した
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _added(self, size):
+        """書き込んだサイズを加算し、上限を超えたら古いものから削除する"""
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._total_bytes += size
+            if self._total_bytes <= self.max_bytes:
+                return
+            
+            # 他のプロセスの書き込みもあるため、削除の前に実際の合計を数え直す
+            entries = sorted(self._entries(), key=lambda entry: entry[0])
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                    total -= size
+                except OSError:
+                    pass
+            self._total_bytes = total
+
+    def clear(self):
+        """キャッシュをすべて削除する"""
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            self._total_bytes = 0
+
+
+class ReportCache(_DiskCache):
+    """集計値が前回と同じ送信者のレポートとグラフ画像を再利用するキャッシュ
+
+    グラフ画像は各グラフの集計値と描画設定、PDFはそれに加えて
+    レポートに載る基本情報と考察の本文のハッシュをキーにする。
+    新着メールがない送信者は描画もPDFの作成も行わずに前回の結果を返す
+    （作成日時のフッターは前回作成時のまま）。
+    """
+
+    VERSION = 1  # レイアウトや描画内容を変更した場合は上げて古いキャッシュを無効にする
+
+    def __init__(self, cache_dir='.gmail_analyzer_cache/reports', max_bytes=500 * 1024 * 1024):
+        super().__init__(cache_dir, max_bytes)
+
+    def chart_key(self, name, aggregates, options):
+        """グラフ1つ分のキー（そのグラフが使う集計値のみ）"""
+        sampling = aggregates['sampling'] if name in ('hourly', 'weekday') else None
+        return self.make_key('chart', self.VERSION, name, aggregates[name], sampling, options)
+
+    def report_key(self, sender_email, aggregates, summary, insights, options):
+        """レポートのPDFのキー"""
+        return self.make_key('report', self.VERSION, sender_email, aggregates, summary, insights, options)
+
+
+class InsightCache(_DiskCache):
+    """Claudeが生成した考察を保存し、同じ依頼（モデル・プロンプト・データ要約）ではAPIを呼ばない
+
+    キーはAPIに送る内容全体のハッシュ。作成から ttl 秒を過ぎた考察は使わずに削除する
+    （None の場合は期限なし）。
+    """
+
+    def __init__(self, cache_dir='.gmail_analyzer_cache/insights', ttl=7 * 24 * 3600, max_bytes=50 * 1024 * 1024):
+        super().__init__(cache_dir, max_bytes)
+        self.ttl = ttl
+
+    def request_key(self, request):
+        """messages.create に渡す引数からキーを作る"""
+        return self.make_key('insights', request)
+
+    def get(self, key):
+        """保存済みの考察のリストを返す（ない場合や期限切れの場合はNone）"""
+        data = self.get_bytes(key, '.json')
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data)
+        except ValueError:
+            return None
+        if self.ttl is not None and time.time() - entry['created'] > self.ttl:
+            self.hits -= 1
+            self.misses += 1
+            try:
+                self._path(key, '.json').unlink()
+            except OSError:
+                pass
+            return None
+        return entry['insights']
+
+    def put(self, key, insights):
+        """考察のリストを保存する"""
+        data = json.dumps({'created': time.time(), 'insights': insights}, ensure_ascii=False)
+        return self.put_bytes(key, data.encode('utf-8'), '.json')
+
 
 class GmailAnalyzer:
-    def __init__(self):
+    def __init__(self, text_mode='snippet', quota=None, render_workers=0, chart_templates=False,
+                 chart_format='png', font_dir=None, cache_dir=None, insight_timeout=30, claude_base_url=None,
+                 use_claude=True):
         self.creds = None
-        self.service = None
-        # 一時的なプロットディレクトリの作成
-        Path('temp_plots').mkdir(exist_ok=True)
+        self._service = None
+        self.service_factory = None
+        self.credential_manager = None
+        # テキスト分析モード（'snippet': 件名＋スニペットのみ, 'body': 本文も取得）
+        self.text_mode = text_mode
+        # セッション全体のクォータ消費量を記録
+        self.quota = quota or QuotaAccountant()
+        # グラフ描画のプロセス数（0の場合は同じプロセスで順番に描画）
+        self.render_workers = render_workers
+        # Trueの場合はグラフの骨組みを使い回してデータだけ差し替える（大量の送信者を処理する場合向け）
+        self.chart_templates = chart_templates
+        # PDFに埋め込むグラフの形式（'svg' はベクター画像でファイルサイズが小さい）
+        if chart_format not in CHART_FORMATS:
+            raise ValueError(f"未対応のグラフ形式です: {chart_format}")
+        self.chart_format = chart_format
+        # 日本語フォントの検索先（Noneの場合は環境変数 GMAIL_ANALYZER_FONT_DIR と標準の場所）
+        self.font_resolver = get_font_resolver(font_dir)
+        # レポートとグラフのキャッシュ（Noneの場合は毎回描画する）
+        self.report_cache = ReportCache(Path(cache_dir) / 'reports') if cache_dir else None
+        # Claudeの考察のキャッシュ（同じデータ要約ではAPIを呼ばない）
+        self.insight_cache = InsightCache(Path(cache_dir) / 'insights') if cache_dir else None
+        # レポート作成時に考察を待つ秒数（グラフ描画と並行、Noneの場合は届くまで待つ）
+        self.insight_timeout = insight_timeout
+        # Falseの場合はClaude APIを使わず、集計値に基づく考察をレポートに載せる
+        self.use_claude = use_claude
+        # Claude APIの接続先（ローカルのスタブサーバーやプロキシを使う場合）と再試行の設定
+        self.claude_base_url = claude_base_url
+        self.claude_max_retries = 4
+        self.claude_backoff = 1.0
+        # Claudeに送る集計データのトークン数の上限（概算）
+        self.claude_input_budget = 300
+        self._claude_client = None
+        self._claude_client_key = None
+        self._claude_lock = threading.Lock()
+        self._claude_retry_at = 0.0
     
-    def authenticate(self, credentials_path='credentials.json'):
-        """認証を行うためのパブリックメソッド（デフォルトパス対応）"""
+    @property
+    def service(self):
+        """現在のスレッド用のGmail APIサービスオブジェクト"""
+        if self._service is None and self.service_factory is not None:
+            return self.service_factory.get_service()
+        return self._service
+
+    @service.setter
+    def service(self, service):
+        # 明示的に設定されたサービスは全スレッドで共有する
+        self._service = service
+
+    def warm_up(self):
+        """重いライブラリの読み込み・フォントの検索・グラフ描画の初期化を先に済ませる
+
+        常駐するワーカーが起動時に一度呼び出しておくと、最初のレポートから描画と
+        PDF作成の処理時間だけで済む。失敗しても各処理の実行時に改めて読み込まれる。
+        """
+        started = time.time()
+        try:
+            pd._load()
+            np._load()
+            sns._load()
+            import fpdf  # noqa: F401
+            font_path = self.font_resolver.find_font_path()
+            # 空の集計値で一度描画してフォントキャッシュとグラフの骨組みを作る
+            empty = {'hourly': [0] * 24, 'weekday': [0] * 7, 'monthly': [0] * 12,
+                     'heatmap': [[0] * 24 for _ in range(7)], 'sampling': None}
+            render_charts(empty, use_templates=self.chart_templates, image_format=self.chart_format,
+                          font_path=font_path)
+            if self.service_factory is not None:
+                GmailServiceFactory.get_discovery_document()
+        except Exception as e:
+            print(f"初期化エラー: {e}")
+        return time.time() - started
+
+    def authenticate(self, credentials_path='credentials.json', token_path='token.json', interactive=None):
+        """認証を行うためのパブリックメソッド（デフォルトパス対応）
+
+        interactive=False の場合はブラウザでの認証を行わず、有効なトークンがなければ
+        すぐに失敗する（バッチ処理・ワーカー向け）。None の場合は端末から実行されて
+        いるかどうかで自動判定する。
+        """
         # 認証情報パスを保存
         self.credentials_path = credentials_path
+        self.token_path = token_path
+        self.interactive = interactive
         
-        # 内部認証メソッドを呼び出し
-        self.service = self._authenticate()
+        # 内部認証メソッドを呼び出し（サービスはスレッドごとにファクトリから取得）
+        service = self._authenticate()
         
-        if self.service:
+        if service:
             print("認証に成功しました。Gmail APIに接続しています。")
             return True
         else:
@@ -119,47 +1649,22 @@ class GmailAnalyzer:
     def _authenticate(self):
         """GoogleのOAuth認証を行い、GmailAPIのサービスオブジェクトを返す（エラー処理強化版）"""
         try:
-            creds = None
-            # トークンファイルが存在する場合は読み込む
-            if os.path.exists('token.json'):
-                try:
-                    creds = Credentials.from_authorized_user_info(
-                        json.load(open('token.json', 'r')), 
-                        SCOPES
-                    )
-                except Exception as e:
-                    print(f"トークンファイル読み込みエラー: {e}")
-                    # トークンファイルに問題がある場合は削除
-                    os.remove('token.json')
-                    creds = None
-            
-            # 有効な認証情報がない場合はユーザーにログインを促す
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    try:
-                        creds.refresh(Request())
-                    except google.auth.exceptions.RefreshError as e:
-                        print(f"トークンリフレッシュエラー: {e}")
-                        # トークンの更新に失敗した場合はファイルを削除して再認証
-                        if os.path.exists('token.json'):
-                            os.remove('token.json')
-                        # 新しい認証フローを開始
-                        flow = InstalledAppFlow.from_client_secrets_file(
-                            self.credentials_path, SCOPES)
-                        creds = flow.run_local_server(port=0)
-                else:
-                    # 通常の認証フロー
-                    flow = InstalledAppFlow.from_client_secrets_file(
-                        self.credentials_path, SCOPES)
-                    creds = flow.run_local_server(port=0)
-                
-                # 認証情報を保存
-                with open('token.json', 'w') as token:
-                    token.write(creds.to_json())
-            
-            # Gmail APIのサービスを構築
-            service = build('gmail', 'v1', credentials=creds)
-            return service
+            # トークンの読み込み・更新はファイルロック下で行う
+            self.credential_manager = CredentialManager(
+                token_path=getattr(self, 'token_path', 'token.json'),
+                credentials_path=self.credentials_path,
+                interactive=getattr(self, 'interactive', None))
+            creds = self.credential_manager.get_credentials()
+            
+            # Gmail APIのサービスを構築（ディスカバリドキュメントとHTTP接続を再利用）
+            self.creds = creds
+            self.service_factory = GmailServiceFactory(creds)
+            return self.service_factory.get_service()
+        
+        except AuthenticationError as e:
+            # 非対話モードでは再認証せずにすぐ失敗する
+            print(f"認証エラー: {e}")
+            return None
         
         except Exception as e:
             print(f"認証エラー: {e}")
@@ -167,91 +1672,557 @@ class GmailAnalyzer:
             traceback.print_exc()
             return None
 
-    def analyze_emails_from_sender(self, sender_email):
-        """指定した送信者からのメールを分析する（直近100件）"""
-        # 検索クエリを設定
-        query = f'from:{sender_email}'
+    def _execute(self, request, call_type, count=1):
+        """クォータを計上してからAPIリクエストを実行する"""
+        self.quota.charge(call_type, count)
+        # 有効期限が近ければ先回りしてトークンを更新する
+        if self.credential_manager is not None:
+            self.credential_manager.get_credentials()
+        try:
+            return request.execute()
+        except google_auth_exceptions.RefreshError as e:
+            raise AuthenticationError(f"トークンの更新に失敗しました: {e}") from e
+
+    def plan_fetch(self, senders, mode='snippet', sample_size=None, max_results=500, latency=0.15):
+        """送信者リストとモードから必要なクォータ単位と所要時間を見積もる
+
+        mode は 'snippet' / 'body'（最大max_results件を取得）または
+        'sample'（sample_size件を抽出）。各送信者の件数は resultSizeEstimate で見積もり、
+        日次の上限を超えないように送信者を日ごとに割り当てたスケジュールを返す。
+        """
+        per_get = self.quota.cost('get')
+        per_list = self.quota.cost('list')
+        sender_plans = []
         
-        # メールの検索（100件に制限）
-        max_emails = 500
-        results = self.service.users().messages().list(userId='me', q=query, maxResults=max_emails).execute()
-        messages = []
+        for sender in senders:
+            # 件数の見積もり（この呼び出し自体もクォータを消費する）
+            try:
+                result = self._execute(self.service.users().messages().list(
+                    userId='me', q=f'from:{sender}', maxResults=1, fields='resultSizeEstimate'), 'list')
+                estimate = result.get('resultSizeEstimate', 0)
+            except Exception as e:
+                print(f"件数見積もりエラー（{sender}）: {e}")
+                estimate = max_results
+            
+            # 実行時に analyze_emails_from_sender に渡す取得条件（見積もりと同じ条件で取得する）
+            fetch_kwargs = {'max_results': max_results, 'text_mode': 'body' if mode == 'body' else 'snippet'}
+            if mode == 'sample':
+                fetch_kwargs['sample_size'] = sample_size or max_results
+                messages = min(estimate, fetch_kwargs['sample_size'])
+                # 見積もり1回＋ID一覧の全ページ＋抽出分の取得
+                list_calls = 1 + max(1, math.ceil(estimate / 500))
+            else:
+                messages = min(estimate, max_results)
+                list_calls = 1
+            
+            units = list_calls * per_list + messages * per_get
+            seconds = units / self.quota.per_second_limit + (list_calls + messages) * latency
+            sender_plans.append({
+                'sender': sender,
+                'estimate': estimate,
+                'messages': messages,
+                'units': units,
+                'seconds': seconds,
+                'fetch_kwargs': fetch_kwargs,
+                'over_daily_limit': units > self.quota.per_day_limit,
+            })
+        
+        # 日次の上限内に収まるように送信者を日ごとに割り当てる
+        # （本日の残りに収まらない送信者は翌日に回すため、days[0] が空になることもある）
+        days = [[]]
+        unschedulable = []
+        budget = self.quota.remaining_today()
+        for sender_plan in sender_plans:
+            if sender_plan['over_daily_limit']:
+                # 1日の上限を1人で超える送信者はどの日にも割り当てられない
+                unschedulable.append(sender_plan['sender'])
+                continue
+            if sender_plan['units'] > budget:
+                days.append([])
+                budget = self.quota.per_day_limit
+            days[-1].append(sender_plan['sender'])
+            budget -= sender_plan['units']
+        
+        plan = {
+            'mode': mode,
+            'senders': sender_plans,
+            'total_units': sum(p['units'] for p in sender_plans),
+            'total_seconds': sum(p['seconds'] for p in sender_plans),
+            'days': days,
+            'unschedulable': unschedulable,
+        }
         
-        if 'messages' in results:
-            messages.extend(results['messages'])
+        print(f"取得計画: {len(senders)}送信者 / 約{plan['total_units']}単位 / 約{plan['total_seconds'] / 60:.1f}分")
+        if len(days) > 1:
+            print(f"日次クォータの上限により{len(days)}日に分割して実行します")
+        if unschedulable:
+            print(f"警告: 1日のクォータ上限（{self.quota.per_day_limit}単位）を超えるため実行できない送信者: "
+                  f"{', '.join(unschedulable)}（max_results を減らすか mode='sample' を使ってください）")
+        return plan
+
+    def run_fetch_plan(self, plan, **kwargs):
+        """取得計画のうち本日のクォータ内に収まる送信者を分析し、結果を送信者ごとに返す
+
+        取得条件（max_results・text_mode・sample_size）は計画作成時のものを使う。
+        kwargs はそれに追加・上書きする引数（checkpoint_dir など）。
+        """
+        results = {}
+        sender_plans = {p['sender']: p for p in plan['senders']}
+        for sender in plan['days'][0]:
+            sender_plan = sender_plans[sender]
+            if sender_plan['units'] > self.quota.remaining_today():
+                print(f"本日のクォータが不足しているため延期します: {sender}")
+                continue
+            fetch_kwargs = dict(sender_plan.get('fetch_kwargs', {}))
+            fetch_kwargs.update(kwargs)
+            results[sender] = self.analyze_emails_from_sender(sender, **fetch_kwargs)
         
-        # 100件で切り捨て
-        messages = messages[:max_emails]
+        deferred = [sender for day in plan['days'][1:] for sender in day]
+        if deferred:
+            print(f"翌日以降に延期された送信者: {len(deferred)}件")
+        if plan.get('unschedulable'):
+            print(f"1日のクォータ上限を超えるため実行しなかった送信者: {', '.join(plan['unschedulable'])}")
+        self.quota.print_summary()
+        return results
+
+    def analyze_emails_from_sender(self, sender_email, max_results=500, text_mode=None, sample_size=None,
+                                   sampling='uniform', sampling_seed=None, checkpoint_dir=None,
+                                   checkpoint_interval=500, progress=None, partial_interval=100,
+                                   start_date=None, end_date=None):
+        """指定した送信者からのメールを分析する（デフォルトは直近500件）
+
+        text_mode='snippet'（デフォルト）の場合はメタデータ形式で取得し、
+        本文はダウンロードせずに件名とスニペットのみをテキスト分析に使用する。
+        text_mode='body'の場合は本文も取得して'body'列に格納する。
+
+        sample_size を指定するとサンプリングモードになり、全メールの中から
+        sample_size件程度を抽出してそのメタデータのみを取得する。
+        sampling は 'uniform'（一様抽出）または 'stratified'（時系列層別抽出）。
+        抽出情報は df.attrs['sampling'] に格納され、グラフでは推定値と信頼区間が表示される。
+
+        checkpoint_dir を指定すると、取得済みのID一覧・ページトークン・取得結果を
+        checkpoint_interval件ごとにディスクへ保存し、同じディレクトリを指定して
+        再実行（または resume_analysis）すると完了済みの処理をスキップして再開する。
+
+        start_date / end_date（datetime、date、または 'YYYY-MM-DD'）で受信日の範囲を絞り込む（両端を含む）。
+
+        progress にコールバックを渡すと進捗イベント（辞書）を通知する
+        （'listed', 'fetch_started', 'fetched', 'error', 'aggregate', 'done'。詳細は _ProgressReporter）。
+        partial_interval件ごとの 'aggregate' には途中までの集計値が入る。
+        コールバックが False を返すとその時点で取得を止め、取得済みの分だけのDataFrameを返す
+        （df.attrs['partial'] に取得件数を記録。チェックポイントがあれば続きから再開できる）。
+        """
+        reporter = _ProgressReporter(self, progress, sender_email, partial_interval)
         
-        # メールデータを格納するリスト
+        # 検索クエリを設定
+        query = self._build_query(sender_email, start_date, end_date)
+        options = {
+            'max_results': max_results,
+            'text_mode': text_mode or self.text_mode,
+            'sample_size': sample_size,
+            'sampling': sampling,
+            'sampling_seed': sampling_seed,
+            'start_date': _format_query_date(start_date),
+            'end_date': _format_query_date(end_date),
+        }
+        
+        # チェックポイントの読み込み（既存の場合は保存された条件で再開）
+        checkpoint = FetchCheckpoint(checkpoint_dir) if checkpoint_dir else None
+        state = checkpoint.load_state() if checkpoint and checkpoint.exists() else None
+        if state:
+            if state['sender_email'] != sender_email:
+                raise ValueError(f"チェックポイントの送信者が一致しません: {state['sender_email']}")
+            options = state['options']
+            query = state['query']
+            print(f"チェックポイントから再開します: {checkpoint_dir}")
+        else:
+            state = {
+                'sender_email': sender_email,
+                'query': query,
+                'options': options,
+                'next_page_token': None,
+                'id_count': 0,
+                'listing_done': False,
+                'sampling_info': None,
+            }
+            if checkpoint:
+                # 以前の取得の途中経過が残っていれば使わない
+                checkpoint.clear_sampling_state()
+        text_mode = options['text_mode']
+        
+        message_ids = checkpoint.load_message_ids(state['id_count']) if checkpoint else []
         email_data = []
+        cancelled = False
+        try:
+            # 1. 対象メッセージIDの一覧取得
+            if not state['listing_done']:
+                if options['sample_size']:
+                    # サンプリングモード: IDのみを一覧取得して抽出（途中で中断しても再開できるよう条件を先に保存）
+                    if checkpoint:
+                        checkpoint.save_state(state)
+                    message_ids, state['sampling_info'] = self._list_sampled_messages(
+                        query, options['sample_size'], method=options['sampling'], seed=options['sampling_seed'],
+                        reporter=reporter, checkpoint=checkpoint)
+                    if checkpoint:
+                        checkpoint.append_message_ids(message_ids)
+                    state['id_count'] = len(message_ids)
+                else:
+                    self._list_message_ids(query, options['max_results'], state, message_ids, checkpoint,
+                                           reporter=reporter)
+                state['listing_done'] = True
+                if checkpoint:
+                    checkpoint.save_state(state)
+                    checkpoint.clear_sampling_state()
+            
+            sampling_info = state['sampling_info']
+            if sampling_info:
+                print(f"検索結果: 約{sampling_info['population']}件中{len(message_ids)}件をサンプルとして分析します")
+            else:
+                print(f'検索結果: {len(message_ids)}件のメールを分析します')
+            
+            # 2. メッセージの取得（取得済みのものはスキップ）
+            email_data = checkpoint.load_records() if checkpoint else []
+            # 以前のバージョンで保存された取得エラーの代わりのレコードは除き、取得し直す
+            email_data = [record for record in email_data if not self._is_error_record(record)]
+            processed_ids = {record['message_id'] for record in email_data}
+            pending_ids = [msg_id for msg_id in message_ids if msg_id not in processed_ids]
+            if processed_ids:
+                print(f"取得済み: {len(processed_ids)}件 / 残り: {len(pending_ids)}件")
+            
+            reporter.fetch_started(len(message_ids), email_data)
+            self._fetch_message_records(pending_ids, sender_email, text_mode, email_data,
+                                        checkpoint, checkpoint_interval, reporter=reporter)
+        except AnalysisCancelled as e:
+            print(f"{e}（取得済み: {len(email_data)}件）")
+            cancelled = True
         
-        print(f'検索結果: {len(messages)}件のメールを分析します')
+        # DataFrameに変換
+        df = pd.DataFrame(email_data)
         
-        for i, msg in enumerate(messages):
+        # ソート
+        if not df.empty:
+            df = df.sort_values('date', ascending=False)
+        
+        if state['sampling_info']:
+            df.attrs['sampling'] = state['sampling_info']
+        if cancelled:
+            df.attrs['partial'] = {'fetched': len(email_data), 'total': len(message_ids)}
+        
+        # 完了の通知（キャンセルはできない）
+        if progress is not None:
             try:
-                # メールの詳細情報を取得
-                message = self.service.users().messages().get(userId='me', id=msg['id']).execute()
-                
-                # ヘッダーからメタデータを抽出
-                headers = {}
-                if 'payload' in message and 'headers' in message['payload']:
-                    headers = {h['name']: h['value'] for h in message['payload']['headers']}
-                
-                # 日時情報の抽出（タイムゾーン処理の修正）
-                date_str = headers.get('Date', '')
-                date_obj = None
-                
+                reporter.emit_partial()
+            except AnalysisCancelled:
+                pass
+            progress(dict(type='done', sender=sender_email, fetched=len(email_data), total=len(message_ids),
+                          errors=reporter.errors, cancelled=cancelled,
+                          elapsed=round(time.monotonic() - reporter.started, 2), df=df))
+        
+        return df
+
+    def fetch_emails_from_sender(self, sender_email, max_results=500, start_date=None, end_date=None, **kwargs):
+        """指定した送信者のメールを取得する（analyze_emails_from_sender の別名）"""
+        return self.analyze_emails_from_sender(sender_email, max_results=max_results, start_date=start_date,
+                                               end_date=end_date, **kwargs)
+
+    def _build_query(self, sender_email, start_date=None, end_date=None):
+        """Gmailの検索クエリを作る（before: は指定日を含まないため終了日の翌日を指定）"""
+        query = f'from:{sender_email}'
+        if start_date is not None:
+            query += f" after:{_parse_query_date(start_date).strftime('%Y/%m/%d')}"
+        if end_date is not None:
+            next_day = _parse_query_date(end_date) + timedelta(days=1)
+            query += f" before:{next_day.strftime('%Y/%m/%d')}"
+        return query
+
+    def iter_analysis(self, sender_email, **kwargs):
+        """analyze_emails_from_sender を別スレッドで実行し、進捗イベントを順に返すジェネレーター
+
+        最後のイベントは {'type': 'done', 'df': DataFrame, ...}。途中でループを抜ける
+        （ジェネレーターを閉じる）と分析をキャンセルする。分析中の例外はここで送出する。
+
+        使用例:
+            for event in analyzer.iter_analysis(sender, partial_interval=50):
+                if event['type'] == 'aggregate' and event['drift'] is not None and event['drift'] < 0.01:
+                    break  # 分布が落ち着いたので打ち切る
+        """
+        events = queue.Queue()
+        stop = threading.Event()
+        
+        def callback(event):
+            events.put(event)
+            return not stop.is_set()
+        
+        def run():
+            try:
+                self.analyze_emails_from_sender(sender_email, progress=callback, **kwargs)
+            except BaseException as e:
+                events.put({'type': 'failed', 'sender': sender_email, 'exception': e})
+        
+        thread = threading.Thread(target=run, name=f'analysis-{sender_email}', daemon=True)
+        thread.start()
+        try:
+            while True:
+                event = events.get()
+                if event['type'] == 'failed':
+                    raise event['exception']
+                yield event
+                if event['type'] == 'done':
+                    break
+        finally:
+            # 取得中の場合は次のイベントの通知時に止まる
+            stop.set()
+
+    def resume_analysis(self, checkpoint_dir, progress=None):
+        """チェックポイントから中断した分析を再開する"""
+        checkpoint = FetchCheckpoint(checkpoint_dir)
+        if not checkpoint.exists():
+            raise FileNotFoundError(f"チェックポイントが見つかりません: {checkpoint_dir}")
+        state = checkpoint.load_state()
+        return self.analyze_emails_from_sender(state['sender_email'], checkpoint_dir=checkpoint_dir,
+                                               progress=progress, **state['options'])
+
+    def _list_message_ids(self, query, max_results, state, message_ids, checkpoint=None, reporter=None):
+        """メッセージIDをページごとに一覧取得する（ページごとにチェックポイントを保存）"""
+        while len(message_ids) < max_results:
+            results = self._execute(self.service.users().messages().list(
+                userId='me', q=query, maxResults=min(500, max_results - len(message_ids)),
+                pageToken=state['next_page_token']), 'list')
+            page_ids = [msg['id'] for msg in results.get('messages', [])]
+            message_ids.extend(page_ids)
+            state['next_page_token'] = results.get('nextPageToken')
+            state['id_count'] = len(message_ids)
+            
+            if checkpoint:
+                checkpoint.append_message_ids(page_ids)
+                checkpoint.save_state(state)
+            if reporter:
+                reporter.page_listed(len(page_ids))
+            
+            if not state['next_page_token']:
+                break
+        return message_ids
+
+    def _fetch_message_records(self, message_ids, sender_email, text_mode, email_data,
+                               checkpoint=None, checkpoint_interval=500, reporter=None):
+        """メッセージを取得してレコードを追加する（一定件数ごとにチェックポイントへ保存）"""
+        # 取得形式（スニペットモードでは本文をダウンロードしない）
+        get_params = self._message_get_params(text_mode)
+        pending_records = []
+        
+        try:
+            for i, msg_id in enumerate(message_ids):
+                message = {}
+                error = None
                 try:
-                    if date_str:
-                        # 明示的にタイムゾーンを指定して解析
-                        date_obj = pd.to_datetime(date_str, errors='coerce', utc=True)
-                        # 必要に応じてJSTに変換（Asia/Tokyo）
-                        date_obj = date_obj.tz_convert('Asia/Tokyo')
-                        # タイムゾーン情報を削除（ローカル時刻として扱う）
-                        date_obj = date_obj.tz_localize(None)
+                    # メールの詳細情報を取得
+                    message = self._execute(self.service.users().messages().get(userId='me', id=msg_id, **get_params), 'get')
+                    record = self._message_to_record(message, text_mode)
                     
-                    if pd.isna(date_obj):  # NaT（無効な日付）の場合
-                        date_obj = pd.Timestamp.now()
-                except:
-                    date_obj = pd.Timestamp.now()
+                except (QuotaExceededError, AuthenticationError):
+                    # クォータ超過・認証切れは再開できるように中断する
+                    raise
+                except Exception as e:
+                    print(f"メール処理エラー: {e}")
+                    error = e
+                    # エラー時も最低限のデータを追加
+                    record = self._error_record(msg_id, sender_email, message)
                 
-                # メールの件名を取得
-                subject = headers.get('Subject', '(件名なし)')
+                email_data.append(record)
+                if error is None:
+                    # 取得に失敗したメッセージは保存せず、再開時にもう一度取得する
+                    pending_records.append(record)
                 
-                email_data.append({
-                    'message_id': msg['id'],
-                    'thread_id': message.get('threadId', ''),
-                    'date': date_obj,
-                    'subject': subject,
-                    'from': headers.get('From', ''),
-                    'to': headers.get('To', ''),
-                    'weekday': date_obj.strftime('%A'),
-                    'hour': date_obj.hour
-                })
+                # 一定件数ごとにチェックポイントへ保存
+                if checkpoint and len(pending_records) >= checkpoint_interval:
+                    checkpoint.append_records(pending_records)
+                    pending_records = []
+                    print(f"チェックポイントを保存しました（{i + 1}/{len(message_ids)}件）")
                 
-            except Exception as e:
-                print(f"メール処理エラー: {e}")
-                # エラー時も最低限のデータを追加
-                email_data.append({
-                    'message_id': msg['id'],
-                    'thread_id': message.get('threadId', ''),
-                    'date': pd.Timestamp.now(),
-                    'subject': '(取得エラー)',
-                    'from': sender_email,
-                    'to': '',
-                    'weekday': 'Unknown',
-                    'hour': 0
+                if reporter:
+                    reporter.message_fetched(record, msg_id, error)
+        finally:
+            # 中断時も取得済みの分は保存する
+            if checkpoint and pending_records:
+                checkpoint.append_records(pending_records)
+        
+        return email_data
+
+    def _error_record(self, msg_id, sender_email, message=None):
+        """取得に失敗したメッセージの代わりに追加する最低限のレコード"""
+        return {
+            'message_id': msg_id,
+            'thread_id': (message or {}).get('threadId', ''),
+            'date': pd.Timestamp.now(),
+            'subject': '(取得エラー)',
+            'from': sender_email,
+            'to': '',
+            'snippet': '',
+            'weekday': 'Unknown',
+            'hour': 0
+        }
+
+    @staticmethod
+    def _is_error_record(record):
+        """_error_record で作った代わりのレコードかどうか"""
+        return record.get('subject') == '(取得エラー)' and record.get('weekday') == 'Unknown'
+
+    @staticmethod
+    def _error_mask(df):
+        """DataFrameの各行が _error_record で作った代わりのレコードかどうか"""
+        if 'subject' not in df.columns or 'weekday' not in df.columns:
+            return pd.Series(False, index=df.index)
+        return df['subject'].eq('(取得エラー)') & df['weekday'].eq('Unknown')
+
+    def _list_sampled_messages(self, query, sample_size, method='uniform', seed=None, reporter=None,
+                               checkpoint=None):
+        """resultSizeEstimateを元にサンプルを計画し、抽出したメッセージIDと抽出情報を返す
+
+        checkpoint を指定すると、ページごとにページトークン・抽出途中のサンプル・乱数の状態を
+        保存し、中断後は保存したページの続きから同じ抽出を再開する。
+        """
+        rng = random.Random(seed)
+        messages_api = self.service.users().messages()
+        saved = checkpoint.load_sampling_state() if checkpoint else None
+        
+        if saved:
+            estimate = saved['estimate']
+            sample = saved['sample']
+            population = saved['population']
+            carry = saved['carry']
+            page_token = saved['page_token']
+            version, internal, gauss_next = saved['rng_state']
+            rng.setstate((version, tuple(internal), gauss_next))
+            print(f"サンプリングの一覧取得を再開します（{population}件まで確認済み）")
+        else:
+            # 1件だけ要求して総件数の見積もりを取得
+            first = self._execute(messages_api.list(userId='me', q=query, maxResults=1,
+                                                    fields='resultSizeEstimate'), 'list')
+            estimate = first.get('resultSizeEstimate', 0)
+            sample = []
+            population = 0
+            carry = 0.0
+            page_token = None
+        rate = min(1.0, sample_size / max(estimate, 1))
+        print(f"推定総件数: {estimate}件 / サンプル率: {rate:.2%} ({method})")
+        
+        while True:
+            # IDのみを取得（1ページ最大500件）
+            results = self._execute(messages_api.list(userId='me', q=query, maxResults=500, pageToken=page_token,
+                                                      fields='messages/id,nextPageToken'), 'list')
+            page = results.get('messages', [])
+            
+            if method == 'stratified':
+                # 一覧は新しい順に返るため、各ページを時系列の層として系統抽出する
+                carry += len(page) * rate
+                k = min(len(page), int(carry))
+                carry -= k
+                if k:
+                    step = len(page) / k
+                    offset = rng.random() * step
+                    sample.extend(page[int(offset + j * step)]['id'] for j in range(k))
+                population += len(page)
+            else:
+                # リザーバーサンプリングで一様抽出
+                for msg in page:
+                    population += 1
+                    if len(sample) < sample_size:
+                        sample.append(msg['id'])
+                    else:
+                        j = rng.randrange(population)
+                        if j < sample_size:
+                            sample[j] = msg['id']
+            
+            if reporter:
+                reporter.page_listed(len(page))
+            
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+            if checkpoint:
+                # 次のページから再開できるように、このページまでの抽出結果を保存する
+                checkpoint.save_sampling_state({
+                    'estimate': estimate, 'sample': sample, 'population': population, 'carry': carry,
+                    'page_token': page_token, 'rng_state': rng.getstate(),
                 })
         
-        # DataFrameに変換
-        df = pd.DataFrame(email_data)
+        sampling_info = {
+            'method': method,
+            'estimate': estimate,
+            'population': population,
+            'sample_size': len(sample),
+        }
+        return sample, sampling_info
+
+    def _get_sampling_info(self, df):
+        """サンプリング取得されたデータの場合は抽出情報を返す（全件取得ならNone）
+
+        取得に失敗したメッセージは sample_size から除き、fetch_errors に件数を記録する
+        （推定値と信頼区間は取得できたメッセージだけを標本として計算する）。
+        """
+        sampling = df.attrs.get('sampling') if hasattr(df, 'attrs') else None
+        if not sampling or sampling['sample_size'] >= sampling['population']:
+            return None
+        errors = int(self._error_mask(df).sum())
+        if errors:
+            sampling = dict(sampling, sample_size=sampling['sample_size'] - errors, fetch_errors=errors)
+        return sampling
+
+    def _message_get_params(self, text_mode):
+        """messages.getに渡す取得形式のパラメータを返す"""
+        if text_mode == 'body':
+            return {'format': 'full'}
+        # スニペットはメタデータ形式のレスポンスにも含まれる
+        return {'format': 'metadata', 'metadataHeaders': METADATA_HEADERS}
+
+    def _message_to_record(self, message, text_mode='snippet'):
+        """Gmail APIのメッセージリソースを分析用のレコードに変換する"""
+        # ヘッダーからメタデータを抽出
+        headers = {}
+        if 'payload' in message and 'headers' in message['payload']:
+            headers = {h['name']: h['value'] for h in message['payload']['headers']}
+        
+        # 日時情報の抽出（タイムゾーン処理の修正）
+        date_str = headers.get('Date', '')
+        date_obj = None
         
-        # ソート
-        if not df.empty:
-            df = df.sort_values('date', ascending=False)
+        try:
+            if date_str:
+                # 明示的にタイムゾーンを指定して解析
+                date_obj = pd.to_datetime(date_str, errors='coerce', utc=True)
+                # 必要に応じてJSTに変換（Asia/Tokyo）
+                date_obj = date_obj.tz_convert('Asia/Tokyo')
+                # タイムゾーン情報を削除（ローカル時刻として扱う）
+                date_obj = date_obj.tz_localize(None)
+            
+            if pd.isna(date_obj):  # NaT（無効な日付）の場合
+                date_obj = pd.Timestamp.now()
+        except:
+            date_obj = pd.Timestamp.now()
         
-        return df
+        # メールの件名を取得
+        subject = headers.get('Subject', '(件名なし)')
+        
+        record = {
+            'message_id': message.get('id', ''),
+            'thread_id': message.get('threadId', ''),
+            'date': date_obj,
+            'subject': subject,
+            'from': headers.get('From', ''),
+            'to': headers.get('To', ''),
+            # スニペットはHTMLエスケープされているので元に戻す
+            'snippet': html.unescape(message.get('snippet', '')),
+            'weekday': date_obj.strftime('%A'),
+            'hour': date_obj.hour
+        }
+        
+        # 本文モードの場合のみ本文を格納
+        if text_mode == 'body':
+            body = extract_plain_text_body(message.get('payload', {}))
+            record['body'] = body
+            record['content_length'] = len(body)
+        
+        return record
 
     def generate_marketing_insights(self, df, sender_email):
         """マーケティング分析の洞察生成（プロフェッショナル版）"""
@@ -476,394 +2447,550 @@ class GmailAnalyzer:
         try:
             # メールアドレスを含むファイル名の生成
             if output_path is None:
-                # メールアドレスから不正なファイル名文字を削除
-                safe_email = re.sub(r'[\\/*?:"<>|]', "_", sender_email)
-                # 現在の日時を追加
-                current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-                output_path = f'gmail_analysis_{safe_email}_{current_time}.pdf'
+                output_path = self._default_report_path(sender_email)
             
             print(f"レポートファイル名: {output_path}")
             
-            # 一時プロットディレクトリの作成
-            os.makedirs('temp_plots', exist_ok=True)
+            aggregates, charts, claude_insights = self._build_report_content(df, sender_email)
+            return self._write_report(df, sender_email, output_path, aggregates, charts, claude_insights)
             
-            # 各種グラフの生成（サイズをさらに小さく調整）
-            hourly_plot = self._create_hourly_distribution_plot(df, figsize=(5, 3))
-            weekday_plot = self._create_weekday_distribution_plot(df, figsize=(5, 3))
-            monthly_plot = self._create_monthly_distribution_plot(df, figsize=(5, 3))
-            heatmap_plot = self._create_heatmap(df, figsize=(5, 3))
-            
-            # Claudeを使用して考察を生成
+        except Exception as e:
+            print(f"PDFレポート作成エラー: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+    def _default_report_path(self, sender_email):
+        """メールアドレスと現在の日時からレポートのファイル名を作る"""
+        # メールアドレスから不正なファイル名文字を削除
+        safe_email = _safe_filename(sender_email)
+        current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return f'gmail_analysis_{safe_email}_{current_time}.pdf'
+
+    def _write_report(self, df, sender_email, output_path, aggregates, charts, insights):
+        """描画済みのグラフと考察から1ページのPDFを作成して保存する"""
+        # 集計値・基本情報・考察が前回と同じなら作成済みのPDFを使う
+        cache_key = None
+        if self.report_cache is not None:
+            cache_key = self.report_cache.report_key(
+                sender_email, aggregates, self._report_summary(df), insights,
+                self._report_render_options())
+            cached_path = self.report_cache.get_path(cache_key, '.pdf')
+            if cached_path is not None:
+                shutil.copyfile(cached_path, output_path)
+                print(f"前回から変更がないため作成済みのレポートを使用しました: {output_path}")
+                return output_path
+        
+        pdf, japanese_font_available = self._create_report_pdf()
+        self._add_report_page(pdf, df, sender_email, japanese_font_available,
+                              aggregates=aggregates, charts=charts, insights=insights)
+        
+        # PDFの保存
+        pdf.output(output_path)
+        print(f"PDFレポートを作成しました: {output_path}")
+        
+        if cache_key is not None:
             try:
-                print("Claude APIを使用して考察を生成中...")
-                claude_insights = self.generate_insights_with_claude(df, sender_email)
-                print(f"生成された考察の数: {len(claude_insights)}")
-                
-                # デバッグ: 考察の内容を表示
-                for i, insight in enumerate(claude_insights):
-                    print(f"考察 {i+1}: {insight[:50]}...")
-                
+                self.report_cache.put_file(cache_key, output_path, '.pdf')
             except Exception as e:
-                print(f"Claude考察生成エラー: {e}")
-                # エラー時はデフォルトの考察を使用
-                claude_insights = self._get_default_insights()
-                print("デフォルトの考察を使用します")
-            
-            # 考察がない場合はデフォルトを使用
-            if not claude_insights:
-                print("考察が空のため、デフォルトの考察を使用します")
-                claude_insights = self._get_default_insights()
-            
-            # FPDFのインポート（XPos, YPosも含む）
-            from fpdf import FPDF
-            try:
-                # FPDF v2.5.2以降の場合、XPosとYPosをインポート
-                from fpdf.enums import XPos, YPos
-                has_new_api = True
-            except ImportError:
-                # 古いバージョンの場合
-                has_new_api = False
-                print("警告: FPDFの古いバージョンを使用しています。非推奨警告が表示される場合があります。")
-            
-            # PDFの作成
-            pdf = FPDF(orientation='P', unit='mm', format='A4')
-            
-            # 日本語フォントの設定
+                print(f"レポートのキャッシュ保存エラー: {e}")
+        
+        return output_path
+
+    def generate_batch_pdf_report(self, senders, output_path=None, title=None, **fetch_kwargs):
+        """複数の送信者のレポートを目次付きの1つのPDFにまとめる
+
+        sendersには送信者のメールアドレス（その場で取得して分析）か
+        (メールアドレス, DataFrame) の組を並べる。ジェネレーターを渡せば
+        取得・描画・ページ追加を1人ずつ順に行うため、送信者数が多くてもデータを溜め込まない。
+        """
+        expected_count = len(senders) if hasattr(senders, '__len__') else None
+        try:
+            writer = BatchReportWriter(self, output_path, title=title, expected_count=expected_count)
+        except Exception as e:
+            print(f"PDFレポート作成エラー: {e}")
+            return None
+        
+        for item in senders:
+            if isinstance(item, str):
+                sender_email = item
+                try:
+                    df = self.analyze_emails_from_sender(sender_email, **fetch_kwargs)
+                except (QuotaExceededError, AuthenticationError):
+                    raise
+                except Exception as e:
+                    print(f"{sender_email}: メール取得エラー: {e}")
+                    df = None
+            else:
+                sender_email, df = item
+            writer.add_sender(df, sender_email)
+            df = None  # 次の送信者の取得前に手放す
+        
+        try:
+            return writer.close()
+        except Exception as e:
+            print(f"PDFレポート作成エラー: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+    def export_for_bigquery(self, senders, output_dir='bigquery_export', formats=('parquet', 'ndjson'),
+                            partition='day', chunk_size=10000, **fetch_kwargs):
+        """送信者ごとのメールと集計値をBigQueryに読み込めるParquet/NDJSONに出力する
+
+        senders は generate_batch_pdf_report と同じく、メールアドレスか (メールアドレス, DataFrame)
+        の組を並べる。1人ずつ取得して書き込むため、送信者数が多くてもデータを溜め込まない。
+        戻り値は manifest.json のパス（load_export_to_bigquery でBigQueryに読み込める）。
+        """
+        try:
+            writer = BigQueryExportWriter(self, output_dir, formats=formats, partition=partition,
+                                          chunk_size=chunk_size)
+        except Exception as e:
+            print(f"出力の準備エラー: {e}")
+            return None
+
+        for item in senders:
+            if isinstance(item, str):
+                sender_email = item
+                try:
+                    df = self.analyze_emails_from_sender(sender_email, **fetch_kwargs)
+                except (QuotaExceededError, AuthenticationError):
+                    writer.close()
+                    raise
+                except Exception as e:
+                    print(f"{sender_email}: メール取得エラー: {e}")
+                    df = None
+            else:
+                sender_email, df = item
+            writer.add_sender(df, sender_email)
+            df = None  # 次の送信者の取得前に手放す
+        return writer.close()
+
+    def _create_report_pdf(self):
+        """レポート用のPDFを作成して日本語フォントを登録する（(pdf, 日本語フォントの有無) を返す）"""
+        from fpdf import FPDF
+        try:
+            # FPDF v2.5.2以降かどうか（XPosとYPosの有無）を確認
+            from fpdf.enums import XPos, YPos  # noqa: F401
+        except ImportError:
+            # 古いバージョンの場合
+            print("警告: FPDFの古いバージョンを使用しています。非推奨警告が表示される場合があります。")
+        
+        # PDFの作成
+        pdf = FPDF(orientation='P', unit='mm', format='A4')
+        
+        # 日本語フォントの設定（検索結果と解析済みフォントはレポート間で共有）
+        japanese_font_available = False
+        try:
+            # 通常とボールドのみ追加（イタリックは使用しない）
+            japanese_font_available = self.font_resolver.add_to_pdf(pdf, 'unicode', styles=('', 'B'))
+            if japanese_font_available:
+                print(f"日本語フォントを使用: {self.font_resolver.find_font_path()}")
+            else:
+                print("警告: 日本語フォントが見つかりません。英語でレポートを生成します。")
+        except Exception as e:
+            print(f"フォント設定エラー: {e}")
             japanese_font_available = False
-            try:
-                # フォントファイルの存在確認
-                font_paths = [
-                    'fonts/ipaexg.ttf',  # 指定パス
-                    '/usr/share/fonts/truetype/ipafont/ipag.ttf',  # Linux
-                    '/Library/Fonts/Arial Unicode.ttf',  # macOS
-                    'C:\\Windows\\Fonts\\msgothic.ttc'  # Windows
-                ]
-                
-                font_file = None
-                for path in font_paths:
-                    if os.path.exists(path):
-                        font_file = path
-                        break
-                
-                if font_file:
-                    # 通常とボールドのみ追加（イタリックは使用しない）
-                    pdf.add_font('unicode', '', font_file)
-                    pdf.add_font('unicode', 'B', font_file)
-                    japanese_font_available = True
-                    print(f"日本語フォントを使用: {font_file}")
-                else:
-                    print("警告: 日本語フォントが見つかりません。英語でレポートを生成します。")
-            except Exception as e:
-                print(f"フォント設定エラー: {e}")
-                japanese_font_available = False
-            
-            # ページ設定
-            pdf.set_auto_page_break(auto=True, margin=5)  # マージンを小さく
-            pdf.add_page()
+        
+        # ページ設定
+        pdf.set_auto_page_break(auto=True, margin=5)  # マージンを小さく
+        return pdf, japanese_font_available
+
+    def _generate_report_insights(self, df, sender_email):
+        """レポートに載せる考察を生成（失敗した場合や空の場合はデフォルトの考察）"""
+        if not self.use_claude:
+            print("Claude APIを使用しない設定のため、集計値に基づく考察を使用します")
+            return self._generate_recommendations(df) or self._get_default_insights()
+        
+        # Claudeを使用して考察を生成
+        try:
+            print("Claude APIを使用して考察を生成中...")
+            claude_insights = self.generate_insights_with_claude(df, sender_email)
+            print(f"生成された考察の数: {len(claude_insights)}")
             
-            # ヘッダー部分（背景色付き）
-            pdf.set_fill_color(52, 152, 219)  # 青色の背景
-            pdf.rect(0, 0, 210, 12, 'F')  # ヘッダーの高さを小さく
+            # デバッグ: 考察の内容を表示
+            for i, insight in enumerate(claude_insights):
+                print(f"考察 {i+1}: {insight[:50]}...")
             
-            # タイトル（白色）
-            pdf.set_text_color(255, 255, 255)
+        except Exception as e:
+            print(f"Claude考察生成エラー: {e}")
+            # エラー時はデフォルトの考察を使用
+            claude_insights = self._get_default_insights()
+            print("デフォルトの考察を使用します")
+        
+        # 考察がない場合はデフォルトを使用
+        if not claude_insights:
+            print("考察が空のため、デフォルトの考察を使用します")
+            claude_insights = self._get_default_insights()
+        
+        return claude_insights
+
+    def _build_report_content(self, df, sender_email, insights=None):
+        """グラフの描画と考察の生成を並行して行い (集計値, グラフ, 考察) を返す
+
+        考察は別スレッドで生成を始め、その間にグラフを描画する。
+        開始から insight_timeout 秒を過ぎても考察が届かない場合はデフォルトの考察を使う
+        （遅れて届いた考察は、キャッシュがあれば保存されて次回以降に使われる）。
+        生成済みの考察（insights）を渡した場合はグラフの描画のみを行う。
+        """
+        started = time.monotonic()
+        future = None
+        if insights is None:
+            # 考察の生成で列が追加されるため、描画・レイアウトとは別のDataFrameを渡す
+            future = _get_insight_executor().submit(self._generate_report_insights, df.copy(deep=False), sender_email)
+        
+        # 集計値のみを描画処理に渡し、render_workers>0ならプロセスプールで並列描画
+        aggregates = self._compute_chart_aggregates(df)
+        charts = self._render_report_charts(aggregates, figsize=(5, 3))
+        if future is None:
+            return aggregates, charts, insights
+        
+        timeout = None
+        if self.insight_timeout is not None:
+            timeout = max(0, self.insight_timeout - (time.monotonic() - started))
+        try:
+            insights = future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            print(f"考察の生成が{self.insight_timeout}秒以内に終わらなかったため、デフォルトの考察を使用します")
+            insights = self._get_default_insights()
+        except Exception as e:
+            print(f"Claude考察生成エラー: {e}")
+            insights = self._get_default_insights()
+        return aggregates, charts, insights
+
+    def _add_report_page(self, pdf, df, sender_email, japanese_font_available, section=None, new_page=True,
+                         aggregates=None, charts=None, insights=None):
+        """1人の送信者分のレポートを1ページとしてPDFに追加する
+
+        sectionを指定すると目次（しおり）に載せる。new_page=False の場合は現在の空白ページに描画する。
+        描画済みのグラフ（charts）と考察（insights）を渡さない場合はここで作成する。
+        """
+        try:
+            from fpdf.enums import XPos, YPos
+            has_new_api = True
+        except ImportError:
+            has_new_api = False
+        
+        # 各種グラフの生成（サイズをさらに小さく調整）と考察の生成
+        if charts is None or insights is None:
+            aggregates, charts, insights = self._build_report_content(df, sender_email, insights)
+        hourly_plot = charts['hourly']
+        weekday_plot = charts['weekday']
+        monthly_plot = charts['monthly']
+        heatmap_plot = charts['heatmap']
+        
+        claude_insights = insights
+        
+        if new_page:
+            pdf.add_page()
+        if section:
+            pdf.start_section(section)
+        
+        # ヘッダー部分（背景色付き）
+        pdf.set_fill_color(52, 152, 219)  # 青色の背景
+        pdf.rect(0, 0, 210, 12, 'F')  # ヘッダーの高さを小さく
+        
+        # タイトル（白色）
+        pdf.set_text_color(255, 255, 255)
+        if japanese_font_available:
+            pdf.set_font('unicode', 'B', 12)  # フォントサイズを小さく
+            title = f'Gmail送信分析レポート: {sender_email}'
+        else:
+            pdf.set_font('helvetica', 'B', 12)  # フォントサイズを小さく
+            title = f'Gmail Analysis Report: {sender_email}'
+        
+        # 非推奨警告を回避するためのcell呼び出し
+        if has_new_api:
+            pdf.cell(0, 8, title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
+        else:
+            pdf.cell(0, 8, title, 0, 1, 'C')
+        
+        # 本文の色を戻す
+        pdf.set_text_color(0, 0, 0)
+        pdf.ln(2)  # 間隔を小さく
+        
+        # 基本情報
+        sampling = self._get_sampling_info(df)
+        if japanese_font_available:
+            pdf.set_font('unicode', 'B', 8)  # フォントサイズを小さく
+            basic_info = f'分析期間: {df["date"].min().strftime("%Y-%m-%d")} 〜 {df["date"].max().strftime("%Y-%m-%d")} | 総メール数: {len(df)}件'
+            if sampling:
+                basic_info = f'分析期間: {df["date"].min().strftime("%Y-%m-%d")} 〜 {df["date"].max().strftime("%Y-%m-%d")} | 総メール数: 約{sampling["population"]}件（{len(df)}件をサンプル分析）'
+        else:
+            pdf.set_font('helvetica', 'B', 8)  # フォントサイズを小さく
+            basic_info = f'Analysis Period: {df["date"].min().strftime("%Y-%m-%d")} to {df["date"].max().strftime("%Y-%m-%d")} | Total Emails: {len(df)}'
+            if sampling:
+                basic_info = f'Analysis Period: {df["date"].min().strftime("%Y-%m-%d")} to {df["date"].max().strftime("%Y-%m-%d")} | Total Emails: ~{sampling["population"]} ({len(df)} sampled)'
+        
+        # 非推奨警告を回避するためのcell呼び出し
+        if has_new_api:
+            pdf.cell(0, 4, basic_info, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
+        else:
+            pdf.cell(0, 4, basic_info, 0, 1, 'C')
+        
+        pdf.ln(2)  # 間隔を小さく
+        
+        # グラフの配置（2x2グリッド）- サイズを小さく
+        graph_width = 80
+        graph_height = 50
+        
+        # 1行目: 時間帯と曜日
+        # 時間帯分布グラフ
+        if hourly_plot:
+            pdf.set_xy(10, 25)
             if japanese_font_available:
-                pdf.set_font('unicode', 'B', 12)  # フォントサイズを小さく
-                title = f'Gmail送信分析レポート: {sender_email}'
+                pdf.set_font('unicode', 'B', 7)  # フォントサイズを小さく
+                hourly_title = '1. 時間帯別分布'
             else:
-                pdf.set_font('helvetica', 'B', 12)  # フォントサイズを小さく
-                title = f'Gmail Analysis Report: {sender_email}'
+                pdf.set_font('helvetica', 'B', 7)  # フォントサイズを小さく
+                hourly_title = '1. Hourly Distribution'
+            
+            pdf.set_fill_color(41, 128, 185)  # 青色の背景
             
             # 非推奨警告を回避するためのcell呼び出し
             if has_new_api:
-                pdf.cell(0, 8, title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
+                pdf.cell(graph_width, 4, hourly_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
             else:
-                pdf.cell(0, 8, title, 0, 1, 'C')
-            
-            # 本文の色を戻す
-            pdf.set_text_color(0, 0, 0)
-            pdf.ln(2)  # 間隔を小さく
+                pdf.cell(graph_width, 4, hourly_title, 0, 1, 'C', 1)
             
-            # 基本情報
+            self._place_chart(pdf, 'hourly', hourly_plot, aggregates, x=10, y=30, w=graph_width, h=graph_height)
+        
+        # 曜日別分布グラフ
+        if weekday_plot:
+            pdf.set_xy(110, 25)
             if japanese_font_available:
-                pdf.set_font('unicode', 'B', 8)  # フォントサイズを小さく
-                basic_info = f'分析期間: {df["date"].min().strftime("%Y-%m-%d")} 〜 {df["date"].max().strftime("%Y-%m-%d")} | 総メール数: {len(df)}件'
+                pdf.set_font('unicode', 'B', 7)  # フォントサイズを小さく
+                weekday_title = '2. 曜日別分布'
             else:
-                pdf.set_font('helvetica', 'B', 8)  # フォントサイズを小さく
-                basic_info = f'Analysis Period: {df["date"].min().strftime("%Y-%m-%d")} to {df["date"].max().strftime("%Y-%m-%d")} | Total Emails: {len(df)}'
+                pdf.set_font('helvetica', 'B', 7)  # フォントサイズを小さく
+                weekday_title = '2. Weekday Distribution'
+            
+            pdf.set_fill_color(46, 204, 113)  # 緑色の背景
             
             # 非推奨警告を回避するためのcell呼び出し
             if has_new_api:
-                pdf.cell(0, 4, basic_info, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
+                pdf.cell(graph_width, 4, weekday_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
             else:
-                pdf.cell(0, 4, basic_info, 0, 1, 'C')
-            
-            pdf.ln(2)  # 間隔を小さく
-            
-            # グラフの配置（2x2グリッド）- サイズを小さく
-            graph_width = 80
-            graph_height = 50
-            
-            # 1行目: 時間帯と曜日
-            # 時間帯分布グラフ
-            if hourly_plot:
-                pdf.set_xy(10, 25)
-                if japanese_font_available:
-                    pdf.set_font('unicode', 'B', 7)  # フォントサイズを小さく
-                    hourly_title = '1. 時間帯別分布'
-                else:
-                    pdf.set_font('helvetica', 'B', 7)  # フォントサイズを小さく
-                    hourly_title = '1. Hourly Distribution'
-                
-                pdf.set_fill_color(41, 128, 185)  # 青色の背景
-                
-                # 非推奨警告を回避するためのcell呼び出し
-                if has_new_api:
-                    pdf.cell(graph_width, 4, hourly_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
-                else:
-                    pdf.cell(graph_width, 4, hourly_title, 0, 1, 'C', 1)
-                
-                pdf.image(hourly_plot, x=10, y=30, w=graph_width, h=graph_height)
-            
-            # 曜日別分布グラフ
-            if weekday_plot:
-                pdf.set_xy(110, 25)
-                if japanese_font_available:
-                    pdf.set_font('unicode', 'B', 7)  # フォントサイズを小さく
-                    weekday_title = '2. 曜日別分布'
-                else:
-                    pdf.set_font('helvetica', 'B', 7)  # フォントサイズを小さく
-                    weekday_title = '2. Weekday Distribution'
-                
-                pdf.set_fill_color(46, 204, 113)  # 緑色の背景
-                
-                # 非推奨警告を回避するためのcell呼び出し
-                if has_new_api:
-                    pdf.cell(graph_width, 4, weekday_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
-                else:
-                    pdf.cell(graph_width, 4, weekday_title, 0, 1, 'C', 1)
-                
-                pdf.image(weekday_plot, x=110, y=30, w=graph_width, h=graph_height)
-            
-            # 2行目: 月別とヒートマップ
-            # 月別分布グラフ
-            if monthly_plot:
-                pdf.set_xy(10, 85)
-                if japanese_font_available:
-                    pdf.set_font('unicode', 'B', 7)  # フォントサイズを小さく
-                    monthly_title = '3. 月別分布'
-                else:
-                    pdf.set_font('helvetica', 'B', 7)  # フォントサイズを小さく
-                    monthly_title = '3. Monthly Distribution'
-                
-                pdf.set_fill_color(155, 89, 182)  # 紫色の背景
-                
-                # 非推奨警告を回避するためのcell呼び出し
-                if has_new_api:
-                    pdf.cell(graph_width, 4, monthly_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
-                else:
-                    pdf.cell(graph_width, 4, monthly_title, 0, 1, 'C', 1)
-                
-                pdf.image(monthly_plot, x=10, y=90, w=graph_width, h=graph_height)
-            
-            # ヒートマップ
-            if heatmap_plot:
-                pdf.set_xy(110, 85)
-                if japanese_font_available:
-                    pdf.set_font('unicode', 'B', 7)  # フォントサイズを小さく
-                    heatmap_title = '4. 時間帯×曜日ヒートマップ'
-                else:
-                    pdf.set_font('helvetica', 'B', 7)  # フォントサイズを小さく
-                    heatmap_title = '4. Hour x Weekday Heatmap'
-                
-                pdf.set_fill_color(211, 84, 0)  # オレンジ色の背景
-                
-                # 非推奨警告を回避するためのcell呼び出し
-                if has_new_api:
-                    pdf.cell(graph_width, 4, heatmap_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
-                else:
-                    pdf.cell(graph_width, 4, heatmap_title, 0, 1, 'C', 1)
-                
-                pdf.image(heatmap_plot, x=110, y=90, w=graph_width, h=graph_height)
+                pdf.cell(graph_width, 4, weekday_title, 0, 1, 'C', 1)
             
-            # 考察セクション（1ページ目の下部に配置）
-            pdf.set_xy(10, 145)
+            self._place_chart(pdf, 'weekday', weekday_plot, aggregates, x=110, y=30, w=graph_width, h=graph_height)
+        
+        # 2行目: 月別とヒートマップ
+        # 月別分布グラフ
+        if monthly_plot:
+            pdf.set_xy(10, 85)
             if japanese_font_available:
-                pdf.set_font('unicode', 'B', 9)
-                insights_title = 'データに基づく考察と改善提案'
+                pdf.set_font('unicode', 'B', 7)  # フォントサイズを小さく
+                monthly_title = '3. 月別分布'
             else:
-                pdf.set_font('helvetica', 'B', 9)
-                insights_title = 'Data-based Insights and Recommendations'
+                pdf.set_font('helvetica', 'B', 7)  # フォントサイズを小さく
+                monthly_title = '3. Monthly Distribution'
             
-            pdf.set_fill_color(241, 196, 15)  # 黄色の背景
+            pdf.set_fill_color(155, 89, 182)  # 紫色の背景
             
             # 非推奨警告を回避するためのcell呼び出し
             if has_new_api:
-                pdf.cell(0, 5, insights_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
+                pdf.cell(graph_width, 4, monthly_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
             else:
-                pdf.cell(0, 5, insights_title, 0, 1, 'C', 1)
+                pdf.cell(graph_width, 4, monthly_title, 0, 1, 'C', 1)
             
-            # 考察の表示（1ページに収めるためにコンパクトに）
+            self._place_chart(pdf, 'monthly', monthly_plot, aggregates, x=10, y=90, w=graph_width, h=graph_height)
+        
+        # ヒートマップ
+        if heatmap_plot:
+            pdf.set_xy(110, 85)
             if japanese_font_available:
-                pdf.set_font('unicode', '', 8)
+                pdf.set_font('unicode', 'B', 7)  # フォントサイズを小さく
+                heatmap_title = '4. 時間帯×曜日ヒートマップ'
             else:
-                pdf.set_font('helvetica', '', 8)
-            
-            # 考察を表示（2列レイアウト）
-            y_pos = 155
-            col_width = 95  # 列の幅
-            line_height = 8  # 行の高さ
-            
-            for i, insight in enumerate(claude_insights):
-                if insight.strip():  # 空行をスキップ
-                    # 箇条書きの番号がない場合は追加
-                    if not re.match(r'^\d+\.', insight.strip()):
-                        insight = f"{i+1}. {insight}"
-                    
-                    # 左右の列に分けて表示
-                    x_pos = 10 if i % 2 == 0 else 105
-                    
-                    # 偶数番目の考察で新しい行を開始
-                    if i % 2 == 0 and i > 0:
-                        y_pos += line_height
-                    
-                    # 考察テキスト
-                    pdf.set_xy(x_pos, y_pos)
-                    pdf.multi_cell(col_width, 4, insight, align='L')
-                    
-                    # 奇数番目の考察の後に行を進める
-                    if i % 2 == 1:
-                        y_pos += line_height
+                pdf.set_font('helvetica', 'B', 7)  # フォントサイズを小さく
+                heatmap_title = '4. Hour x Weekday Heatmap'
             
-            # フッター
-            pdf.set_y(-10)
-            if japanese_font_available:
-                pdf.set_font('unicode', '', 6)  # フォントサイズをさらに小さく
-                footer = f'作成日時: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")} - Gmail分析ツール'
-            else:
-                pdf.set_font('helvetica', '', 6)  # フォントサイズをさらに小さく
-                footer = f'Generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")} - Gmail Analysis Tool'
+            pdf.set_fill_color(211, 84, 0)  # オレンジ色の背景
             
             # 非推奨警告を回避するためのcell呼び出し
             if has_new_api:
-                pdf.cell(0, 6, footer, 0, new_x=XPos.RIGHT, new_y=YPos.TOP, align='C')
+                pdf.cell(graph_width, 4, heatmap_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
             else:
-                pdf.cell(0, 6, footer, 0, 0, 'C')
-            
-            # PDFの保存
-            pdf.output(output_path)
-            print(f"PDFレポートを作成しました: {output_path}")
-            
-            # 一時ファイルの削除
-            for plot in [hourly_plot, weekday_plot, monthly_plot, heatmap_plot]:
-                if plot and os.path.exists(plot):
-                    os.remove(plot)
+                pdf.cell(graph_width, 4, heatmap_title, 0, 1, 'C', 1)
             
-            return output_path
-            
-        except Exception as e:
-            print(f"PDFレポート作成エラー: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+            self._place_chart(pdf, 'heatmap', heatmap_plot, aggregates, x=110, y=90, w=graph_width, h=graph_height)
+        
+        # 考察セクション（1ページ目の下部に配置）
+        pdf.set_xy(10, 145)
+        if japanese_font_available:
+            pdf.set_font('unicode', 'B', 9)
+            insights_title = 'データに基づく考察と改善提案'
+        else:
+            pdf.set_font('helvetica', 'B', 9)
+            insights_title = 'Data-based Insights and Recommendations'
+        
+        pdf.set_fill_color(241, 196, 15)  # 黄色の背景
+        
+        # 非推奨警告を回避するためのcell呼び出し
+        if has_new_api:
+            pdf.cell(0, 5, insights_title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
+        else:
+            pdf.cell(0, 5, insights_title, 0, 1, 'C', 1)
+        
+        # 考察の表示（1ページに収めるためにコンパクトに）
+        if japanese_font_available:
+            pdf.set_font('unicode', '', 8)
+        else:
+            pdf.set_font('helvetica', '', 8)
+        
+        # 考察を表示（2列レイアウト）
+        y_pos = 155
+        col_width = 95  # 列の幅
+        line_height = 8  # 行の高さ
+        
+        for i, insight in enumerate(claude_insights):
+            if insight.strip():  # 空行をスキップ
+                # 箇条書きの番号がない場合は追加
+                if not re.match(r'^\d+\.', insight.strip()):
+                    insight = f"{i+1}. {insight}"
+                
+                # 左右の列に分けて表示
+                x_pos = 10 if i % 2 == 0 else 105
+                
+                # 偶数番目の考察で新しい行を開始
+                if i % 2 == 0 and i > 0:
+                    y_pos += line_height
+                
+                # 考察テキスト
+                pdf.set_xy(x_pos, y_pos)
+                pdf.multi_cell(col_width, 4, insight, align='L')
+                
+                # 奇数番目の考察の後に行を進める
+                if i % 2 == 1:
+                    y_pos += line_height
+        
+        # フッター（下端のため自動改ページで空白ページが入らないようにする）
+        pdf.set_auto_page_break(auto=False)
+        pdf.set_y(-10)
+        if japanese_font_available:
+            pdf.set_font('unicode', '', 6)  # フォントサイズをさらに小さく
+            footer = f'作成日時: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")} - Gmail分析ツール'
+        else:
+            pdf.set_font('helvetica', '', 6)  # フォントサイズをさらに小さく
+            footer = f'Generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")} - Gmail Analysis Tool'
+        
+        # 非推奨警告を回避するためのcell呼び出し
+        if has_new_api:
+            pdf.cell(0, 6, footer, 0, new_x=XPos.RIGHT, new_y=YPos.TOP, align='C')
+        else:
+            pdf.cell(0, 6, footer, 0, 0, 'C')
+        pdf.set_auto_page_break(auto=True, margin=5)
 
-    def _create_hourly_distribution_plot(self, df, figsize=(10, 6)):
-        """時間帯分布のグラフを作成"""
-        import matplotlib.pyplot as plt
+    def _report_render_options(self, figsize=(5, 3)):
+        """描画結果に影響する設定（キャッシュキーに含める）"""
+        return {
+            'figsize': list(figsize),
+            'chart_format': self.chart_format,
+            'chart_templates': self.chart_templates,
+            'font': self.font_resolver.find_font_path(),
+        }
+
+    def _report_summary(self, df):
+        """レポートの基本情報欄に載る値（キャッシュキーに含める）"""
+        sampling = self._get_sampling_info(df)
+        return {
+            'start': df['date'].min().strftime('%Y-%m-%d'),
+            'end': df['date'].max().strftime('%Y-%m-%d'),
+            'total': len(df),
+            'population': sampling['population'] if sampling else None,
+        }
+
+    def _render_report_charts(self, aggregates, figsize=(5, 3)):
+        """レポート用のグラフを描画する（キャッシュがあれば集計値が同じグラフは再利用）"""
+        cache = self.report_cache
+        if cache is None:
+            return render_charts(aggregates, figsize=figsize, max_workers=self.render_workers,
+                                 use_templates=self.chart_templates, image_format=self.chart_format,
+                                 font_path=self.font_resolver.find_font_path())
+        
+        suffix = f'.{self.chart_format}'
+        options = self._report_render_options(figsize)
+        keys = {name: cache.chart_key(name, aggregates, options)
+                for name in ('hourly', 'weekday', 'monthly', 'heatmap')}
+        charts = {}
+        for name, key in keys.items():
+            data = cache.get_bytes(key, suffix)
+            if data is not None:
+                charts[name] = io.BytesIO(data)
         
+        missing = [name for name in keys if name not in charts]
+        if missing:
+            rendered = render_charts(aggregates, figsize=figsize, max_workers=self.render_workers,
+                                     use_templates=self.chart_templates, image_format=self.chart_format,
+                                     names=missing, font_path=self.font_resolver.find_font_path())
+            for name, image in rendered.items():
+                if image is not None:
+                    try:
+                        cache.put_bytes(keys[name], image.getvalue(), suffix)
+                    except Exception as e:
+                        print(f"グラフのキャッシュ保存エラー（{name}）: {e}")
+                charts[name] = image
+        return charts
+
+    def _place_chart(self, pdf, name, image, aggregates, x, y, w, h):
+        """グラフをPDFに配置（SVGを埋め込めない場合はPNGで描画し直して配置）"""
         try:
-            # 日本時間に変換（すでに変換済みなので+9時間は不要）
-            df['date_jst'] = pd.to_datetime(df['date'])
-            
-            # 時間帯分析
-            hourly_counts = df['date_jst'].dt.hour.value_counts().sort_index()
-            
-            # 24時間分のデータをカウント0で初期化
-            all_hours = pd.Series(0, index=range(24))
-            # 実際のデータで上書き
-            all_hours.update(hourly_counts)
-            
-            # グラフ作成
-            plt.figure(figsize=figsize)
-            ax = all_hours.plot(kind='bar', color='skyblue')
-            
-            plt.title('時間帯別メール分布', fontsize=14)
-            plt.xlabel('時間帯', fontsize=12)
-            plt.ylabel('メール数', fontsize=12)
-            plt.xticks(rotation=45)
-            plt.grid(axis='y', linestyle='--', alpha=0.7)
-            
-            # データラベル追加
-            for i, v in enumerate(all_hours):
-                ax.text(i, v + 0.1, str(v), ha='center')
-            
-            plt.tight_layout()
-            plt.savefig('temp_plots/hourly_distribution.png')
-            plt.close()
-            
+            pdf.image(image, x=x, y=y, w=w, h=h)
         except Exception as e:
-            print(f"時間帯グラフ作成エラー: {e}")
-            # エラー時は空のグラフを作成
-            plt.figure(figsize=figsize)
-            plt.title('時間帯別分布 (利用不可)', fontsize=14)
-            plt.savefig('temp_plots/hourly_distribution.png')
-            plt.close()
-        
-        return 'temp_plots/hourly_distribution.png'
+            if self.chart_format == 'png':
+                raise
+            print(f"SVG埋め込みエラー（{name}）: {e}（PNGで埋め込みます）")
+            pdf.image(render_chart(name, aggregates, figsize=(5, 3), font_path=self.font_resolver.find_font_path()),
+                      x=x, y=y, w=w, h=h)
+
+    def _create_hourly_distribution_plot(self, df, figsize=(10, 6)):
+        """時間帯分布のグラフを作成"""
+        aggregates = self._compute_chart_aggregates(df)
+        return render_hourly_chart(aggregates['hourly'], figsize, aggregates['sampling'], self.chart_format)
 
     def _create_weekday_distribution_plot(self, df, figsize=(10, 6)):
         """曜日分布のグラフを作成（土日を青色で強調）"""
-        import matplotlib.pyplot as plt
-        import numpy as np
+        aggregates = self._compute_chart_aggregates(df)
+        return render_weekday_chart(aggregates['weekday'], figsize, aggregates['sampling'], self.chart_format)
+
+    def _compute_chart_aggregates(self, df):
+        """グラフ描画用の集計値を計算する
+
+        描画プロセスにはDataFrameではなく、この辞書（リストのみで構成）を渡す。
+        取得に失敗したメッセージ（日時が不明）はどの区分にも数えない。
+        """
+        sampling = self._get_sampling_info(df)
+        errors = self._error_mask(df)
+        if errors.any():
+            df = df[~errors]
         
-        plt.figure(figsize=figsize)
+        # 日本時間に変換（すでに変換済みなので+9時間は不要）
+        dates = pd.to_datetime(df['date'], errors='coerce').dropna()
         
-        try:
-            # 曜日データの取得（安全に）
-            if 'weekday' in df.columns:
-                # すでに曜日列がある場合はそれを使用
-                weekday_counts = df['weekday'].value_counts()
-            else:
-                # date列から曜日を計算（型チェック付き）
-                if not pd.api.types.is_datetime64_any_dtype(df['date']):
-                    df['date'] = pd.to_datetime(df['date'], errors='coerce')
-                
-                # 有効な日付のみで計算
-                valid_dates = df[df['date'].notna()]
-                if len(valid_dates) > 0:
-                    weekday_counts = valid_dates['date'].dt.day_name().value_counts()
-                else:
-                    weekday_counts = pd.Series(dtype='int64')
-            
-            # 曜日の順序を設定
-            ordered_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-            ordered_counts = pd.Series([weekday_counts.get(day, 0) for day in ordered_days], index=ordered_days)
-            
-            # 土日とそれ以外で色を分ける
-            colors = ['#FF9999', '#FF9999', '#FF9999', '#FF9999', '#FF9999', '#6699CC', '#4477AA']
-            
-            # グラフ作成
-            ax = ordered_counts.plot(kind='bar', color=colors)
-            
-            plt.title('曜日別メール分布', fontsize=14)
-            plt.xlabel('曜日', fontsize=12)
-            plt.ylabel('メール数', fontsize=12)
-            plt.xticks(rotation=45)
-            plt.grid(axis='y', linestyle='--', alpha=0.7)
-            
-            # データラベルを追加
-            for i, v in enumerate(ordered_counts):
-                ax.text(i, v + 0.1, str(v), ha='center')
-            
-        except Exception as e:
-            print(f"曜日グラフ作成エラー: {e}")
-            plt.title('曜日別データ (エラー発生)', fontsize=14)
+        # 時間帯別・月別（存在しない区分は0）
+        hourly = dates.dt.hour.value_counts().reindex(range(24), fill_value=0)
+        monthly = dates.dt.month.value_counts().reindex(range(1, 13), fill_value=0)
         
-        plt.tight_layout()
-        plt.savefig('temp_plots/weekday_distribution.png')
-        plt.close()
+        # 曜日別（曜日列がある場合はそれを使用）
+        ordered_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+        if 'weekday' in df.columns:
+            weekday_counts = df['weekday'].value_counts()
+        else:
+            weekday_counts = dates.dt.day_name().value_counts()
+        weekday = [int(weekday_counts.get(day, 0)) for day in ordered_days]
+        
+        # 曜日×時間帯（0=月曜日）
+        heatmap = np.zeros((7, 24), dtype=int)
+        np.add.at(heatmap, (dates.dt.weekday.values, dates.dt.hour.values), 1)
         
-        return 'temp_plots/weekday_distribution.png'
+        return {
+            'hourly': [int(v) for v in hourly.values],
+            'weekday': weekday,
+            'monthly': [int(v) for v in monthly.values],
+            'heatmap': heatmap.tolist(),
+            'sampling': sampling,
+        }
 
     def _generate_marketing_insights(self, df, sender_email):
         """マーケティングプロの考察を生成（JST対応）"""
@@ -983,6 +3110,7 @@ class GmailAnalyzer:
         
         return suggestions
 
+    @_pyplot_locked
     def _create_time_series_plot(self, df, figsize=(10, 6)):
         """月別推移グラフを作成（JST対応、タイムゾーン警告修正版）"""
         try:
@@ -1030,17 +3158,16 @@ class GmailAnalyzer:
             
             plt.tight_layout()
             
-            # 一時ファイルとして保存
-            output_path = 'temp_plots/time_series.png'
-            plt.savefig(output_path)
-            plt.close()
+            # 画像バッファに保存
+            image = _save_figure(self.chart_format)
             
-            return output_path
+            return image
             
         except Exception as e:
             print(f"時系列グラフ作成エラー: {e}")
             return None
 
+    @_pyplot_locked
     def _create_activity_heatmap(self, df, figsize=(10, 6)):
         """時系列ヒートマップを作成（JST対応、視覚的に改善したバージョン）"""
         try:
@@ -1075,6 +3202,7 @@ class GmailAnalyzer:
             # 青から濃い青へのグラデーション
             colors = ['#ffffff', '#f2f9ff', '#d4e9ff', '#b5daff', 
                      '#8ac5ff', '#5eadff', '#3a96ff', '#1b80ff', '#0066e3', '#004fb3']
+            from matplotlib.colors import LinearSegmentedColormap
             custom_cmap = LinearSegmentedColormap.from_list('custom_blue', colors)
             
             # 最大値に基づいてカラースケールを調整
@@ -1150,12 +3278,10 @@ class GmailAnalyzer:
             # レイアウト調整
             plt.tight_layout()
             
-            # 一時ファイルとして保存（高解像度）
-            output_path = 'temp_plots/activity_heatmap.png'
-            plt.savefig(output_path, dpi=200, bbox_inches='tight')
-            plt.close()
+            # 画像バッファに保存（高解像度）
+            image = _save_figure(self.chart_format, dpi=200, bbox_inches='tight')
             
-            return output_path
+            return image
             
         except Exception as e:
             print(f"ヒートマップ作成エラー: {e}")
@@ -1163,15 +3289,17 @@ class GmailAnalyzer:
             traceback.print_exc()
             return None
 
+    @_pyplot_locked
     def _create_wordcloud(self, df, figsize=(10, 6)):
         """キーワード分析のワードクラウドを作成（A4最適化版）"""
         try:
-            # 本文データがあるか確認
-            if 'body' not in df.columns or df['body'].isna().all():
+            # 本文（なければ件名＋スニペット）のテキストを取得
+            text_series = self._get_text_series(df)
+            if text_series is None:
                 return None
             
             # テキストの前処理
-            text = ' '.join(df['body'].dropna().astype(str).tolist())
+            text = ' '.join(text_series.tolist())
             if len(text) < 20:  # テキストが短すぎる場合
                 return None
                 
@@ -1198,26 +3326,17 @@ class GmailAnalyzer:
                 plt.axis('off')
                 plt.tight_layout(pad=0)
                 
-                # 一時ファイルとして保存
-                output_path = 'temp_plots/wordcloud.png'
-                plt.savefig(output_path, dpi=150, bbox_inches='tight')
-                plt.close()
+                # 画像バッファに保存
+                image = _save_figure(dpi=150, bbox_inches='tight')
                 
-                return output_path
+                return image
                 
             except ImportError:
                 # WordCloudライブラリがない場合のフォールバック
                 print("WordCloudライブラリがインストールされていません。")
                 
-                # 単語の頻度を計算
-                words = re.findall(r'\b\w+\b', text.lower())
-                word_freq = {}
-                for word in words:
-                    if len(word) > 2:  # 短すぎる単語を除外
-                        word_freq[word] = word_freq.get(word, 0) + 1
-                
                 # 頻度上位20単語を取得
-                top_words = sorted(word_freq.items(), key=lambda x: x[1], reverse=True)[:20]
+                top_words = self._count_word_frequencies(text).most_common(20)
                 
                 # バブルチャートで可視化
                 plt.figure(figsize=figsize)
@@ -1238,117 +3357,47 @@ class GmailAnalyzer:
                 
                 plt.tight_layout()
                 
-                # 一時ファイルとして保存
-                output_path = 'temp_plots/word_freq.png'
-                plt.savefig(output_path, dpi=150, bbox_inches='tight')
-                plt.close()
+                # 画像バッファに保存
+                image = _save_figure(dpi=150, bbox_inches='tight')
                 
-                return output_path
+                return image
             
         except Exception as e:
             print(f"単語分析作成エラー: {e}")
             return None
 
+    def _get_text_series(self, df):
+        """テキスト分析用の文字列を取得（本文がなければ件名＋スニペットを使用）"""
+        if 'body' in df.columns and not df['body'].isna().all():
+            return df['body'].dropna().astype(str)
+        
+        # スニペットモード: 本文をダウンロードせずに件名とスニペットを結合
+        if 'snippet' not in df.columns and 'subject' not in df.columns:
+            return None
+        subjects = df['subject'].fillna('').astype(str) if 'subject' in df.columns else ''
+        snippets = df['snippet'].fillna('').astype(str) if 'snippet' in df.columns else ''
+        text_series = (subjects + ' ' + snippets).str.strip()
+        text_series = text_series[text_series != '']
+        if text_series.empty:
+            return None
+        return text_series
+
+    def _count_word_frequencies(self, text):
+        """テキストから単語の出現頻度を計算する"""
+        words = re.findall(r'\b\w+\b', text.lower())
+        # 短すぎる単語と数字のみの単語を除外
+        return Counter(word for word in words if len(word) > 2 and not word.isdigit())
+
     def _create_heatmap(self, df, figsize=(10, 6)):
         """曜日×時間帯のヒートマップを作成（JST対応版、24時間対応、曜日順序修正）"""
-        try:
-            # 日本時間に変換（+9時間）
-            df = df.copy()  # 元のデータフレームを変更しないようにコピー
-            df['date_jst'] = pd.to_datetime(df['date'])
-            
-            # 数値で曜日を取得（0=月曜日, 1=火曜日, ..., 6=日曜日）して正確な順序を確保
-            df['weekday_num'] = df['date_jst'].dt.weekday
-            df['hour_jst'] = df['date_jst'].dt.hour
-            
-            # 曜日の順序（数値）
-            weekday_nums = list(range(7))  # 0=月曜日, 1=火曜日, ..., 6=日曜日
-            hour_order = list(range(24))   # 0-23時
-            
-            # 曜日と時間でグループ化して集計
-            count_df = df.groupby(['weekday_num', 'hour_jst']).size().reset_index(name='count')
-            count_dict = dict(zip(zip(count_df['weekday_num'], count_df['hour_jst']), count_df['count']))
-            
-            # すべての時間帯の組み合わせに対して値を設定（ない場合は0）
-            full_data = []
-            for weekday in weekday_nums:
-                for hour in hour_order:
-                    full_data.append({
-                        'weekday': weekday,
-                        'hour': hour,
-                        'count': count_dict.get((weekday, hour), 0)
-                    })
-            
-            full_df = pd.DataFrame(full_data)
-            
-            # ピボットテーブルに変換
-            pivot_data = full_df.pivot(
-                index='weekday', 
-                columns='hour', 
-                values='count'
-            )
-            
-            # 日本語の曜日名（月曜日から順）
-            jp_weekdays = ['月曜日', '火曜日', '水曜日', '木曜日', '金曜日', '土曜日', '日曜日']
-            pivot_data.index = jp_weekdays  # 数値インデックスを日本語曜日名に置き換え
-            
-            # ヒートマップの作成
-            plt.figure(figsize=figsize)
-            
-            # カラーマップの設定
-            cmap = plt.cm.Blues
-            
-            # ヒートマップ描画
-            ax = sns.heatmap(
-                pivot_data, 
-                cmap=cmap,
-                linewidths=0.5,
-                linecolor='gray',
-                annot=True,
-                fmt='g',
-                annot_kws={"size": 9},
-                cbar_kws={'label': 'メール数', 'shrink': 0.8}
-            )
-            
-            # 軸ラベルの設定
-            plt.xlabel('時間帯（JST）', fontsize=12)
-            plt.ylabel('曜日', fontsize=12)
-            
-            # x軸のラベルを3時間ごとに表示
-            plt.xticks(
-                [i + 0.5 for i in range(0, 24, 3)], 
-                [f"{i}時" for i in range(0, 24, 3)],
-                rotation=0
-            )
-            
-            # タイトル設定
-            plt.title('曜日×時間帯の送信頻度（JST）', fontsize=14)
-            
-            # 業務時間帯（9-17時）を強調表示
-            ax.add_patch(plt.Rectangle((9, 0), 8, 5, fill=False, edgecolor='red', lw=2))
-            
-            # 時間帯の区切り線
-            for h in [6, 12, 18]:
-                plt.axvline(x=h, color='#9e9e9e', linestyle='--', alpha=0.3)
-            
-            # 週末の区切り線
-            plt.axhline(y=5, color='#9e9e9e', linestyle='--', alpha=0.5)
-            
-            plt.tight_layout()
-            
-            # 一時ファイルとして保存
-            output_path = 'temp_plots/heatmap.png'
-            plt.savefig(output_path, dpi=150, bbox_inches='tight')
-            plt.close()
-            
-            print(f"ヒートマップを作成しました: {output_path}")
-            return output_path
-            
+        try:
+            aggregates = self._compute_chart_aggregates(df)
         except Exception as e:
             print(f"ヒートマップ作成エラー: {e}")
-            import traceback
-            traceback.print_exc()
             return None
+        return render_heatmap_chart(aggregates['heatmap'], figsize, self.chart_format)
 
+    @_pyplot_locked
     def _create_communication_trend_graph(self, df, figsize=(10, 6)):
         """コミュニケーション傾向の時系列分析グラフ"""
         if len(df) < 10:
@@ -1408,21 +3457,16 @@ class GmailAnalyzer:
             plt.tight_layout()
             
             # 画像を保存
-            plt.savefig('temp_plots/communication_trend.png', dpi=300, bbox_inches='tight')
-            plt.close()
-            
-            return 'temp_plots/communication_trend.png'
+            return _save_figure(self.chart_format, dpi=300, bbox_inches='tight')
         
         return None
 
+    @_pyplot_locked
     def _create_relationship_radar_chart(self, df, figsize=(7, 7)):
         """関係性分析のレーダーチャート（サイズ調整版）"""
         if len(df) < 10:
             return None
         
-        import matplotlib.pyplot as plt
-        import numpy as np
-        import pandas as pd
         
         # 必要な指標を計算
         metrics = {}
@@ -1520,26 +3564,26 @@ class GmailAnalyzer:
         
         # 画像を保存
         plt.tight_layout()
-        plt.savefig('temp_plots/relationship_radar.png', dpi=300, bbox_inches='tight', transparent=True)
-        plt.close()
-        
-        return 'temp_plots/relationship_radar.png'
+        return _save_figure(self.chart_format, dpi=300, bbox_inches='tight', transparent=True)
 
+    @_pyplot_locked
     def _analyze_text_content(self, df):
-        """メール本文のテキスト分析を行う"""
-        if 'content_length' not in df.columns:
-            return None
+        """メール本文のテキスト分析を行う（本文がない場合は件名＋スニペットで分析）"""
         
-        import numpy as np
-        import matplotlib.pyplot as plt
-        from collections import Counter
-        import re
+        # 本文の文字数がない場合はスニペットモードで分析
+        snippet_mode = 'content_length' not in df.columns
+        text_series = self._get_text_series(df)
+        if snippet_mode:
+            if text_series is None:
+                return None
+            lengths = text_series.str.len()
+        else:
+            lengths = df['content_length'].dropna()
         
         # 基本的な文章統計
         stats = {}
         
         # 1. 文の長さの分布
-        lengths = df['content_length'].dropna()
         if len(lengths) == 0:
             return None
         
@@ -1548,28 +3592,47 @@ class GmailAnalyzer:
         stats['最小文字数'] = lengths.min()
         
         # 2. 文章の複雑さ（長文の割合）
-        long_emails = lengths[lengths > 1000].count()
-        stats['長文率'] = long_emails / len(lengths) * 100
+        # スニペットは1000文字に届かないため、本文を取得していない場合は算出しない
+        if snippet_mode:
+            stats['長文率'] = None
+        else:
+            long_emails = lengths[lengths > 1000].count()
+            stats['長文率'] = long_emails / len(lengths) * 100
+        
+        # 3. 頻出キーワード
+        if text_series is not None:
+            word_freq = self._count_word_frequencies(' '.join(text_series.tolist()))
+            stats['頻出キーワード'] = [word for word, _ in word_freq.most_common(10)]
         
         # テキスト分析用のグラフ作成
         fig, ax = plt.subplots(figsize=(7, 3.5))
         
-        # 文字数分布のヒストグラム
-        bins = [0, 250, 500, 750, 1000, 1500, 2000, 3000, lengths.max() + 1]
-        ax.hist(lengths, bins=bins, color='#5975a4', alpha=0.7, edgecolor='black', linewidth=0.5)
-        
-        ax.set_xlabel('メール本文の文字数', fontsize=10)
-        ax.set_ylabel('メール数', fontsize=10)
-        ax.set_title('メール文章の長さ分布', fontsize=12)
-        
-        # x軸ラベルの調整
-        labels = ['0-250', '250-500', '500-750', '750-1K', '1K-1.5K', '1.5K-2K', '2K-3K', '3K+']
-        plt.xticks(bins[:-1], labels, rotation=45, ha='right')
+        if snippet_mode:
+            # スニペットは最大200文字程度なので細かい区間で集計
+            bins = list(range(0, int(lengths.max()) + 41, 40))
+            ax.hist(lengths, bins=bins, color='#5975a4', alpha=0.7, edgecolor='black', linewidth=0.5)
+            
+            ax.set_xlabel('件名＋スニペットの文字数', fontsize=10)
+            ax.set_ylabel('メール数', fontsize=10)
+            ax.set_title('メール文章の長さ分布（スニペット）', fontsize=12)
+        else:
+            # 文字数分布のヒストグラム
+            bins = [0, 250, 500, 750, 1000, 1500, 2000, 3000, lengths.max() + 1]
+            ax.hist(lengths, bins=bins, color='#5975a4', alpha=0.7, edgecolor='black', linewidth=0.5)
+            
+            ax.set_xlabel('メール本文の文字数', fontsize=10)
+            ax.set_ylabel('メール数', fontsize=10)
+            ax.set_title('メール文章の長さ分布', fontsize=12)
+            
+            # x軸ラベルの調整
+            labels = ['0-250', '250-500', '500-750', '750-1K', '1K-1.5K', '1.5K-2K', '2K-3K', '3K+']
+            plt.xticks(bins[:-1], labels, rotation=45, ha='right')
         
         # 統計情報をグラフに追加
+        long_rate = '算出不可（本文未取得）' if stats['長文率'] is None else f"{stats['長文率']:.1f}%"
         stats_text = (f"平均: {stats['平均文字数']:.0f}文字\n"
                      f"最大: {stats['最大文字数']:.0f}文字\n"
-                     f"長文率: {stats['長文率']:.1f}%")
+                     f"長文率: {long_rate}")
         
         plt.text(0.75, 0.75, stats_text, transform=ax.transAxes, 
                  bbox=dict(facecolor='white', alpha=0.8, boxstyle='round,pad=0.5'),
@@ -1579,10 +3642,7 @@ class GmailAnalyzer:
         plt.tight_layout()
         
         # 画像を保存
-        plt.savefig('temp_plots/text_analysis.png', dpi=300, bbox_inches='tight')
-        plt.close()
-        
-        return 'temp_plots/text_analysis.png', stats
+        return _save_figure(self.chart_format, dpi=300, bbox_inches='tight'), stats
 
     # 日付型の安全な処理のためのヘルパー関数を追加
     def _safe_weekday_counts(self, df):
@@ -1613,6 +3673,7 @@ class GmailAnalyzer:
             print(f"時間帯カウントエラー: {e}")
             return pd.Series(dtype='int64')
 
+    @_pyplot_locked
     def _create_read_status_analysis(self, df, figsize=(10, 6)):
         """既読状態の分析グラフを作成"""
         try:
@@ -1662,12 +3723,10 @@ class GmailAnalyzer:
             
             plt.tight_layout()
             
-            # 一時ファイルとして保存
-            output_path = 'temp_plots/read_analysis.png'
-            plt.savefig(output_path)
-            plt.close()
+            # 画像バッファに保存
+            image = _save_figure(self.chart_format)
             
-            return output_path
+            return image
             
         except Exception as e:
             print(f"既読分析グラフ作成エラー: {e}")
@@ -1850,293 +3909,1919 @@ class GmailAnalyzer:
                     # 最後の手段：JSTを削除した文字列をpandasでパース
                     return pd.to_datetime(clean_date_str, errors='coerce')
             else:
-                # JSTを含まない通常のパース
-                return pd.to_datetime(date_str, errors='coerce')
-        except Exception as e:
-            print(f"日付パースエラー: {e} - 入力: {date_str}")
+                # JSTを含まない通常のパース
+                return pd.to_datetime(date_str, errors='coerce')
+        except Exception as e:
+            print(f"日付パースエラー: {e} - 入力: {date_str}")
+            return None
+
+    def parse_date_without_warning(self, date_str):
+        """警告を発生させないで日付文字列をパースする補助関数"""
+        # クラス外でも使える静的メソッド
+        try:
+            # JSTを含む場合
+            if isinstance(date_str, str) and 'JST' in date_str:
+                # JSTを削除
+                clean_date_str = date_str.replace('JST', '').strip()
+                # タイムゾーン情報なしでパース
+                date_obj = pd.to_datetime(clean_date_str, errors='coerce')
+                if not pd.isna(date_obj):
+                    # 明示的に日本時間のタイムゾーンを設定
+                    date_obj = date_obj.tz_localize('Asia/Tokyo')
+                return date_obj
+            else:
+                # 通常のパース
+                return pd.to_datetime(date_str, errors='coerce')
+        except:
+            return pd.NaT  # Not a Time を返す
+
+    def generate_insights_with_claude(self, df, sender_email):
+        """Claudeを使用してデータに基づいた考察を生成する（詳細版）"""
+        try:
+            # APIキーの取得（環境変数から、または設定ファイルから）
+            client = self._get_claude_client()
+            if client is None:
+                print("Claude APIキーが設定されていません。環境変数 ANTHROPIC_API_KEY を設定してください。")
+                return self._get_default_insights()
+            
+            # データの準備（Claudeに送信するデータを構造化）
+            data_summary = self._prepare_data_for_claude(df, sender_email)
+            
+            # Claudeに送信して回答を取得
+            try:
+                insights = self._insights_for_summary(client, data_summary)
+            except Exception as api_error:
+                print(f"Claude API呼び出しエラー: {api_error}")
+                return self._get_default_insights()
+            
+            # インサイトが取得できなかった場合はデフォルトを使用
+            if not insights:
+                print("Claude APIからの考察を抽出できませんでした。デフォルトの考察を使用します。")
+                return self._get_default_insights()
+            return insights
+            
+        except Exception as e:
+            print(f"考察生成エラー: {e}")
+            return self._get_default_insights()
+
+    def generate_insights_batch(self, items, max_concurrency=4):
+        """複数の送信者の考察を並行して生成し {送信者: 考察のリスト} を返す
+
+        itemsには (メールアドレス, DataFrame) の組を並べる。同時に送るリクエストは
+        max_concurrency 件までで、レート制限（429）や過負荷（529）の応答は
+        全スレッドで待機を共有して指数バックオフで再試行する。
+        失敗した送信者や回答を解析できなかった送信者にはデフォルトの考察を返す。
+        """
+        results = {}
+        if not self.use_claude:
+            return {sender_email: self._generate_report_insights(df.copy(deep=False), sender_email)
+                    for sender_email, df in items}
+        client = self._get_claude_client()
+        if client is None:
+            print("Claude APIキーが設定されていません。すべての送信者にデフォルトの考察を使用します。")
+            return {sender_email: self._get_default_insights() for sender_email, _ in items}
+        
+        def generate(sender_email, df):
+            # 要約の作成で列が追加されるため、呼び出し元のDataFrameは変更しない
+            data_summary = self._prepare_data_for_claude(df.copy(deep=False), sender_email)
+            return self._insights_for_summary(client, data_summary)
+        
+        with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='insights') as executor:
+            futures = {executor.submit(generate, sender_email, df): sender_email for sender_email, df in items}
+            for future in as_completed(futures):
+                sender_email = futures[future]
+                try:
+                    insights = future.result()
+                except Exception as e:
+                    print(f"{sender_email}: Claude API呼び出しエラー: {e}（デフォルトの考察を使用します）")
+                    insights = None
+                if not insights:
+                    insights = self._get_default_insights()
+                results[sender_email] = insights
+        
+        print(f"{len(results)}名分の考察を生成しました")
+        return results
+
+    def _get_claude_client(self):
+        """Claude APIクライアントを返す（APIキーがない場合はNone、スレッド間で共有する）
+
+        再試行はクライアントではなく _call_claude で行う。
+        claude_base_url（未指定の場合は環境変数 ANTHROPIC_BASE_URL）で接続先を変更できる。
+        """
+        api_key = os.environ.get("ANTHROPIC_API_KEY")
+        if not api_key:
+            return None
+        with self._claude_lock:
+            if self._claude_client is None or self._claude_client_key != api_key:
+                kwargs = {'api_key': api_key, 'max_retries': 0}
+                if self.claude_base_url:
+                    kwargs['base_url'] = self.claude_base_url
+                self._claude_client = anthropic.Anthropic(**kwargs)
+                self._claude_client_key = api_key
+            return self._claude_client
+
+    def _insights_for_summary(self, client, data_summary):
+        """データ要約から考察を生成する（保存済みならAPIを呼ばない、解析できない場合は空のリスト）"""
+        request = self._build_claude_request(data_summary)
+        
+        # 同じ依頼の考察が保存されていればAPIを呼ばない
+        cache_key = None
+        if self.insight_cache is not None:
+            cache_key = self.insight_cache.request_key(request)
+            cached_insights = self.insight_cache.get(cache_key)
+            if cached_insights:
+                print("保存済みの考察を使用します（Claude APIは呼び出しません）")
+                return cached_insights
+        
+        message = self._call_claude(client, request)
+        
+        # 回答からインサイトを抽出
+        response = message.content[0].text
+        print("Claude API応答:", response[:100] + "...")
+        insights = self._parse_claude_insights(response)
+        
+        if insights and cache_key is not None:
+            try:
+                self.insight_cache.put(cache_key, insights)
+            except Exception as e:
+                print(f"考察のキャッシュ保存エラー: {e}")
+        return insights
+
+    # 再試行するHTTPステータス（429: レート制限, 529: 過負荷, 5xx: 一時的なエラー）
+    CLAUDE_RETRY_STATUS = (408, 409, 429, 500, 502, 503, 504, 529)
+
+    def _call_claude(self, client, request):
+        """messages.create を呼び出す（レート制限・過負荷・接続エラーは指数バックオフで再試行）"""
+        for attempt in range(self.claude_max_retries + 1):
+            # 他のスレッドが受けたレート制限の待機を共有する
+            wait = self._claude_wait()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                return client.messages.create(**request)
+            except Exception as e:
+                if self._claude_retry_delay(e, attempt) is None:
+                    raise
+
+    def _claude_wait(self):
+        """同じ分析ツールのリクエストが受けたレート制限による、残りの待機秒数"""
+        return self._claude_retry_at - time.monotonic()
+
+    def _claude_retry_delay(self, error, attempt):
+        """Claude APIのエラーを再試行するまでの秒数を返す（再試行しない場合はNone）
+
+        同期版（_call_claude）と非同期版（AsyncGmailAnalyzer）で共通の再試行の方針。
+        待機時間は retry-after ヘッダーがあればそれに従い、指数バックオフより短くはしない。
+        1つのリクエストがレート制限を受けた場合は、同じ分析ツールからの他のリクエストも
+        _claude_wait() の秒数だけ待機させる。
+        """
+        status = getattr(error, 'status_code', None)
+        retryable = status in self.CLAUDE_RETRY_STATUS or isinstance(error, anthropic.APIConnectionError)
+        if not retryable or attempt >= self.claude_max_retries:
+            return None
+        
+        delay = self.claude_backoff * (2 ** attempt) * random.uniform(0.8, 1.2)
+        response = getattr(error, 'response', None)
+        try:
+            delay = max(delay, float(response.headers.get('retry-after')))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        print(f"Claude APIの一時的なエラー（{status or type(error).__name__}）: {delay:.1f}秒後に再試行します")
+        with self._claude_lock:
+            self._claude_retry_at = max(self._claude_retry_at, time.monotonic() + delay)
+        return delay
+
+    def _build_claude_request(self, data_summary):
+        """messages.create に渡す引数を作る（考察のキャッシュキーにもなる）
+
+        回答はJSONで求め、アシスタントの応答の先頭を "{" に固定して前置きの文章を防ぐ。
+        """
+        prompt = f"""以下はGmailの送信者1人分の集計データ（JSON）です。
+hourは日本時間の時刻別件数（0時から）、weekdayは月曜始まりの曜日別件数、monthは1月から、
+seasonは春夏秋冬、top_slotsは[曜日(0=月), 時, 件数]、hour_4hは4時間ごとの件数、
+peakは最も多い時・曜日(0=月)・月です。
+
+{data_summary}
+
+送信者が効果的なメール戦略を立てるための考察と実行可能な提案を5つ、日本語で作成してください。
+各項目は合わせて50-70文字程度にしてください。
+次の形式のJSONのみで回答してください：
+{{"insights": [{{"observation": "具体的な考察", "suggestion": "実行可能な提案"}}]}}"""
+        return {
+            'model': "claude-3-haiku-20240307",
+            'max_tokens': 1000,
+            'temperature': 0.7,
+            'system': "あなたはメール分析の専門家です。データに基づいた具体的で実用的な考察と改善提案を提供してください。",
+            'messages': [
+                {"role": "user", "content": prompt},
+                {"role": "assistant", "content": "{"},
+            ],
+        }
+
+    def _parse_claude_insights(self, response):
+        """Claudeの回答（"{" に続くJSON）から考察のリストを取り出す
+
+        JSONとして解析できない場合は番号付きの行を考察として使う。
+        """
+        text = response.strip()
+        if not text.startswith('{'):
+            text = '{' + text  # 先頭の "{" は送信側で指定済み
+        try:
+            # JSONの後ろに文章が続いても無視する
+            data, _ = json.JSONDecoder().raw_decode(text)
+            insights = []
+            for item in data.get('insights', []):
+                if isinstance(item, dict):
+                    observation = str(item.get('observation', '')).strip()
+                    suggestion = str(item.get('suggestion', '')).strip()
+                    line = f"{observation}: {suggestion}" if observation and suggestion else observation or suggestion
+                else:
+                    line = str(item).strip()
+                if line:
+                    insights.append(f"{len(insights) + 1}. {line}")
+            if insights:
+                return insights
+        except (ValueError, AttributeError) as e:
+            print(f"考察のJSON解析エラー: {e}")
+        
+        # 回答を行ごとに分割して整形
+        insights = []
+        for line in response.strip().split('\n'):
+            line = line.strip()
+            if re.match(r'^\d+\.', line):  # 番号付きの行のみを抽出
+                insights.append(line)
+        return insights
+
+    def _get_default_insights(self):
+        """デフォルトの考察を返す（APIが利用できない場合など）- 簡潔版"""
+        return [
+            "1. 最適送信時間の活用: 朝9時台と夕方17-18時台に送信し開封率向上",
+            "2. 曜日最適化: 火-木曜日は開封率高く、月曜は埋もれやすい傾向",
+            "3. コンテンツ調整: 朝は簡潔、昼はビジュアル、夕方は詳細情報を提供",
+            "4. セグメント配信: 「朝型」「夜型」ユーザー別に最適時間帯で配信",
+            "5. A/Bテスト実施: 異なる時間帯で送信し開封率・クリック率を比較"
+        ]
+
+    def _prepare_data_for_claude(self, df, sender_email, token_budget=None):
+        """Claudeに送信する集計データをコンパクトなJSONで作る
+
+        トークン数の概算が token_budget（未指定の場合は claude_input_budget）を超える場合は、
+        重要度の低い詳細（上位の組み合わせ、月別、時刻別の細かさ）から順に削る。
+        DataFrameは変更しない。
+        """
+        if token_budget is None:
+            token_budget = self.claude_input_budget
+        aggregates = self._compute_chart_aggregates(df)
+        dates = pd.to_datetime(df['date'], errors='coerce').dropna().sort_values()
+        total_emails = len(df)
+        
+        hourly = aggregates['hourly']
+        weekday = aggregates['weekday']
+        monthly = aggregates['monthly']
+        heatmap = aggregates['heatmap']
+        
+        # 曜日×時間帯の件数が多い組み合わせ（0=月曜日）
+        slots = sorted(((count, day, hour) for day, row in enumerate(heatmap) for hour, count in enumerate(row)
+                        if count > 0), reverse=True)
+        
+        # 季節（春: 3-5月, 夏: 6-8月, 秋: 9-11月, 冬: 12-2月）
+        season = [sum(monthly[m - 1] for m in months)
+                  for months in ((3, 4, 5), (6, 7, 8), (9, 10, 11), (12, 1, 2))]
+        
+        # 平均送信間隔（日）
+        intervals = dates.diff().dt.total_seconds().dropna() / 86400
+        avg_days_between = round(float(intervals.mean()), 1) if len(intervals) else None
+        
+        payload = {
+            'sender': sender_email,
+            'total': total_emails,
+            'period': [dates.iloc[0].strftime('%Y-%m-%d'), dates.iloc[-1].strftime('%Y-%m-%d')] if len(dates) else None,
+            'peak': {'hour': hourly.index(max(hourly)), 'weekday': weekday.index(max(weekday)),
+                     'month': monthly.index(max(monthly)) + 1},
+            'hour': hourly,
+            'weekday': weekday,
+            'month': monthly,
+            'season': season,
+            'top_slots': [[day, hour, count] for count, day, hour in slots[:5]],
+            'avg_interval_days': avg_days_between,
+        }
+        sampling = aggregates['sampling']
+        if sampling:
+            payload['sampled_from'] = sampling['population']
+        
+        # トークン数の上限に収まるまで詳細を削る
+        def coarsen_hours(p):
+            hours = p.pop('hour')
+            p['hour_4h'] = [sum(hours[i:i + 4]) for i in range(0, 24, 4)]
+        
+        trims = [
+            lambda p: p.update(top_slots=p['top_slots'][:3]),
+            lambda p: p.pop('month'),
+            coarsen_hours,
+            lambda p: p.pop('top_slots'),
+        ]
+        data_summary = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+        for trim in trims:
+            if estimate_tokens(data_summary) <= token_budget:
+                break
+            trim(payload)
+            data_summary = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+        
+        return data_summary
+
+    def _create_monthly_distribution_plot(self, df, figsize=(10, 6)):
+        """月別分布グラフを作成"""
+        try:
+            aggregates = self._compute_chart_aggregates(df)
+        except Exception as e:
+            print(f"月別グラフ作成エラー: {e}")
+            return None
+        return render_monthly_chart(aggregates['monthly'], figsize, self.chart_format)
+
+class BatchReportWriter:
+    """複数の送信者のレポートを目次付きの1つのPDFにまとめる
+
+    日本語フォントは文書全体で一度だけ登録し、使用した文字のサブセットを1回だけ埋め込む。
+    送信者ごとのデータとグラフはページを追加した時点で手放すため、
+    保持し続けるのは描画済みのページだけになる。
+
+    使用例:
+        with BatchReportWriter(analyzer, 'weekly.pdf', expected_count=len(senders)) as writer:
+            for sender in senders:
+                writer.add_sender(analyzer.analyze_emails_from_sender(sender), sender)
+    """
+
+    TOC_ROWS_PER_PAGE = 40
+
+    def __init__(self, analyzer, output_path=None, title=None, expected_count=None):
+        self.analyzer = analyzer
+        if output_path is None:
+            current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_path = f'gmail_analysis_batch_{current_time}.pdf'
+        self.output_path = output_path
+        self.title = title
+        self.page_count = 0
+        self.failed = []
+        self.result = None
+        
+        self.pdf, self.japanese_font_available = analyzer._create_report_pdf()
+        
+        # 目次は最後に描画するため、先頭にページを確保しておく（送信者数が不明な場合は必要に応じて増やす）
+        toc_pages = max(1, math.ceil((expected_count or 0) / self.TOC_ROWS_PER_PAGE))
+        self.pdf.add_page()
+        self.pdf.insert_toc_placeholder(self._render_toc, pages=toc_pages, allow_extra_pages=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def add_sender(self, df, sender_email, insights=None):
+        """送信者1人分のレポートページを追加する（失敗した送信者は記録してスキップ）
+
+        generate_insights_batch でまとめて生成した考察があれば insights に渡す。
+        """
+        if df is None or df.empty:
+            print(f"{sender_email}: データがないためスキップします")
+            self.failed.append(sender_email)
+            return False
+        
+        try:
+            # 目次の確保で改ページ済みの空白ページは1人目のページとして使う
+            self.analyzer._add_report_page(self.pdf, df, sender_email, self.japanese_font_available,
+                                           section=sender_email, new_page=self.page_count > 0,
+                                           insights=insights)
+            self.page_count += 1
+            print(f"{sender_email}: ページを追加しました（{self.page_count}ページ目）")
+            return True
+        except Exception as e:
+            print(f"{sender_email}: ページ作成エラー: {e}")
+            self.failed.append(sender_email)
+            return False
+
+    def _render_toc(self, pdf, outline):
+        """目次ページを描画（各送信者のページへのリンク付き）"""
+        font = 'unicode' if self.japanese_font_available else 'helvetica'
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font(font, 'B', 14)
+        heading = self.title or ('Gmail送信分析レポート 目次' if self.japanese_font_available
+                                 else 'Gmail Analysis Report - Contents')
+        pdf.cell(0, 12, heading, 0, new_x='LMARGIN', new_y='NEXT', align='C')
+        
+        pdf.set_font(font, '', 9)
+        for number, section in enumerate(outline, 1):
+            link = pdf.add_link(page=section.page_number)
+            pdf.cell(160, 6, f'{number}. {section.name}', 0, link=link)
+            pdf.cell(0, 6, str(section.page_number), 0, new_x='LMARGIN', new_y='NEXT', align='R', link=link)
+
+    def close(self):
+        """PDFを書き出してパスを返す（ページがない場合はNone）"""
+        if self.pdf is None:
+            return self.result
+        
+        pdf, self.pdf = self.pdf, None
+        if self.page_count == 0:
+            print("レポートに追加できた送信者がいないため、PDFを作成しませんでした")
+            return None
+        
+        pdf.output(self.output_path)
+        self.result = self.output_path
+        print(f"PDFレポートを作成しました: {self.output_path}（{self.page_count}名分）")
+        if self.failed:
+            print(f"作成できなかった送信者: {', '.join(self.failed)}")
+        return self.result
+
+class AsyncGmailAnalyzer:
+    """asyncioのサービスに組み込むための非同期版の分析ツール
+
+    Gmail APIはhttpx.AsyncClient、Claude APIはAsyncAnthropicで呼び出すため、
+    取得中にスレッドを占有しない。認証・集計・描画・PDF作成は内部の GmailAnalyzer と共有し、
+    CPUを使う処理（集計・グラフ描画・PDF作成）は executor（Noneの場合は既定のスレッドプール）で実行する。
+    各メソッドの timeout は処理全体の秒数で、超えると asyncio.TimeoutError を送出する。
+    タスクをキャンセルすると実行中のHTTPリクエストも中断される。
+
+    使用例:
+        async with AsyncGmailAnalyzer(cache_dir='.cache') as analyzer:
+            await analyzer.authenticate(interactive=False)
+            path = await analyzer.report('example@gmail.com', timeout=300)
+    """
+
+    GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users/me'
+    # 再試行するHTTPステータス（429: レート制限, 5xx: 一時的なエラー）
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, analyzer=None, max_concurrency=10, request_timeout=60, executor=None,
+                 base_url=None, **analyzer_kwargs):
+        self.analyzer = analyzer or GmailAnalyzer(**analyzer_kwargs)
+        # 同時に実行するmessages.getの数
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.executor = executor
+        # Gmail APIの接続先（テスト用のローカルサーバーなど）
+        self.base_url = (base_url or self.GMAIL_API_URL).rstrip('/')
+        self.max_retries = 3
+        self.backoff = 1.0
+        self._client = None
+        self._claude_client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+        return False
+
+    async def aclose(self):
+        """HTTP接続を閉じる"""
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+        claude_client, self._claude_client = self._claude_client, None
+        if claude_client is not None:
+            await claude_client.close()
+
+    async def _run_sync(self, func, *args, **kwargs):
+        """同期処理をエグゼキューターで実行する"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _with_timeout(self, coroutine, timeout):
+        if timeout is None:
+            return await coroutine
+        return await asyncio.wait_for(coroutine, timeout)
+
+    async def authenticate(self, credentials_path='credentials.json', token_path='token.json', interactive=None):
+        """認証を行う（トークンの読み込み・更新はエグゼキューターで実行）"""
+        return await self._run_sync(self.analyzer.authenticate, credentials_path, token_path, interactive)
+
+    def _get_client(self):
+        if self._client is None:
+            try:
+                self._client = httpx.AsyncClient(timeout=self.request_timeout)
+            except ImportError as e:
+                raise ImportError("非同期APIには httpx が必要です（pip install httpx）") from e
+        return self._client
+
+    async def _auth_headers(self):
+        """Authorizationヘッダー（期限が近い場合のトークン更新はエグゼキューターで行う）"""
+        manager = self.analyzer.credential_manager
+        creds = self.analyzer.creds
+        if manager is not None:
+            creds = manager._credentials
+            if creds is None or manager._needs_refresh(creds):
+                try:
+                    creds = await self._run_sync(manager.get_credentials)
+                except google_auth_exceptions.RefreshError as e:
+                    raise AuthenticationError(f"トークンの更新に失敗しました: {e}") from e
+        if creds is None:
+            return {}
+        return {'Authorization': f'Bearer {creds.token}'}
+
+    async def _request(self, path, params, call_type):
+        """クォータを計上してからGmail APIにGETリクエストを送る（429・5xx・接続エラーは再試行）"""
+        client = self._get_client()
+        for attempt in range(self.max_retries + 1):
+            # 毎秒の上限を超える場合はスレッドを止めずに待つ
+            while True:
+                wait = self.analyzer.quota.try_charge(call_type)
+                if wait == 0:
+                    break
+                await asyncio.sleep(wait)
+            
+            try:
+                response = await client.get(f'{self.base_url}/{path}', params=params,
+                                            headers=await self._auth_headers())
+            except httpx.TransportError as e:
+                # 接続エラー・タイムアウト（TimeoutException を含む）も一時的なエラーとして再試行する
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.8, 1.2)
+                print(f"Gmail APIへの接続エラー（{type(e).__name__}）: {delay:.1f}秒後に再試行します")
+                await asyncio.sleep(delay)
+                continue
+            if response.status_code in self.RETRY_STATUS and attempt < self.max_retries:
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.8, 1.2)
+                print(f"Gmail APIの一時的なエラー（{response.status_code}）: {delay:.1f}秒後に再試行します")
+                await asyncio.sleep(delay)
+                continue
+            if response.status_code == 401:
+                raise AuthenticationError("Gmail APIの認証に失敗しました。再認証してください。")
+            response.raise_for_status()
+            return response.json()
+
+    async def _gather(self, coroutines):
+        """すべて完了するまで待つ（1つが失敗・キャンセルされたら残りをキャンセルする）"""
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def fetch(self, sender_email, max_results=500, text_mode=None, progress=None, partial_interval=100,
+                    start_date=None, end_date=None, timeout=None):
+        """指定した送信者のメールを取得してDataFrameを返す（analyze_emails_from_sender の非同期版）
+
+        progress のコールバックと中断の扱いは analyze_emails_from_sender と同じ。
+        """
+        return await self._with_timeout(
+            self._fetch(sender_email, max_results, text_mode, progress, partial_interval, start_date, end_date),
+            timeout)
+
+    async def _fetch(self, sender_email, max_results=500, text_mode=None, progress=None, partial_interval=100,
+                     start_date=None, end_date=None):
+        analyzer = self.analyzer
+        text_mode = text_mode or analyzer.text_mode
+        reporter = _ProgressReporter(analyzer, progress, sender_email, partial_interval)
+        query = analyzer._build_query(sender_email, start_date, end_date)
+        message_ids = []
+        email_data = []
+        cancelled = False
+        try:
+            # 1. 対象メッセージIDの一覧取得
+            page_token = None
+            while len(message_ids) < max_results:
+                params = {'q': query, 'maxResults': min(500, max_results - len(message_ids))}
+                if page_token:
+                    params['pageToken'] = page_token
+                results = await self._request('messages', params, 'list')
+                page_ids = [msg['id'] for msg in results.get('messages', [])]
+                message_ids.extend(page_ids)
+                reporter.page_listed(len(page_ids))
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+            print(f'検索結果: {len(message_ids)}件のメールを分析します')
+            
+            # 2. メッセージの取得（同時に max_concurrency 件まで）
+            get_params = analyzer._message_get_params(text_mode)
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            reporter.fetch_started(len(message_ids), [])
+            
+            async def fetch_message(msg_id):
+                async with semaphore:
+                    error = None
+                    try:
+                        message = await self._request(f'messages/{msg_id}', get_params, 'get')
+                        record = analyzer._message_to_record(message, text_mode)
+                    except (QuotaExceededError, AuthenticationError, asyncio.CancelledError):
+                        raise
+                    except Exception as e:
+                        print(f"メール処理エラー: {e}")
+                        error = e
+                        record = analyzer._error_record(msg_id, sender_email)
+                email_data.append(record)
+                reporter.message_fetched(record, msg_id, error)
+            
+            await self._gather(fetch_message(msg_id) for msg_id in message_ids)
+        except AnalysisCancelled as e:
+            print(f"{e}（取得済み: {len(email_data)}件）")
+            cancelled = True
+        
+        df = pd.DataFrame(email_data)
+        if not df.empty:
+            df = df.sort_values('date', ascending=False)
+        if cancelled:
+            df.attrs['partial'] = {'fetched': len(email_data), 'total': len(message_ids)}
+        
+        if progress is not None:
+            try:
+                reporter.emit_partial()
+            except AnalysisCancelled:
+                pass
+            progress(dict(type='done', sender=sender_email, fetched=len(email_data), total=len(message_ids),
+                          errors=reporter.errors, cancelled=cancelled,
+                          elapsed=round(time.monotonic() - reporter.started, 2), df=df))
+        return df
+
+    def _get_claude_client(self):
+        """非同期のClaude APIクライアントを返す（APIキーがない場合はNone）"""
+        api_key = os.environ.get("ANTHROPIC_API_KEY")
+        if not api_key:
+            return None
+        if self._claude_client is None:
+            kwargs = {'api_key': api_key, 'max_retries': 0}
+            if self.analyzer.claude_base_url:
+                kwargs['base_url'] = self.analyzer.claude_base_url
+            self._claude_client = anthropic.AsyncAnthropic(**kwargs)
+        return self._claude_client
+
+    async def generate_insights(self, df, sender_email, timeout=None):
+        """Claudeで考察を生成する（失敗・期限切れの場合はデフォルトの考察）"""
+        try:
+            return await self._with_timeout(self._generate_insights(df, sender_email), timeout)
+        except asyncio.TimeoutError:
+            print(f"考察の生成が{timeout}秒以内に終わらなかったため、デフォルトの考察を使用します")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Claude API呼び出しエラー: {e}")
+        return self.analyzer._get_default_insights()
+
+    async def _generate_insights(self, df, sender_email):
+        analyzer = self.analyzer
+        if not analyzer.use_claude:
+            return await self._run_sync(analyzer._generate_report_insights, df, sender_email)
+        client = self._get_claude_client()
+        if client is None:
+            print("Claude APIキーが設定されていません。環境変数 ANTHROPIC_API_KEY を設定してください。")
+            return analyzer._get_default_insights()
+        
+        data_summary = await self._run_sync(analyzer._prepare_data_for_claude, df, sender_email)
+        request = analyzer._build_claude_request(data_summary)
+        
+        # 同じ依頼の考察が保存されていればAPIを呼ばない
+        cache_key = None
+        if analyzer.insight_cache is not None:
+            cache_key = analyzer.insight_cache.request_key(request)
+            cached_insights = analyzer.insight_cache.get(cache_key)
+            if cached_insights:
+                print("保存済みの考察を使用します（Claude APIは呼び出しません）")
+                return cached_insights
+        
+        # 再試行の方針と待機の共有は同期版（GmailAnalyzer._call_claude）と同じ
+        for attempt in range(analyzer.claude_max_retries + 1):
+            wait = analyzer._claude_wait()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                message = await client.messages.create(**request)
+                break
+            except Exception as e:
+                if analyzer._claude_retry_delay(e, attempt) is None:
+                    raise
+        
+        insights = analyzer._parse_claude_insights(message.content[0].text)
+        if not insights:
+            print("Claude APIからの考察を抽出できませんでした。デフォルトの考察を使用します。")
+            return analyzer._get_default_insights()
+        if cache_key is not None:
+            try:
+                analyzer.insight_cache.put(cache_key, insights)
+            except Exception as e:
+                print(f"考察のキャッシュ保存エラー: {e}")
+        return insights
+
+    async def analyze(self, sender_email, timeout=None, **fetch_kwargs):
+        """メールを取得し、集計値と考察を {'df', 'aggregates', 'insights'} で返す"""
+        async def run():
+            df = await self._fetch(sender_email, **fetch_kwargs)
+            if df.empty:
+                return {'df': df, 'aggregates': None, 'insights': []}
+            insight_task = asyncio.ensure_future(self.generate_insights(df.copy(deep=False), sender_email))
+            try:
+                aggregates = await self._run_sync(self.analyzer._compute_chart_aggregates, df)
+                insights = await insight_task
+            finally:
+                insight_task.cancel()
+            return {'df': df, 'aggregates': aggregates, 'insights': insights}
+        return await self._with_timeout(run(), timeout)
+
+    async def report(self, sender_email, df=None, output_path=None, timeout=None, **fetch_kwargs):
+        """メールを取得してPDFレポートを作成し、パスを返す（データがない場合はNone）
+
+        dfを渡した場合は取得を省略する。グラフの描画とClaudeの考察生成は並行して行い、
+        考察が insight_timeout 秒以内に届かない場合はデフォルトの考察を使う。
+        """
+        async def run():
+            report_df = df if df is not None else await self._fetch(sender_email, **fetch_kwargs)
+            if report_df.empty:
+                print(f"{sender_email}: データがないためレポートを作成しません")
+                return None
+            
+            analyzer = self.analyzer
+            path = output_path or analyzer._default_report_path(sender_email)
+            insight_task = asyncio.ensure_future(self.generate_insights(
+                report_df.copy(deep=False), sender_email, timeout=analyzer.insight_timeout))
+            try:
+                aggregates = await self._run_sync(analyzer._compute_chart_aggregates, report_df)
+                charts = await self._run_sync(analyzer._render_report_charts, aggregates)
+                insights = await insight_task
+            finally:
+                insight_task.cancel()
+            return await self._run_sync(analyzer._write_report, report_df, sender_email, path,
+                                        aggregates, charts, insights)
+        return await self._with_timeout(run(), timeout)
+
+
+class AccountRegistry:
+    """分析対象のGmailアカウントを管理する（アカウントごとに1つのトークン）
+
+    accounts.json に {アカウント名: {"token_path": ..., "credentials_path": ...}} の形式で保存する。
+    """
+
+    def __init__(self, registry_path='accounts.json'):
+        self.registry_path = registry_path
+        self.accounts = {}
+        if os.path.exists(registry_path):
+            with open(registry_path, 'r', encoding='utf-8') as f:
+                self.accounts = json.load(f)
+
+    def save(self):
+        """登録内容を保存する"""
+        tmp_path = f"{self.registry_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.accounts, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.registry_path)
+
+    def add_account(self, name, token_path=None, credentials_path='credentials.json'):
+        """アカウントを登録する（トークンのパスは省略時 tokens/<アカウント名>.json）"""
+        if token_path is None:
+            os.makedirs('tokens', exist_ok=True)
+            token_path = os.path.join('tokens', f"{re.sub(r'[^A-Za-z0-9_.@-]', '_', name)}.json")
+        self.accounts[name] = {'token_path': token_path, 'credentials_path': credentials_path}
+        self.save()
+        return self.accounts[name]
+
+    def remove_account(self, name):
+        """アカウントの登録を削除する（トークンファイルは残す）"""
+        self.accounts.pop(name, None)
+        self.save()
+
+    def create_analyzer(self, name, interactive=False, quota=None, **analyzer_kwargs):
+        """アカウント用のアナライザーを作成して認証する
+
+        クォータはユーザーごとに管理されるため、アカウントごとに別の
+        QuotaAccountant・認証情報・接続を持つアナライザーを作成する。
+        """
+        if name not in self.accounts:
+            raise KeyError(f"未登録のアカウントです: {name}")
+        account = self.accounts[name]
+        analyzer = GmailAnalyzer(quota=quota or QuotaAccountant(), **analyzer_kwargs)
+        if not analyzer.authenticate(credentials_path=account['credentials_path'],
+                                     token_path=account['token_path'], interactive=interactive):
+            raise AuthenticationError(f"アカウントの認証に失敗しました: {name}")
+        return analyzer
+
+
+class MultiAccountScheduler:
+    """複数アカウントのメール取得を並列に実行する
+
+    アカウントごとにアナライザー（レート制限・認証情報・接続）とワーカープールを持ち、
+    各アカウントの送信者の取得を並列に実行する。結果には account 列が付与される。
+    """
+
+    def __init__(self, registry, workers_per_account=2, interactive=False, analyzer_kwargs=None):
+        self.registry = registry
+        self.workers_per_account = workers_per_account
+        self.interactive = interactive
+        self.analyzer_kwargs = analyzer_kwargs or {}
+        self.analyzers = {}
+
+    def get_analyzer(self, account):
+        """アカウント用のアナライザーを返す（初回のみ作成・認証）"""
+        if account not in self.analyzers:
+            self.analyzers[account] = self.registry.create_analyzer(
+                account, interactive=self.interactive, **self.analyzer_kwargs)
+        return self.analyzers[account]
+
+    def run(self, jobs, checkpoint_root=None, **fetch_kwargs):
+        """アカウントごとの送信者リストを並列に取得する
+
+        jobs は {アカウント名: [送信者, ...]}。戻り値は {(アカウント名, 送信者): DataFrame}。
+        checkpoint_root を指定すると送信者ごとのチェックポイントをその下に保存する。
+        """
+        results = {}
+        errors = {}
+        executors = []
+        futures = {}
+        
+        try:
+            for account, senders in jobs.items():
+                try:
+                    analyzer = self.get_analyzer(account)
+                except Exception as e:
+                    print(f"アカウント初期化エラー（{account}）: {e}")
+                    for sender in senders:
+                        errors[(account, sender)] = e
+                    continue
+                
+                # アカウントごとに独立したワーカープール
+                executor = ThreadPoolExecutor(max_workers=self.workers_per_account,
+                                              thread_name_prefix=f"gmail-{account}")
+                executors.append(executor)
+                for sender in senders:
+                    kwargs = dict(fetch_kwargs)
+                    if checkpoint_root:
+                        kwargs['checkpoint_dir'] = os.path.join(
+                            checkpoint_root, _safe_filename(account), _safe_filename(sender))
+                    future = executor.submit(analyzer.analyze_emails_from_sender, sender, **kwargs)
+                    futures[future] = (account, sender)
+            
+            for future in as_completed(futures):
+                account, sender = futures[future]
+                try:
+                    df = future.result()
+                    # 集計をアカウント単位で合算できるようにタグ付け
+                    df['account'] = account
+                    df['sender'] = sender
+                    results[(account, sender)] = df
+                except Exception as e:
+                    print(f"取得エラー（{account} / {sender}）: {e}")
+                    errors[(account, sender)] = e
+        finally:
+            for executor in executors:
+                executor.shutdown(wait=True)
+        
+        self.errors = errors
+        for account, analyzer in self.analyzers.items():
+            print(f"\nアカウント: {account}", end='')
+            analyzer.quota.print_summary()
+        return results
+
+    @staticmethod
+    def combine_results(results):
+        """アカウント・送信者ごとの結果を1つのDataFrameに結合する"""
+        frames = [df for df in results.values() if not df.empty]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def aggregate_by_account(results):
+        """アカウントごとの時間帯別件数を集計し、全アカウントの合計行を追加する"""
+        combined = MultiAccountScheduler.combine_results(results)
+        if combined.empty:
+            return pd.DataFrame()
+        hourly = combined.groupby(['account', 'hour']).size().unstack(fill_value=0)
+        hourly = hourly.reindex(columns=range(24), fill_value=0)
+        hourly['total'] = hourly.sum(axis=1)
+        hourly.loc['全アカウント合計'] = hourly.sum()
+        return hourly
+
+
+class ReportJobQueue:
+    """HTTPサービスから受け付けた分析ジョブを上限付きのキューとワーカースレッドで処理する
+
+    各ワーカーは analyzer_factory で作成したアナライザーを起動時に warm_up し、以降の
+    ジョブで使い回す（ライブラリ・フォント・Gmail APIの接続を毎回用意しない）。
+    同じ内容のジョブが待機中・実行中の場合は新しく登録せず、そのジョブを返す。
+    ジョブの情報はロック内でのみ更新し、外部にはその時点のコピーを返す。
+    """
+
+    FORMATS = {'pdf': '.pdf', 'csv': '.csv', 'jsonl': '.jsonl', 'json': '.json'}
+
+    def __init__(self, analyzer_factory=None, workers=2, max_queue=100, output_dir='reports', job_ttl=3600):
+        self.analyzer_factory = analyzer_factory or self._default_analyzer
+        self.workers = workers
+        self.output_dir = Path(output_dir)
+        # 完了したジョブの情報と成果物を保持する秒数
+        self.job_ttl = job_ttl
+        self.jobs = {}
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._inflight = {}  # ジョブの内容のキー -> 待機中・実行中のジョブID
+        self._lock = threading.Lock()
+        self._threads = []
+
+    @staticmethod
+    def _default_analyzer():
+        """トークンファイルで認証したアナライザー（サービスではブラウザ認証を行わない）"""
+        analyzer = GmailAnalyzer(cache_dir=os.environ.get('GMAIL_ANALYZER_CACHE_DIR'))
+        if not analyzer.authenticate(interactive=False):
+            raise AuthenticationError("有効なトークンがありません。先にコマンドラインで認証してください")
+        return analyzer
+
+    def start(self):
+        """ワーカースレッドを起動する"""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        for i in range(len(self._threads), self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"report-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def shutdown(self, wait=True):
+        """待機中のジョブを処理し終えたらワーカーを止める"""
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def normalize(self, params):
+        """リクエストの内容を検証してジョブのパラメータにする（不正な場合は ValueError）"""
+        senders = params.get('senders') or params.get('sender')
+        if isinstance(senders, str):
+            senders = [senders]
+        if not senders or not all(isinstance(s, str) and s.strip() for s in senders):
+            raise ValueError("senders に送信者のメールアドレスを指定してください")
+        output_format = params.get('format', 'pdf')
+        if output_format not in self.FORMATS:
+            raise ValueError(f"未対応の形式です: {output_format}（{', '.join(self.FORMATS)}）")
+        max_results = params.get('max_results', 500)
+        if not isinstance(max_results, int) or isinstance(max_results, bool) or max_results <= 0:
+            raise ValueError("max_results には正の整数を指定してください")
+        job = {
+            'senders': list(dict.fromkeys(s.strip() for s in senders)),
+            'start_date': None,
+            'end_date': None,
+            'max_results': max_results,
+            'format': output_format,
+        }
+        for key, name in (('start_date', 'since'), ('end_date', 'until')):
+            value = params.get(name) or params.get(key)
+            if value:
+                # 日付の形式を揃えておく（重複判定のため）
+                job[key] = _format_query_date(value)
+        return job
+
+    def submit(self, params):
+        """ジョブを登録して (ジョブ, 新規かどうか) を返す（キューが満杯の場合は queue.Full）"""
+        job_params = self.normalize(params)
+        key = hashlib.sha256(json.dumps(job_params, sort_keys=True).encode('utf-8')).hexdigest()
+        with self._lock:
+            self._prune()
+            job_id = self._inflight.get(key)
+            if job_id is not None:
+                return self._snapshot(self.jobs[job_id]), False
+            
+            job_id = key[:12] + format(int(time.time() * 1000), 'x')
+            job = {'id': job_id, 'key': key, 'status': 'queued', 'params': job_params,
+                   'created': time.time(), 'started': None, 'finished': None,
+                   'artifact': None, 'failed_senders': [], 'error': None}
+            self._queue.put_nowait(job_id)
+            self.jobs[job_id] = job
+            self._inflight[key] = job_id
+            return self._snapshot(job), True
+
+    def get(self, job_id):
+        """ジョブの状態のコピーを返す（存在しない場合はNone）"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return self._snapshot(job) if job is not None else None
+
+    @staticmethod
+    def _snapshot(job):
+        """ワーカーの更新の影響を受けないジョブのコピー（ロック内で呼び出す）"""
+        return dict(job, failed_senders=list(job['failed_senders']))
+
+    def _update(self, job_id, **fields):
+        """ジョブの情報をまとめて更新する（状態と成果物が食い違って見えないようにする）"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def stats(self):
+        """キューとジョブの件数"""
+        with self._lock:
+            counts = Counter(job['status'] for job in self.jobs.values())
+        return {'workers': len(self._threads), 'queued': self._queue.qsize(),
+                'max_queue': self._queue.maxsize, 'jobs': dict(counts)}
+
+    def _prune(self):
+        """保持期間を過ぎた完了済みジョブと成果物を削除する（ロック内で呼び出す）"""
+        if self.job_ttl is None:
+            return
+        expire = time.time() - self.job_ttl
+        for job_id, job in list(self.jobs.items()):
+            if job['finished'] is not None and job['finished'] < expire:
+                if job['artifact']:
+                    try:
+                        os.remove(job['artifact'])
+                    except OSError:
+                        pass
+                del self.jobs[job_id]
+
+    def _worker_loop(self):
+        """キューからジョブを取り出して順に処理する"""
+        analyzer = None
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                break
+            self._update(job_id, status='running', started=time.time())
+            job = self.get(job_id)
+            failed_senders = []
+            result = {'status': 'failed', 'error': '処理が中断されました'}
+            try:
+                if analyzer is None:
+                    analyzer = self.analyzer_factory()
+                    print(f"{threading.current_thread().name}: 初期化しました（{analyzer.warm_up():.1f}秒）")
+                artifact = self._run_job(analyzer, job, failed_senders)
+                if artifact:
+                    result = {'status': 'done', 'artifact': artifact}
+                else:
+                    result = {'status': 'failed', 'error': 'データがないため成果物を作成できませんでした'}
+            except Exception as e:
+                print(f"ジョブ {job_id} の処理エラー: {e}")
+                result = {'status': 'failed', 'error': f"{type(e).__name__}: {e}"}
+                if isinstance(e, AuthenticationError):
+                    # トークンが更新されたら次のジョブで作り直す
+                    analyzer = None
+            finally:
+                # 成果物・エラーと状態を同時に公開する
+                self._update(job_id, failed_senders=failed_senders, finished=time.time(), **result)
+                with self._lock:
+                    self._inflight.pop(job['key'], None)
+
+    def _run_job(self, analyzer, job, failed_senders):
+        """ジョブを実行して成果物のパスを返す（作成できなかった場合はNone）
+
+        データを取得できなかった送信者は failed_senders に追加する。
+        """
+        params = job['params']
+        output_path = str(self.output_dir / f"{job['id']}{self.FORMATS[params['format']]}")
+        fetch_kwargs = {'max_results': params['max_results'],
+                        'start_date': params['start_date'], 'end_date': params['end_date']}
+        
+        if params['format'] == 'pdf':
+            if len(params['senders']) == 1:
+                sender = params['senders'][0]
+                df = analyzer.analyze_emails_from_sender(sender, **fetch_kwargs)
+                if df.empty:
+                    failed_senders.append(sender)
+                    return None
+                return analyzer.generate_comprehensive_pdf_report(df, sender, output_path=output_path)
+            # 複数の送信者は目次付きの1つのPDFにまとめる
+            writer = BatchReportWriter(analyzer, output_path, expected_count=len(params['senders']))
+            for sender in params['senders']:
+                df = analyzer.analyze_emails_from_sender(sender, **fetch_kwargs)
+                writer.add_sender(df, sender)
+                df = None
+            failed_senders.extend(writer.failed)
+            return writer.close()
+        
+        frames = []
+        summaries = []
+        for sender in params['senders']:
+            df = analyzer.analyze_emails_from_sender(sender, **fetch_kwargs)
+            if df.empty:
+                failed_senders.append(sender)
+                continue
+            if params['format'] == 'json':
+                summaries.append(_sender_summary(analyzer, df, sender, with_insights=True))
+            else:
+                df = df.copy()
+                df['sender'] = sender
+                frames.append(df)
+        if not frames and not summaries:
             return None
+        
+        tmp_path = f"{output_path}.tmp"
+        if params['format'] == 'json':
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(summaries, f, ensure_ascii=False, indent=2, default=str)
+        elif params['format'] == 'jsonl':
+            pd.concat(frames, ignore_index=True).to_json(
+                tmp_path, orient='records', lines=True, date_format='iso', force_ascii=False)
+        else:
+            pd.concat(frames, ignore_index=True).to_csv(tmp_path, index=False)
+        os.replace(tmp_path, output_path)
+        return output_path
 
-    def parse_date_without_warning(self, date_str):
-        """警告を発生させないで日付文字列をパースする補助関数"""
-        # クラス外でも使える静的メソッド
+
+def create_app(job_queue=None, **queue_kwargs):
+    """分析ジョブを受け付けるFlaskアプリを作成する
+
+    POST /jobs でジョブを登録し（{"senders": [...], "since": "YYYY-MM-DD", "until": ..., "format": "pdf"}）、
+    GET /jobs/<id> で状態、GET /jobs/<id>/artifact で成果物を取得する。
+    job_queue を省略した場合は queue_kwargs で ReportJobQueue を作成して起動する
+    （analyzer_factory を差し替えればテスト用のGmailに接続できる）。
+    """
+    from flask import Flask, jsonify, request, send_file, url_for
+    
+    if job_queue is None:
+        job_queue = ReportJobQueue(**queue_kwargs)
+    job_queue.start()
+    
+    app = Flask(__name__)
+    app.config['JOB_QUEUE'] = job_queue
+    
+    def job_response(job):
+        body = {key: job[key] for key in ('id', 'status', 'params', 'created', 'started', 'finished',
+                                          'failed_senders', 'error')}
+        body['url'] = url_for('get_job', job_id=job['id'], _external=True)
+        if job['status'] == 'done':
+            body['artifact_url'] = url_for('get_artifact', job_id=job['id'], _external=True)
+        return body
+    
+    @app.post('/jobs')
+    def submit_job():
+        params = request.get_json(silent=True)
+        if not isinstance(params, dict):
+            return jsonify({'error': 'JSONオブジェクトを送信してください'}), 400
         try:
-            # JSTを含む場合
-            if isinstance(date_str, str) and 'JST' in date_str:
-                # JSTを削除
-                clean_date_str = date_str.replace('JST', '').strip()
-                # タイムゾーン情報なしでパース
-                date_obj = pd.to_datetime(clean_date_str, errors='coerce')
-                if not pd.isna(date_obj):
-                    # 明示的に日本時間のタイムゾーンを設定
-                    date_obj = date_obj.tz_localize('Asia/Tokyo')
-                return date_obj
-            else:
-                # 通常のパース
-                return pd.to_datetime(date_str, errors='coerce')
-        except:
-            return pd.NaT  # Not a Time を返す
+            job, created = job_queue.submit(params)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except queue.Full:
+            return jsonify({'error': 'ジョブが混み合っています。しばらくしてから再送してください'}), 503, {'Retry-After': '30'}
+        headers = {'Location': url_for('get_job', job_id=job['id'])}
+        return jsonify(job_response(job)), 202 if created else 200, headers
+    
+    @app.get('/jobs/<job_id>')
+    def get_job(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'ジョブが見つかりません'}), 404
+        return jsonify(job_response(job))
+    
+    @app.get('/jobs/<job_id>/artifact')
+    def get_artifact(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'ジョブが見つかりません'}), 404
+        if job['status'] != 'done':
+            return jsonify({'error': f"ジョブは完了していません（{job['status']}）"}), 409
+        return send_file(os.path.abspath(job['artifact']), as_attachment=True,
+                         download_name=os.path.basename(job['artifact']))
+    
+    @app.get('/health')
+    def health():
+        return jsonify(job_queue.stats())
+    
+    return app
 
-    def generate_insights_with_claude(self, df, sender_email):
-        """Claudeを使用してデータに基づいた考察を生成する（詳細版）"""
+
+def _current_rss_mb():
+    """現在のプロセスのメモリ使用量（MB、取得できない場合はNone）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:  # Windowsの場合
+        return None
+    # /proc がない場合は最大使用量で代用（macOSはバイト、それ以外はKB単位）
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+def _default_worker_analyzer(credentials_path='credentials.json', token_path='token.json', **analyzer_kwargs):
+    """ワーカープロセス用のアナライザー（トークンファイルで認証し、ブラウザは開かない）"""
+    analyzer = GmailAnalyzer(**analyzer_kwargs)
+    if not analyzer.authenticate(credentials_path, token_path, interactive=False):
+        raise AuthenticationError(f"有効なトークンがありません: {token_path}")
+    return analyzer
+
+def _warm_worker_main(conn, analyzer_factory, max_jobs, max_rss_mb):
+    """常駐ワーカープロセスの本体
+
+    初期化（アナライザーの作成・認証・warm_up）を一度だけ行い、親プロセスから
+    ジョブを1件ずつ受け取って処理する。処理件数かメモリ使用量が上限を超えたら
+    交代を通知して終了する。
+    """
+    try:
+        started = time.time()
+        analyzer = analyzer_factory()
+        analyzer.warm_up()
+    except Exception as e:
+        conn.send(('failed', f"{type(e).__name__}: {e}"))
+        return
+    conn.send(('ready', os.getpid(), time.time() - started))
+    
+    jobs = 0
+    while True:
         try:
-            # APIキーの取得（環境変数から、または設定ファイルから）
-            api_key = os.environ.get("ANTHROPIC_API_KEY")
-            if not api_key:
-                print("Claude APIキーが設定されていません。環境変数 ANTHROPIC_API_KEY を設定してください。")
-                return self._get_default_insights()
-            
-            # データの準備（Claudeに送信するデータを構造化）
-            data_summary = self._prepare_data_for_claude(df, sender_email)
-            
-            # Claudeクライアントの初期化
-            client = anthropic.Anthropic(api_key=api_key)
-            
-            # プロンプトの作成（より詳細な考察を求めるように改善）
-            prompt = f"""
-あなたはメール分析の専門家です。以下のGmailの送信データに基づいて、具体的で実用的な考察と改善提案を提供してください。
-データを詳細に分析し、送信者が効果的なメール戦略を立てるための具体的なアドバイスを5つ提供してください。
-各考察は簡潔かつ具体的に、実行可能な提案を含めてください。
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        task_id, sender_email, output_path, fetch_kwargs = task
+        path = error = None
+        try:
+            df = analyzer.analyze_emails_from_sender(sender_email, **fetch_kwargs)
+            if df.empty:
+                raise ValueError(f"メールが見つかりませんでした: {sender_email}")
+            path = analyzer.generate_comprehensive_pdf_report(df, sender_email, output_path=output_path)
+            if path is None:
+                raise RuntimeError(f"レポートを作成できませんでした: {sender_email}")
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        df = None
+        jobs += 1
+        
+        # 長時間動かすとグラフの状態がたまるため、上限を超えたら新しいプロセスと交代する
+        # （次のジョブを渡されないように完了の通知と一緒に伝える）
+        with _pyplot_lock:
+            plt.close('all')
+        rss = _current_rss_mb()
+        retiring = (max_jobs and jobs >= max_jobs) or (max_rss_mb and rss is not None and rss > max_rss_mb)
+        conn.send(('done', task_id, path, error, (jobs, rss) if retiring else None))
+        if retiring:
+            break
 
-{data_summary}
 
-考察と提案を箇条書きで5つ提供してください。各項目は50-70文字程度の簡潔な内容にしてください。
-以下のフォーマットで回答してください：
+class WarmWorkerPool:
+    """初期化済みのワーカープロセスでレポートを作成する
 
-1. [具体的な考察]: [実行可能な提案]
-2. [具体的な考察]: [実行可能な提案]
-...
+    各ワーカーは起動時に一度だけライブラリの読み込み・フォントの解析・グラフ描画の準備・
+    Gmail APIの接続を行い、以降はジョブごとの取得・描画・PDF作成だけを行う。
+    max_jobs_per_worker 件処理したか、メモリ使用量が max_rss_mb を超えたワーカーは
+    終了し、新しいワーカーに置き換える（交代中も他のワーカーは処理を続ける）。
 
-回答は日本語でお願いします。
-"""
-            
-            # Claudeに送信して回答を取得
+    analyzer_factory を指定する場合は、ワーカープロセスに渡せるようにモジュールの
+    トップレベルの関数（または functools.partial）にする。
+    """
+
+    def __init__(self, workers=2, max_jobs_per_worker=50, max_rss_mb=1024, analyzer_factory=None,
+                 credentials_path='credentials.json', token_path='token.json', start_method='spawn',
+                 **analyzer_kwargs):
+        import multiprocessing
+        
+        self.workers = workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_rss_mb = max_rss_mb
+        self.analyzer_factory = analyzer_factory or functools.partial(
+            _default_worker_analyzer, credentials_path, token_path, **analyzer_kwargs)
+        # スレッドを使う処理と共存できるようにデフォルトはspawnで起動
+        self._context = multiprocessing.get_context(start_method)
+        # ワーカーID -> {'process', 'conn', 'ready', 'task', 'initialized'}（task は処理中のジョブ）
+        self._workers = {}
+        self._pending = deque()  # ワーカーに渡していないジョブ
+        self._futures = {}  # ジョブID -> Future
+        self._next_worker_id = 0
+        self._next_task_id = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._collector = None
+        self.stats = Counter()
+        self.init_times = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def start(self):
+        """ワーカープロセスと結果を受け取るスレッドを起動する"""
+        with self._lock:
+            while len(self._workers) < self.workers:
+                self._spawn_worker()
+        if self._collector is None:
+            self._collector = threading.Thread(target=self._collect_results, name='warm-pool-results', daemon=True)
+            self._collector.start()
+        return self
+
+    def _spawn_worker(self):
+        """ワーカープロセスを1つ起動する（ロック内で呼び出す）"""
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_warm_worker_main, name=f"warm-worker-{worker_id}", daemon=True,
+            args=(child_conn, self.analyzer_factory, self.max_jobs_per_worker, self.max_rss_mb))
+        process.start()
+        child_conn.close()
+        self._workers[worker_id] = {'process': process, 'conn': parent_conn, 'ready': False, 'task': None,
+                                    'initialized': False}
+        self.stats['spawned'] += 1
+
+    def submit(self, sender_email, output_path=None, **fetch_kwargs):
+        """送信者1人分のレポート作成を登録し、PDFのパスを返すFutureを返す"""
+        from concurrent.futures import Future
+        
+        if self._closed:
+            raise RuntimeError("ワーカープールは停止しています")
+        if self._collector is None:
+            self.start()
+        future = Future()
+        with self._lock:
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            self._futures[task_id] = future
+            self._pending.append((task_id, sender_email, output_path, fetch_kwargs))
+            sends = self._dispatch()
+        self._send(sends)
+        return future
+
+    def generate_reports(self, senders, output_dir='.', **fetch_kwargs):
+        """複数の送信者のレポートを作成して {送信者: PDFのパス（失敗した場合はNone）} を返す"""
+        os.makedirs(output_dir, exist_ok=True)
+        futures = {}
+        for sender in senders:
+            output_path = os.path.join(output_dir, f"gmail_analysis_{_safe_filename(sender)}.pdf")
+            futures[sender] = self.submit(sender, output_path=output_path, **fetch_kwargs)
+        
+        results = {}
+        for sender, future in futures.items():
             try:
-                message = client.messages.create(
-                    model="claude-3-haiku-20240307",
-                    max_tokens=1000,
-                    temperature=0.7,
-                    system="あなたはメール分析の専門家です。データに基づいた具体的で実用的な考察と改善提案を提供してください。",
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-                
-                # 回答からインサイトを抽出
-                response = message.content[0].text
-                print("Claude API応答:", response[:100] + "...")
-                
-                # 回答を行ごとに分割して整形
-                insights = []
-                for line in response.strip().split('\n'):
-                    line = line.strip()
-                    if re.match(r'^\d+\.', line):  # 番号付きの行のみを抽出
-                        insights.append(line)
-                
-                # インサイトが取得できなかった場合はデフォルトを使用
-                if not insights:
-                    print("Claude APIからの考察を抽出できませんでした。デフォルトの考察を使用します。")
-                    return self._get_default_insights()
-                
-                return insights
-                
-            except Exception as api_error:
-                print(f"Claude API呼び出しエラー: {api_error}")
-                return self._get_default_insights()
-            
-        except Exception as e:
-            print(f"考察生成エラー: {e}")
-            return self._get_default_insights()
+                results[sender] = future.result()
+            except Exception as e:
+                print(f"{sender}: レポート作成エラー: {e}")
+                results[sender] = None
+        return results
 
-    def _get_default_insights(self):
-        """デフォルトの考察を返す（APIが利用できない場合など）- 簡潔版"""
-        return [
-            "1. 最適送信時間の活用: 朝9時台と夕方17-18時台に送信し開封率向上",
-            "2. 曜日最適化: 火-木曜日は開封率高く、月曜は埋もれやすい傾向",
-            "3. コンテンツ調整: 朝は簡潔、昼はビジュアル、夕方は詳細情報を提供",
-            "4. セグメント配信: 「朝型」「夜型」ユーザー別に最適時間帯で配信",
-            "5. A/Bテスト実施: 異なる時間帯で送信し開封率・クリック率を比較"
-        ]
+    def _dispatch(self):
+        """空いているワーカーに待機中のジョブを割り当てる（ロック内で呼び出す）
 
-    def _prepare_data_for_claude(self, df, sender_email):
-        """Claudeに送信するデータを準備する（インデックスエラー修正版）"""
-        # 基本統計情報
-        total_emails = len(df)
-        date_range = f"{df['date'].min().strftime('%Y-%m-%d')} から {df['date'].max().strftime('%Y-%m-%d')}"
-        
-        # 時間帯別の分布
-        hourly_counts = df['hour'].value_counts().sort_index()
-        peak_hour = hourly_counts.idxmax()
-        peak_hour_count = hourly_counts.max()
-        peak_hour_percentage = (peak_hour_count / total_emails) * 100
-        
-        # 曜日別の分布（エラー修正）
-        weekday_counts = df['weekday'].value_counts().sort_index()
-        weekday_names = ['月曜日', '火曜日', '水曜日', '木曜日', '金曜日', '土曜日', '日曜日']
-        
-        # エラー修正: peak_weekday_idxが文字列の場合の対応
-        peak_weekday_idx = weekday_counts.idxmax()
-        
-        # インデックスの型を確認して適切に処理
-        if isinstance(peak_weekday_idx, str):
-            # 文字列の場合は直接曜日名として使用
-            peak_weekday = peak_weekday_idx
-        elif isinstance(peak_weekday_idx, (int, np.integer)) and 0 <= peak_weekday_idx < len(weekday_names):
-            # 整数の場合はweekday_namesから取得
-            peak_weekday = weekday_names[peak_weekday_idx]
+        送信する (ワーカーID, ワーカー, メッセージ) のリストを返す。パイプへの送信は
+        ブロックすることがあるため、ロックの外で _send に渡す。
+        """
+        sends = []
+        for worker_id, worker in self._workers.items():
+            if not worker['ready'] or worker['task'] is not None:
+                continue
+            if self._pending:
+                task = self._pending.popleft()
+                worker['task'] = task[0]
+                sends.append((worker_id, worker, task))
+            elif self._closed:
+                # 停止時は待機中のジョブがなくなったワーカーから終了させる
+                worker['ready'] = False
+                sends.append((worker_id, worker, None))
+        return sends
+
+    def _send(self, sends):
+        """_dispatch で割り当てたメッセージをワーカーに送る（ロックの外で呼び出す）
+
+        パイプが切れていたワーカーは新しいワーカーに置き換え、送れなかったジョブは
+        待機中に戻して他のワーカーに割り当て直す。
+        """
+        while sends:
+            broken = []
+            for worker_id, worker, task in sends:
+                try:
+                    worker['conn'].send(task)
+                except (OSError, EOFError) as e:
+                    print(f"ワーカー{worker_id}に送信できませんでした（{type(e).__name__}）: ワーカーを置き換えます")
+                    broken.append((worker_id, worker, task))
+            if not broken:
+                break
+            with self._lock:
+                for worker_id, worker, task in broken:
+                    if task is not None:
+                        worker['task'] = None
+                        self._pending.appendleft(task)
+                    if self._workers.pop(worker_id, None) is not None:
+                        self.stats['replaced'] += 1
+                        if not self._closed:
+                            self._spawn_worker()
+                sends = self._dispatch()
+            for _, worker, _ in broken:
+                # パイプが切れたワーカーは通常すでに終了している（残っている場合は強制終了する）
+                # 接続は結果を受け取るスレッドが参照している場合があるため、ここでは閉じない
+                worker['process'].join(1)
+                if worker['process'].is_alive():
+                    worker['process'].terminate()
+                    worker['process'].join()
+
+    def _collect_results(self):
+        """ワーカーからの通知を受け取り、Futureの完了とワーカーの交代を行う"""
+        from multiprocessing.connection import wait
+        
+        while True:
+            with self._lock:
+                if self._closed and not self._workers:
+                    break
+                workers = list(self._workers.items())
+            handles = [worker['conn'] for _, worker in workers] + [worker['process'].sentinel for _, worker in workers]
+            wait(handles, timeout=0.5)
+            
+            for worker_id, worker in workers:
+                # 終了したワーカーも、最後に送った通知を先に受け取ってから片付ける
+                exited = not worker['process'].is_alive()
+                try:
+                    while worker['conn'].poll():
+                        self._handle_message(worker_id, worker, worker['conn'].recv())
+                except (EOFError, OSError):
+                    exited = True
+                if exited:
+                    with self._lock:
+                        crashed = self._reap_worker(worker_id, worker)
+                    if crashed:
+                        self._fail_all(f"ワーカーが初期化中に終了しました（終了コード {worker['process'].exitcode}）")
+            with self._lock:
+                sends = self._dispatch()
+            self._send(sends)
+
+    def _handle_message(self, worker_id, worker, message):
+        kind = message[0]
+        if kind == 'ready':
+            self.init_times.append(message[2])
+            with self._lock:
+                worker['ready'] = worker['initialized'] = True
+        elif kind == 'done':
+            task_id, path, error, retiring = message[1:]
+            with self._lock:
+                worker['task'] = None
+                if retiring:
+                    worker['ready'] = False
+                future = self._futures.pop(task_id, None)
+            self.stats['failed' if error else 'completed'] += 1
+            if future is not None:
+                if error:
+                    future.set_exception(RuntimeError(error))
+                else:
+                    future.set_result(path)
+            if retiring:
+                self.stats['recycled'] += 1
+                jobs, rss = retiring
+                rss = f"{rss:.0f}MB" if rss is not None else '不明'
+                print(f"ワーカー{worker_id}を交代します（{jobs}件処理、メモリ {rss}）")
+        elif kind == 'failed':
+            print(f"ワーカー{worker_id}の初期化エラー: {message[1]}")
+            self._fail_all(f"ワーカーの初期化に失敗しました: {message[1]}")
+
+    def _fail_all(self, reason):
+        """初期化に失敗した場合は置き換えても同じ結果になるため、待機中のジョブをすべて失敗にする"""
+        self.stats['init_failed'] += 1
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.set_exception(RuntimeError(reason))
+
+    def _reap_worker(self, worker_id, worker):
+        """終了したワーカーを片付け、必要なら新しいワーカーを起動する（ロック内で呼び出す）
+
+        初期化を終えないまま終了した場合は起動し直さずにTrueを返す。
+        """
+        if self._workers.pop(worker_id, None) is None:
+            return False
+        worker['process'].join()
+        worker['conn'].close()
+        if worker['task'] is not None:
+            # 処理中に異常終了した（メモリ不足で強制終了された場合など）
+            future = self._futures.pop(worker['task'], None)
+            if future is not None:
+                self.stats['failed'] += 1
+                future.set_exception(RuntimeError(
+                    f"ワーカーが異常終了しました（終了コード {worker['process'].exitcode}）"))
+        if self._closed:
+            return False
+        if not worker['initialized']:
+            return True
+        self._spawn_worker()
+        return False
+
+    def shutdown(self, wait=True):
+        """登録済みのジョブを処理し終えたらワーカーを停止する"""
+        with self._lock:
+            self._closed = True
+            sends = self._dispatch()
+        self._send(sends)
+        if wait and self._collector is not None:
+            self._collector.join()
+        print(f"ワーカープールを停止しました（完了 {self.stats['completed']}件、失敗 {self.stats['failed']}件、"
+              f"交代 {self.stats['recycled']}回）")
+
+
+# BigQuery用の出力のスキーマ（列の順序・型は固定。変更する場合は EXPORT_SCHEMA_VERSION を上げる）
+EXPORT_SCHEMA_VERSION = 1
+MESSAGE_EXPORT_SCHEMA = [
+    {'name': 'sender', 'type': 'STRING', 'mode': 'REQUIRED', 'description': '分析対象の送信者'},
+    {'name': 'account', 'type': 'STRING', 'mode': 'NULLABLE', 'description': '取得したGmailアカウント（複数アカウントの場合）'},
+    {'name': 'message_id', 'type': 'STRING', 'mode': 'REQUIRED', 'description': 'GmailのメッセージID'},
+    {'name': 'thread_id', 'type': 'STRING', 'mode': 'NULLABLE', 'description': 'GmailのスレッドID'},
+    {'name': 'sent_at', 'type': 'TIMESTAMP', 'mode': 'REQUIRED', 'description': '送信日時（UTC）'},
+    {'name': 'sent_date', 'type': 'DATE', 'mode': 'REQUIRED', 'description': '送信日（日本時間、パーティション列）'},
+    {'name': 'weekday', 'type': 'STRING', 'mode': 'NULLABLE', 'description': '曜日（日本時間、英語表記）'},
+    {'name': 'hour', 'type': 'INT64', 'mode': 'NULLABLE', 'description': '時（日本時間、0〜23）'},
+    {'name': 'subject', 'type': 'STRING', 'mode': 'NULLABLE', 'description': '件名'},
+    {'name': 'from_header', 'type': 'STRING', 'mode': 'NULLABLE', 'description': 'Fromヘッダー'},
+    {'name': 'to_header', 'type': 'STRING', 'mode': 'NULLABLE', 'description': 'Toヘッダー'},
+    {'name': 'snippet', 'type': 'STRING', 'mode': 'NULLABLE', 'description': 'スニペット'},
+    {'name': 'body', 'type': 'STRING', 'mode': 'NULLABLE', 'description': '本文（text_mode="body" の場合のみ）'},
+    {'name': 'content_length', 'type': 'INT64', 'mode': 'NULLABLE', 'description': '本文の文字数'},
+    {'name': 'fetch_error', 'type': 'BOOL', 'mode': 'REQUIRED', 'description': '取得に失敗したメッセージ（日時は取得時刻）'},
+    {'name': 'exported_at', 'type': 'TIMESTAMP', 'mode': 'REQUIRED', 'description': '出力日時（UTC）'},
+]
+AGGREGATE_EXPORT_SCHEMA = [
+    {'name': 'snapshot_date', 'type': 'DATE', 'mode': 'REQUIRED', 'description': '集計日（パーティション列）'},
+    {'name': 'sender', 'type': 'STRING', 'mode': 'REQUIRED', 'description': '分析対象の送信者'},
+    {'name': 'dimension', 'type': 'STRING', 'mode': 'REQUIRED',
+     'description': '集計の単位（hour / weekday / month / weekday_hour）'},
+    {'name': 'bucket', 'type': 'INT64', 'mode': 'REQUIRED',
+     'description': '区分（hour: 0〜23, weekday: 0=月曜日, month: 1〜12, weekday_hour: 曜日×24+時）'},
+    {'name': 'message_count', 'type': 'INT64', 'mode': 'REQUIRED', 'description': '件数（抽出取得の場合は抽出した件数）'},
+    {'name': 'total_messages', 'type': 'INT64', 'mode': 'REQUIRED', 'description': '送信者の総件数'},
+    {'name': 'period_start', 'type': 'DATE', 'mode': 'NULLABLE', 'description': '分析期間の開始日'},
+    {'name': 'period_end', 'type': 'DATE', 'mode': 'NULLABLE', 'description': '分析期間の終了日'},
+    {'name': 'sample_size', 'type': 'INT64', 'mode': 'NULLABLE', 'description': '抽出件数（全件取得の場合はNULL）'},
+    {'name': 'population', 'type': 'INT64', 'mode': 'NULLABLE', 'description': '抽出元の件数（全件取得の場合はNULL）'},
+    {'name': 'exported_at', 'type': 'TIMESTAMP', 'mode': 'REQUIRED', 'description': '出力日時（UTC）'},
+]
+EXPORT_FORMATS = {'parquet': '.parquet', 'ndjson': '.ndjson'}
+
+
+def _arrow_schema(schema):
+    """BigQueryのスキーマ定義からParquet出力用のpyarrowのスキーマを作る"""
+    import pyarrow as pa
+    types = {'STRING': pa.string(), 'INT64': pa.int64(), 'BOOL': pa.bool_(), 'DATE': pa.date32(),
+             'TIMESTAMP': pa.timestamp('us', tz='UTC')}
+    return pa.schema([pa.field(field['name'], types[field['type']], nullable=field['mode'] != 'REQUIRED')
+                      for field in schema])
+
+
+class _PartitionedFiles:
+    """パーティション（日付）ごとのファイルに行を追記する
+
+    開いておくファイル数は max_open_files までに抑え、超えた場合は最も長く使っていない
+    ファイルを閉じる。NDJSONは同じファイルに追記し直し、Parquetは追記できないため
+    次のパートファイルを作る。書き込み中のファイルは .tmp で、閉じた時点で名前を変える。
+    """
+
+    def __init__(self, root, table, schema, output_format, max_open_files=64):
+        self.root = Path(root)
+        self.table = table
+        self.schema = schema
+        self.output_format = output_format
+        self.max_open_files = max_open_files
+        self._open = {}  # パーティション -> (ファイルまたはParquetWriter, パス)（挿入順＝使用順）
+        self._parts = Counter()
+        self.files = []
+        self.rows = 0
+        if output_format == 'parquet':
+            self._arrow_schema = _arrow_schema(schema)
+
+    def write(self, partition, frame):
+        """1つのパーティションの行（スキーマどおりの列を持つDataFrame）を書き込む"""
+        if partition in self._open:
+            # 最近使ったものとして末尾に移す
+            self._open[partition] = self._open.pop(partition)
         else:
-            # その他の場合は不明として処理
-            peak_weekday = "不明"
-        
-        peak_weekday_count = weekday_counts.max()
-        peak_weekday_percentage = (peak_weekday_count / total_emails) * 100
-        
-        # 月別の分布
-        df['month'] = df['date'].dt.month
-        monthly_counts = df['month'].value_counts().sort_index()
-        month_names = ['1月', '2月', '3月', '4月', '5月', '6月', '7月', '8月', '9月', '10月', '11月', '12月']
-        
-        # エラー修正: peak_month_idxが文字列の場合の対応
-        peak_month_idx = monthly_counts.idxmax()
-        
-        # インデックスの型を確認して適切に処理
-        if isinstance(peak_month_idx, str):
-            # 文字列の場合は直接月名として使用
-            peak_month = peak_month_idx
-        elif isinstance(peak_month_idx, (int, np.integer)) and 1 <= peak_month_idx <= 12:
-            # 整数の場合はmonth_namesから取得（1-indexedを0-indexedに調整）
-            peak_month = month_names[peak_month_idx - 1]
+            while len(self._open) >= self.max_open_files:
+                self._close(next(iter(self._open)))
+            self._open[partition] = self._open_file(partition)
+        handle, _ = self._open[partition]
+        
+        if self.output_format == 'parquet':
+            import pyarrow as pa
+            handle.write_table(pa.Table.from_pandas(frame, schema=self._arrow_schema, preserve_index=False))
         else:
-            # その他の場合は不明として処理
-            peak_month = "不明"
+            handle.write(self._to_ndjson(frame))
+        self.rows += len(frame)
+
+    def _open_file(self, partition):
+        directory = self.root / self.output_format / self.table / partition
+        directory.mkdir(parents=True, exist_ok=True)
+        if self.output_format == 'parquet':
+            import pyarrow.parquet as pq
+            path = directory / f"part-{self._parts[partition]:05d}.parquet"
+            self._parts[partition] += 1
+            return pq.ParquetWriter(f"{path}.tmp", self._arrow_schema, compression='snappy'), path
+        path = directory / 'part-00000.ndjson'
+        if self._parts[partition]:
+            # 一度閉じたファイルは名前を変えずに追記する
+            return open(path, 'a', encoding='utf-8'), path
+        self._parts[partition] += 1
+        return open(f"{path}.tmp", 'w', encoding='utf-8'), path
+
+    def _to_ndjson(self, frame):
+        """BigQueryが読み込める形式（DATEは YYYY-MM-DD、TIMESTAMPはUTCのISO 8601）の行にする"""
+        frame = frame.copy()
+        for field in self.schema:
+            column = frame[field['name']]
+            if field['type'] == 'TIMESTAMP':
+                frame[field['name']] = column.dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            elif field['type'] == 'DATE':
+                frame[field['name']] = column.map(lambda d: None if pd.isna(d) else d.isoformat())
+        text = frame.to_json(orient='records', lines=True, force_ascii=False)
+        return text if text.endswith('\n') else text + '\n'
+
+    def _close(self, partition):
+        handle, path = self._open.pop(partition)
+        handle.close()
+        if os.path.exists(f"{path}.tmp"):
+            os.replace(f"{path}.tmp", path)
+        relative = path.relative_to(self.root).as_posix()
+        if relative not in self.files:
+            self.files.append(relative)
+
+    def close(self):
+        """開いているファイルをすべて閉じて、作成したファイルの一覧を返す"""
+        for partition in list(self._open):
+            self._close(partition)
+        self.files.sort()
+        return self.files
+
+
+class BigQueryExportWriter:
+    """送信者ごとのメールと集計値を、BigQueryに読み込める形式で1人ずつ書き出す
+
+    messages（メール1通1行、送信日ごと）と aggregates（集計値、集計日ごと）の2つの表を
+    出力先/形式/表/日付/ のディレクトリに分けて保存する。各送信者のデータは chunk_size 行ずつ
+    変換して書き込むため、全体をメモリに溜め込まない。close() でスキーマ定義
+    （schema/*.json、`bq load --schema` 形式）と manifest.json を書き出す。
+    同じ出力先に以前の出力がある場合は、書き込む前にこのクラスが作るファイルを削除する
+    （古いパートファイルが新しい出力に混ざらないようにする）。
+    """
+
+    def __init__(self, analyzer, output_dir, formats=('parquet', 'ndjson'), partition='day', chunk_size=10000,
+                 max_open_files=64):
+        import importlib.util
         
-        peak_month_count = monthly_counts.max()
-        peak_month_percentage = (peak_month_count / total_emails) * 100
+        if partition not in ('day', 'month'):
+            raise ValueError(f"未対応のパーティション単位です: {partition}")
+        formats = [f for f in formats if f in EXPORT_FORMATS] or ['ndjson']
+        if 'parquet' in formats and importlib.util.find_spec('pyarrow') is None:
+            print("警告: pyarrowがインストールされていないため、Parquetは出力しません（pip install pyarrow）")
+            formats = [f for f in formats if f != 'parquet'] or ['ndjson']
         
-        # 時間帯×曜日のヒートマップデータ
-        try:
-            heatmap_data = df.groupby(['weekday', 'hour']).size().unstack(fill_value=0)
-            best_hour_weekday = np.unravel_index(np.argmax(heatmap_data.values), heatmap_data.shape)
-            
-            # エラー修正: インデックスの型を確認して適切に処理
-            best_weekday_idx = best_hour_weekday[0]
-            if isinstance(best_weekday_idx, (int, np.integer)) and 0 <= best_weekday_idx < len(weekday_names):
-                best_weekday = weekday_names[best_weekday_idx]
-            else:
-                best_weekday = "不明"
-            
-            best_hour = best_hour_weekday[1]
-            best_combo_count = heatmap_data.values[best_hour_weekday]
-            best_combo_percentage = (best_combo_count / total_emails) * 100
-        except Exception as e:
-            print(f"ヒートマップデータ処理エラー: {e}")
-            best_weekday = "不明"
-            best_hour = "不明"
-            best_combo_count = 0
-            best_combo_percentage = 0
-        
-        # 季節的なパターン
-        df['season'] = df['date'].dt.month.apply(lambda m: '春' if 3 <= m <= 5 else '夏' if 6 <= m <= 8 else '秋' if 9 <= m <= 11 else '冬')
-        season_counts = df['season'].value_counts()
-        peak_season = season_counts.idxmax()
-        peak_season_count = season_counts.max()
-        peak_season_percentage = (peak_season_count / total_emails) * 100
-        
-        # 連続した日のパターン
+        self.analyzer = analyzer
+        self.output_dir = Path(output_dir)
+        self.formats = formats
+        self.partition = partition
+        self.chunk_size = chunk_size
+        self.exported_at = pd.Timestamp.now(tz='UTC')
+        self.snapshot_date = self.exported_at.tz_convert('Asia/Tokyo').date()
+        self.senders = []
+        self.failed = []
+        self.result = None
+        self._clear_previous_export()
+        self._writers = {
+            (table, output_format): _PartitionedFiles(self.output_dir, table, schema, output_format, max_open_files)
+            for table, schema in (('messages', MESSAGE_EXPORT_SCHEMA), ('aggregates', AGGREGATE_EXPORT_SCHEMA))
+            for output_format in formats
+        }
+
+    def _clear_previous_export(self):
+        """出力先にある以前の出力（形式ごとのディレクトリ・schema・manifest.json）を削除する"""
+        for name in [*EXPORT_FORMATS, 'schema']:
+            path = self.output_dir / name
+            if path.is_dir():
+                shutil.rmtree(path)
         try:
-            df_sorted = df.sort_values('date')
-            df_sorted['prev_date'] = df_sorted['date'].shift(1)
-            df_sorted['days_since_last'] = (df_sorted['date'] - df_sorted['prev_date']).dt.days
-            avg_days_between = df_sorted['days_since_last'].mean()
-        except Exception as e:
-            print(f"送信間隔計算エラー: {e}")
-            avg_days_between = 0
-        
-        # データサマリーの作成
-        data_summary = f"""
-基本情報:
-- 送信者: {sender_email}
-- 総メール数: {total_emails}
-- 分析期間: {date_range}
+            (self.output_dir / 'manifest.json').unlink()
+        except FileNotFoundError:
+            pass
 
-時間帯別分析:
-- 最も送信が多い時間帯: {peak_hour}時 ({peak_hour_count}件, 全体の{peak_hour_percentage:.1f}%)
-- 時間帯別送信数: {', '.join([f"{h}時: {c}件" for h, c in hourly_counts.items()])}
+    def _partition_key(self, dates):
+        """DATE列からパーティションのディレクトリ名（YYYY-MM-DD または YYYY-MM）を作る"""
+        return dates.map(lambda d: d.strftime('%Y-%m-%d' if self.partition == 'day' else '%Y-%m'))
 
-曜日別分析:
-- 最も送信が多い曜日: {peak_weekday} ({peak_weekday_count}件, 全体の{peak_weekday_percentage:.1f}%)
-- 曜日別送信数: {', '.join([f"{w}: {c}件" for w, c in weekday_counts.items()])}
+    def _message_rows(self, chunk, sender_email):
+        """分析用のDataFrameの一部をmessages表のスキーマに変換する"""
+        chunk = chunk.reset_index(drop=True)
+        dates = pd.to_datetime(chunk['date'], errors='coerce')
+        column = lambda name: chunk[name] if name in chunk.columns else None
+        
+        rows = pd.DataFrame({
+            'sender': sender_email,
+            'account': column('account'),
+            'message_id': chunk['message_id'].astype(str),
+            'thread_id': column('thread_id'),
+            # 分析用の日時は日本時間（タイムゾーンなし）なので、UTCに直して保存する
+            'sent_at': dates.dt.tz_localize('Asia/Tokyo', ambiguous='NaT',
+                                            nonexistent='shift_forward').dt.tz_convert('UTC'),
+            'sent_date': dates.dt.date,
+            'weekday': column('weekday'),
+            'hour': column('hour'),
+            'subject': column('subject'),
+            'from_header': column('from'),
+            'to_header': column('to'),
+            'snippet': column('snippet'),
+            'body': column('body'),
+            'content_length': column('content_length'),
+            'fetch_error': chunk['weekday'].eq('Unknown') if 'weekday' in chunk.columns else False,
+            'exported_at': self.exported_at,
+        })
+        rows['hour'] = rows['hour'].astype('Int64')
+        rows['content_length'] = rows['content_length'].astype('Int64')
+        # 日時を解釈できない行はパーティションに入れられないため除く
+        return rows[rows['sent_at'].notna() & rows['sent_date'].notna()]
 
-月別・季節分析:
-- 最も送信が多い月: {peak_month} ({peak_month_count}件, 全体の{peak_month_percentage:.1f}%)
-- 最も送信が多い季節: {peak_season} ({peak_season_count}件, 全体の{peak_season_percentage:.1f}%)
+    def _aggregate_rows(self, df, sender_email, aggregates):
+        """集計値を aggregates 表の行（区分ごとに1行）にする"""
+        dates = pd.to_datetime(df['date'], errors='coerce').dropna()
+        sampling = aggregates['sampling'] or {}
+        rows = []
+        buckets = [('hour', enumerate(aggregates['hourly'])),
+                   ('weekday', enumerate(aggregates['weekday'])),
+                   ('month', enumerate(aggregates['monthly'], 1)),
+                   ('weekday_hour', ((day * 24 + hour, count) for day, counts in enumerate(aggregates['heatmap'])
+                                     for hour, count in enumerate(counts)))]
+        for dimension, counts in buckets:
+            for bucket, count in counts:
+                rows.append({'dimension': dimension, 'bucket': bucket, 'message_count': int(count)})
+        frame = pd.DataFrame(rows)
+        frame.insert(0, 'snapshot_date', self.snapshot_date)
+        frame.insert(1, 'sender', sender_email)
+        frame['total_messages'] = len(df)
+        frame['period_start'] = dates.min().date() if not dates.empty else None
+        frame['period_end'] = dates.max().date() if not dates.empty else None
+        frame['sample_size'] = pd.array([sampling.get('sample_size')] * len(frame), dtype='Int64')
+        frame['population'] = pd.array([sampling.get('population')] * len(frame), dtype='Int64')
+        frame['exported_at'] = self.exported_at
+        return frame
 
-最適な組み合わせ:
-- 最も送信が多い時間帯×曜日の組み合わせ: {best_weekday}の{best_hour}時 ({best_combo_count}件, 全体の{best_combo_percentage:.1f}%)
+    def _write(self, table, partitions, frame):
+        """行をパーティションに分けて、出力形式ごとのファイルに書き込む"""
+        for output_format in self.formats:
+            writer = self._writers[(table, output_format)]
+            for partition, group in frame.groupby(partitions, sort=True):
+                writer.write(partition, group)
 
-送信頻度:
-- 平均送信間隔: {avg_days_between:.1f}日
-"""
+    def add_sender(self, df, sender_email, aggregates=None):
+        """送信者1人分のメールと集計値を書き込む（失敗した送信者は記録してスキップ）"""
+        if df is None or df.empty:
+            print(f"{sender_email}: データがないためスキップします")
+            self.failed.append(sender_email)
+            return False
         
-        return data_summary
-
-    def _create_monthly_distribution_plot(self, df, figsize=(10, 6)):
-        """月別分布グラフを作成"""
         try:
-            # 日付データの準備
-            df['month'] = pd.to_datetime(df['date']).dt.month
-            
-            # 月別カウント
-            monthly_counts = df['month'].value_counts().sort_index()
-            
-            # 1-12月すべてを表示するための準備
-            full_months = pd.Series(0, index=range(1, 13))
-            for month, count in monthly_counts.items():
-                full_months[month] = count
-            
-            # 月名のマッピング
-            month_names = ['1月', '2月', '3月', '4月', '5月', '6月', 
-                           '7月', '8月', '9月', '10月', '11月', '12月']
-            
-            # プロット
-            plt.figure(figsize=figsize)
-            bars = plt.bar(range(1, 13), full_months.values, color='#9b59b6')
-            
-            # 軸とタイトルの設定
-            plt.title('月別メール数', pad=10)
-            plt.xlabel('月')
-            plt.ylabel('メール数')
-            
-            # x軸のラベルを設定
-            plt.xticks(range(1, 13), month_names, rotation=45)
-            
-            # グリッド線の追加
-            plt.grid(axis='y', linestyle='--', alpha=0.7)
-            
-            # y軸を0から開始
-            plt.ylim(bottom=0)
-            
-            # データがあるバーにラベルを表示
-            for bar in bars:
-                height = bar.get_height()
-                if height > 0:
-                    plt.text(bar.get_x() + bar.get_width()/2., height + 0.5,
-                            f'{int(height)}', ha='center', va='bottom')
-            
-            plt.tight_layout()
-            
-            # 一時ファイルとして保存
-            os.makedirs('temp_plots', exist_ok=True)
-            output_path = 'temp_plots/monthly_distribution.png'
-            plt.savefig(output_path)
-            plt.close()
-            
-            return output_path
-            
+            for start in range(0, len(df), self.chunk_size):
+                rows = self._message_rows(df.iloc[start:start + self.chunk_size], sender_email)
+                if not rows.empty:
+                    self._write('messages', self._partition_key(rows['sent_date']).values, rows)
+            
+            if aggregates is None:
+                aggregates = self.analyzer._compute_chart_aggregates(df)
+            rows = self._aggregate_rows(df, sender_email, aggregates)
+            self._write('aggregates', self._partition_key(rows['snapshot_date']).values, rows)
+            self.senders.append(sender_email)
+            print(f"{sender_email}: {len(df)}件を出力しました")
+            return True
         except Exception as e:
-            print(f"月別グラフ作成エラー: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+            print(f"{sender_email}: 出力エラー: {e}")
+            self.failed.append(sender_email)
+            return False
+
+    def close(self):
+        """ファイルを閉じてスキーマとmanifest.jsonを書き出し、manifestのパスを返す"""
+        if self.result is not None:
+            return self.result
+        
+        schema_dir = self.output_dir / 'schema'
+        schema_dir.mkdir(parents=True, exist_ok=True)
+        tables = {}
+        for table, schema, partition_field in (('messages', MESSAGE_EXPORT_SCHEMA, 'sent_date'),
+                                               ('aggregates', AGGREGATE_EXPORT_SCHEMA, 'snapshot_date')):
+            schema_path = schema_dir / f"{table}.json"
+            with open(schema_path, 'w', encoding='utf-8') as f:
+                json.dump(schema, f, ensure_ascii=False, indent=2)
+            tables[table] = {
+                'schema': schema_path.relative_to(self.output_dir).as_posix(),
+                'fields': schema,
+                'partition_field': partition_field,
+                'partition_type': 'DAY' if self.partition == 'day' else 'MONTH',
+                'files': {},
+            }
+            for output_format in self.formats:
+                writer = self._writers[(table, output_format)]
+                tables[table]['files'][output_format] = writer.close()
+                tables[table]['rows'] = writer.rows
+        
+        manifest = {
+            'schema_version': EXPORT_SCHEMA_VERSION,
+            'exported_at': self.exported_at.isoformat(),
+            'senders': self.senders,
+            'failed': self.failed,
+            'tables': tables,
+        }
+        manifest_path = self.output_dir / 'manifest.json'
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+        
+        self.result = str(manifest_path)
+        print(f"BigQuery用のファイルを出力しました: {self.output_dir}"
+              f"（{len(self.senders)}名分、メール {tables['messages']['rows']}件）")
+        if self.failed:
+            print(f"出力できなかった送信者: {', '.join(self.failed)}")
+        return self.result
+
+
+def load_export_to_bigquery(export_dir, dataset, project=None, source_format='parquet',
+                            write_disposition='WRITE_APPEND', location=None):
+    """export_for_bigquery の出力をBigQueryの表（messages・aggregates）に読み込む
+
+    dataset は 'データセット' または 'プロジェクト.データセット'。認証にはアプリケーションの
+    デフォルト認証情報（GOOGLE_APPLICATION_CREDENTIALS など）を使い、見つからない場合や
+    google-cloud-bigquery がない場合は何もせずにNoneを返す。表ごとにパーティションの
+    ファイルを1つにまとめてから1回のロードジョブで読み込む。戻り値は {表名: 読み込んだ行数}。
+    """
+    try:
+        from google.cloud import bigquery
+        import google.auth
+        credentials, default_project = google.auth.default(
+            scopes=['https://www.googleapis.com/auth/bigquery'])
+    except ImportError:
+        print("google-cloud-bigqueryがインストールされていないため、BigQueryへの読み込みを省略します")
+        return None
+    except google_auth_exceptions.DefaultCredentialsError as e:
+        print(f"BigQueryの認証情報が見つからないため、読み込みを省略します: {e}")
+        return None
+    
+    with open(os.path.join(export_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if '.' in dataset:
+        project, dataset = dataset.split('.', 1)
+    client = bigquery.Client(project=project or default_project, credentials=credentials, location=location)
+    
+    loaded = {}
+    for table_name, table in manifest['tables'].items():
+        files = [os.path.join(export_dir, path) for path in table['files'].get(source_format, [])]
+        if not files:
+            continue
+        job_config = bigquery.LoadJobConfig(
+            source_format=(bigquery.SourceFormat.PARQUET if source_format == 'parquet'
+                           else bigquery.SourceFormat.NEWLINE_DELIMITED_JSON),
+            schema=[bigquery.SchemaField(field['name'], field['type'], mode=field['mode'],
+                                         description=field.get('description')) for field in table['fields']],
+            write_disposition=write_disposition,
+            time_partitioning=bigquery.TimePartitioning(type_=table['partition_type'],
+                                                        field=table['partition_field']))
+        table_id = f"{client.project}.{dataset}.{table_name}"
+        
+        import tempfile
+        with tempfile.TemporaryFile() as combined:
+            if source_format == 'parquet':
+                # 行グループ単位で1つのファイルにまとめる（全体をメモリに読み込まない）
+                import pyarrow.parquet as pq
+                writer = pq.ParquetWriter(combined, _arrow_schema(table['fields']), compression='snappy')
+                for path in files:
+                    source = pq.ParquetFile(path)
+                    for index in range(source.num_row_groups):
+                        writer.write_table(source.read_row_group(index))
+                writer.close()
+            else:
+                for path in files:
+                    with open(path, 'rb') as f:
+                        shutil.copyfileobj(f, combined)
+            combined.seek(0)
+            job = None
+            try:
+                job = client.load_table_from_file(combined, table_id, job_config=job_config)
+                job.result()
+            except Exception as e:
+                print(f"BigQueryへの読み込みエラー（{table_id}）: {e}")
+                if job is not None and job.errors:
+                    print(job.errors[:5])
+                raise
+        loaded[table_name] = job.output_rows
+        print(f"{table_id} に{job.output_rows}行を読み込みました")
+    return loaded
+
+
+def extract_plain_text_body(payload):
+    """メッセージのペイロードからテキスト形式の本文を取り出す"""
+    # ペイロードからパーツを取得
+    parts = payload.get('parts', [])
+    
+    # 本文を格納する変数
+    body = ""
+    
+    # パーツがある場合（マルチパートメール）
+    if parts:
+        for part in parts:
+            mime_type = part.get('mimeType')
+            # テキスト形式の本文を探す
+            if mime_type == 'text/plain':
+                body_data = part.get('body', {}).get('data', '')
+                if body_data:
+                    # Base64でエンコードされたデータをデコード
+                    body = base64.urlsafe_b64decode(body_data).decode('utf-8')
+                    break
+    # シンプルなメールの場合
+    elif 'body' in payload and 'data' in payload['body']:
+        body_data = payload['body']['data']
+        body = base64.urlsafe_b64decode(body_data).decode('utf-8')
+    
+    return body
 
 def get_message_content(service, user_id, msg_id):
     """メッセージの本文を取得する"""
@@ -2144,65 +5829,383 @@ def get_message_content(service, user_id, msg_id):
         # メッセージの詳細情報を取得（format=fullで全データを取得）
         message = service.users().messages().get(userId=user_id, id=msg_id, format='full').execute()
         
-        # ペイロードからパーツを取得
-        payload = message['payload']
-        parts = payload.get('parts', [])
-        
-        # 本文を格納する変数
-        body = ""
-        
-        # パーツがある場合（マルチパートメール）
-        if parts:
-            for part in parts:
-                mime_type = part.get('mimeType')
-                # テキスト形式の本文を探す
-                if mime_type == 'text/plain':
-                    body_data = part.get('body', {}).get('data', '')
-                    if body_data:
-                        # Base64でエンコードされたデータをデコード
-                        body = base64.urlsafe_b64decode(body_data).decode('utf-8')
-                        break
-        # シンプルなメールの場合
-        elif 'body' in payload and 'data' in payload['body']:
-            body_data = payload['body']['data']
-            body = base64.urlsafe_b64decode(body_data).decode('utf-8')
-        
-        return body
+        return extract_plain_text_body(message['payload'])
     
     except Exception as error:
         print(f'メッセージ本文の取得エラー: {error}')
         return ""
 
-def main():
-    analyzer = GmailAnalyzer()
-    analyzer.authenticate()
+# コマンドラインの終了コード（スケジューラーから判定しやすいように種類ごとに分ける）
+EXIT_OK = 0           # すべての送信者の処理に成功
+EXIT_FAILED = 1       # 一部またはすべての送信者の処理に失敗（データなしを含む）
+EXIT_USAGE = 2        # 引数の誤り
+EXIT_AUTH = 3         # 認証エラー（トークンの再作成が必要）
+EXIT_QUOTA = 4        # Gmail APIの日次クォータ超過（チェックポイントから再開可能）
+EXIT_INTERRUPTED = 130
+
+def _cli_date(value):
+    """--since / --until の値（YYYY-MM-DD）"""
+    import argparse
+    try:
+        return _parse_query_date(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日付は YYYY-MM-DD 形式で指定してください: {value}")
+
+def build_arg_parser():
+    """コマンドラインの引数定義"""
+    import argparse
+    
+    common = argparse.ArgumentParser(add_help=False)
+    target = common.add_argument_group('対象')
+    target.add_argument('--sender', action='append', default=[], metavar='EMAIL',
+                        help='分析対象の送信者メールアドレス（複数指定可）')
+    target.add_argument('--senders-file', metavar='PATH',
+                        help='送信者のメールアドレスを1行に1件書いたファイル（#以降はコメント）')
+    target.add_argument('--since', type=_cli_date, metavar='YYYY-MM-DD', help='この日以降のメールのみ')
+    target.add_argument('--until', type=_cli_date, metavar='YYYY-MM-DD', help='この日以前のメールのみ')
+    target.add_argument('--max-results', type=int, default=500, help='送信者ごとの最大取得件数（デフォルト: 500）')
+    target.add_argument('--sample-size', type=int, help='全件の代わりに抽出して取得する件数')
+    run = common.add_argument_group('実行')
+    run.add_argument('--workers', type=int, default=1, help='同時に処理する送信者数（デフォルト: 1）')
+    run.add_argument('--cache-dir', help='レポート・グラフ・考察のキャッシュ先')
+    run.add_argument('--checkpoint-dir', help='取得の進捗を送信者ごとに保存するディレクトリ（中断後に再開）')
+    run.add_argument('--credentials', default='credentials.json', help='OAuthクライアントの認証情報ファイル')
+    run.add_argument('--token', default='token.json', help='トークンファイル')
+    run.add_argument('--non-interactive', action='store_true',
+                     help='ブラウザでの認証を行わない（有効なトークンがなければ終了コード3で終了）')
+    
+    parser = argparse.ArgumentParser(
+        prog='gmail_analyzer.py',
+        description='Gmailの送信者ごとの送信パターンを分析します',
+        epilog='終了コード: 0=成功, 1=一部の送信者が失敗, 2=引数の誤り, 3=認証エラー, 4=クォータ超過, 130=中断')
+    subparsers = parser.add_subparsers(dest='command', metavar='{fetch,analyze,report,export,serve}')
+    
+    fetch = subparsers.add_parser('fetch', parents=[common], help='メールを取得してCSV/JSONLに保存')
+    fetch.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help='出力形式（デフォルト: csv）')
+    fetch.add_argument('--output-dir', default='.', help='出力先ディレクトリ（送信者ごとに1ファイル）')
+    
+    analyze = subparsers.add_parser('analyze', parents=[common], help='集計結果と考察を表示')
+    analyze.add_argument('--format', choices=['text', 'json'], default='text', help='出力形式（デフォルト: text）')
+    analyze.add_argument('--output', help='出力ファイル（省略時は標準出力）')
+    analyze.add_argument('--no-llm', action='store_true', help='Claude APIを使わず集計値に基づく考察を出力')
+    
+    report = subparsers.add_parser('report', parents=[common], help='PDFレポートを作成')
+    report.add_argument('--output', help='出力PDFのパス（複数の送信者の場合は目次付きの1つのPDFにまとめる）')
+    report.add_argument('--output-dir', default='.', help='--output を省略した場合の出力先ディレクトリ（送信者ごとに1ファイル）')
+    report.add_argument('--format', choices=CHART_FORMATS, default='png', help='グラフの埋め込み形式（デフォルト: png）')
+    report.add_argument('--no-llm', action='store_true', help='Claude APIを使わず集計値に基づく考察を載せる')
+    report.add_argument('--render-workers', type=int, default=0, help='グラフ描画のプロセス数（デフォルト: 0=同じプロセス）')
+    report.add_argument('--insight-timeout', type=float, default=30, help='考察を待つ秒数（デフォルト: 30）')
+    
+    export = subparsers.add_parser('export', parents=[common], help='BigQueryに読み込めるParquet/NDJSONに出力')
+    export.add_argument('--output-dir', default='bigquery_export', help='出力先ディレクトリ（デフォルト: bigquery_export）')
+    export.add_argument('--format', dest='export_format', action='append', choices=list(EXPORT_FORMATS),
+                        help='出力形式（複数指定可、デフォルト: parquet と ndjson）')
+    export.add_argument('--partition', choices=['day', 'month'], default='day', help='日付パーティションの単位（デフォルト: day）')
+    export.add_argument('--chunk-size', type=int, default=10000, help='一度に変換・書き込みする行数（デフォルト: 10000）')
+    export.add_argument('--bq-dataset', metavar='[PROJECT.]DATASET',
+                        help='出力後にBigQueryのデータセットへ読み込む（アプリケーションのデフォルト認証情報を使用）')
+    
+    serve = subparsers.add_parser('serve', help='分析ジョブを受け付けるHTTPサービスを起動')
+    serve.add_argument('--host', default='127.0.0.1', help='待ち受けるアドレス（デフォルト: 127.0.0.1）')
+    serve.add_argument('--port', type=int, default=8000, help='待ち受けるポート（デフォルト: 8000）')
+    serve.add_argument('--workers', type=int, default=2, help='ジョブを処理するワーカー数（デフォルト: 2）')
+    serve.add_argument('--max-queue', type=int, default=100, help='待機できるジョブ数の上限（デフォルト: 100）')
+    serve.add_argument('--output-dir', default='reports', help='成果物の保存先（デフォルト: reports）')
+    serve.add_argument('--cache-dir', help='レポート・グラフ・考察のキャッシュ先')
+    serve.add_argument('--credentials', default='credentials.json', help='OAuthクライアントの認証情報ファイル')
+    serve.add_argument('--token', default='token.json', help='トークンファイル（事前に作成しておく）')
+    serve.add_argument('--no-llm', action='store_true', help='Claude APIを使わず集計値に基づく考察を使う')
+    return parser
+
+def _read_senders(args):
+    """--sender と --senders-file から送信者の一覧を作る（重複は除く）"""
+    senders = list(args.sender)
+    if args.senders_file:
+        with open(args.senders_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    senders.append(line)
+    return list(dict.fromkeys(senders))
+
+def _cli_fetch_kwargs(args, sender):
+    """analyze_emails_from_sender に渡す取得条件"""
+    kwargs = {'max_results': args.max_results, 'start_date': args.since, 'end_date': args.until}
+    if args.sample_size:
+        kwargs['sample_size'] = args.sample_size
+    if args.checkpoint_dir:
+        kwargs['checkpoint_dir'] = os.path.join(args.checkpoint_dir, _safe_filename(sender))
+    return kwargs
+
+def _cli_run_senders(args, senders, process):
+    """送信者ごとに process(sender) を --workers 件ずつ並行に実行し {送信者: 結果} を返す
+
+    失敗した送信者は結果をNoneとして続行する。クォータ超過・認証エラーは全体を止める。
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix='cli') as executor:
+        futures = {executor.submit(process, sender): sender for sender in senders}
+        try:
+            for future in as_completed(futures):
+                sender = futures[future]
+                try:
+                    results[sender] = future.result()
+                except (QuotaExceededError, AuthenticationError):
+                    raise
+                except Exception as e:
+                    print(f"{sender}: 処理エラー: {e}", file=sys.stderr)
+                    results[sender] = None
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+def _cli_fetch(analyzer, args, senders):
+    """fetch: 送信者ごとのメールをファイルに保存する"""
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    def process(sender):
+        df = analyzer.analyze_emails_from_sender(sender, **_cli_fetch_kwargs(args, sender))
+        if df.empty:
+            print(f"{sender}: メールが見つかりませんでした", file=sys.stderr)
+            return None
+        path = output_dir / f"{_safe_filename(sender)}.{args.format}"
+        if args.format == 'jsonl':
+            df.to_json(path, orient='records', lines=True, date_format='iso', force_ascii=False)
+        else:
+            df.to_csv(path, index=False)
+        print(f"{sender}: {len(df)}件を保存しました: {path}")
+        return str(path)
+    
+    return _cli_run_senders(args, senders, process)
+
+def _sender_summary(analyzer, df, sender, with_insights):
+    """送信者1人分の集計結果（analyze の出力・HTTPサービスのJSON形式）"""
+    aggregates = analyzer._compute_chart_aggregates(df)
+    summary = {
+        'sender': sender,
+        'total': len(df),
+        'period': [df['date'].min().strftime('%Y-%m-%d'), df['date'].max().strftime('%Y-%m-%d')],
+        'monthly': {month: int(count) for month, count in
+                    df.groupby(df['date'].dt.strftime('%Y-%m')).size().items()},
+        'hourly': aggregates['hourly'],
+        'weekday': dict(zip(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+                            aggregates['weekday'])),
+        'recent': [{'date': row['date'].strftime('%Y-%m-%d %H:%M'), 'subject': row['subject']}
+                   for _, row in df.sort_values('date', ascending=False).head(5).iterrows()],
+    }
+    if aggregates['sampling']:
+        summary['sampling'] = aggregates['sampling']
+    if with_insights:
+        summary['insights'] = analyzer._generate_report_insights(df.copy(deep=False), sender)
+    return summary
+
+def _print_summary_text(summary, file):
+    """analyze の結果をテキストで出力する"""
+    print(f"\n=== {summary['sender']} ===", file=file)
+    print(f"総メール数: {summary['total']}（{summary['period'][0]} 〜 {summary['period'][1]}）", file=file)
+    print('\n--- 月別メール数 ---', file=file)
+    for month, count in summary['monthly'].items():
+        print(f"{month}: {count}", file=file)
+    print('\n--- 時間帯別メール数 ---', file=file)
+    for hour, count in enumerate(summary['hourly']):
+        print(f"{hour:2d}時: {count}", file=file)
+    print('\n--- 曜日別メール数 ---', file=file)
+    for day, count in summary['weekday'].items():
+        print(f"{day}: {count}", file=file)
+    print('\n--- 直近5件のメール ---', file=file)
+    for email in summary['recent']:
+        print(f"{email['date']} - {email['subject']}", file=file)
+    if summary.get('insights'):
+        print('\n--- 考察 ---', file=file)
+        for insight in summary['insights']:
+            print(insight, file=file)
+
+def _cli_analyze(analyzer, args, senders):
+    """analyze: 集計結果（と考察）を出力する"""
+    def process(sender):
+        df = analyzer.analyze_emails_from_sender(sender, **_cli_fetch_kwargs(args, sender))
+        if df.empty:
+            print(f"{sender}: メールが見つかりませんでした", file=sys.stderr)
+            return None
+        return _sender_summary(analyzer, df, sender, with_insights=True)
+    
+    # JSONを標準出力に書く場合、処理中のメッセージは標準エラー出力に回す
+    import contextlib
+    stdout = sys.stdout
+    redirect = args.format == 'json' and not args.output
+    with contextlib.redirect_stdout(sys.stderr) if redirect else contextlib.nullcontext():
+        results = _cli_run_senders(args, senders, process)
+    
+    summaries = [results[sender] for sender in senders if results.get(sender)]
+    out = open(args.output, 'w', encoding='utf-8') if args.output else stdout
+    try:
+        if args.format == 'json':
+            json.dump(summaries, out, ensure_ascii=False, indent=2, default=str)
+            out.write('\n')
+        else:
+            for summary in summaries:
+                _print_summary_text(summary, out)
+    finally:
+        if args.output:
+            out.close()
+    return results
+
+def _cli_fetch_in_order(analyzer, args, senders):
+    """送信者のメールを --workers 件ずつ並行に取得し、指定された順に (送信者, DataFrame) を返す
+
+    取得に失敗した送信者のDataFrameはNone。クォータ超過・認証エラーは残りの取得を取り消して止める。
+    """
+    fetch = lambda sender: analyzer.analyze_emails_from_sender(sender, **_cli_fetch_kwargs(args, sender))
+    with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix='cli') as executor:
+        futures = [(sender, executor.submit(fetch, sender)) for sender in senders]
+        try:
+            for sender, future in futures:
+                try:
+                    df = future.result()
+                except (QuotaExceededError, AuthenticationError):
+                    raise
+                except Exception as e:
+                    print(f"{sender}: メール取得エラー: {e}", file=sys.stderr)
+                    df = None
+                yield sender, df
+        finally:
+            for _, pending in futures:
+                pending.cancel()
+
+def _cli_report(analyzer, args, senders):
+    """report: PDFレポートを作成する"""
+    fetch = lambda sender: analyzer.analyze_emails_from_sender(sender, **_cli_fetch_kwargs(args, sender))
+    
+    if args.output and len(senders) > 1:
+        # 取得は並行し、ページは指定された順に追加する
+        writer = BatchReportWriter(analyzer, args.output, expected_count=len(senders))
+        results = {}
+        for sender, df in _cli_fetch_in_order(analyzer, args, senders):
+            results[sender] = args.output if writer.add_sender(df, sender) else None
+            df = None
+        if writer.close() is None:
+            return {sender: None for sender in senders}
+        return results
+    
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    def process(sender):
+        df = fetch(sender)
+        if df.empty:
+            print(f"{sender}: メールが見つかりませんでした", file=sys.stderr)
+            return None
+        output_path = args.output or str(output_dir / analyzer._default_report_path(sender))
+        return analyzer.generate_comprehensive_pdf_report(df, sender, output_path=output_path)
     
-    sender = input('分析したい送信者のメールアドレスを入力してください: ')
-    df = analyzer.analyze_emails_from_sender(sender)
-    df = df.sort_values('date', ascending=False)
+    return _cli_run_senders(args, senders, process)
+
+def _cli_export(analyzer, args, senders):
+    """export: BigQuery用のParquet/NDJSONを出力し、--bq-dataset があれば読み込む"""
+    writer = BigQueryExportWriter(analyzer, args.output_dir, formats=args.export_format or ('parquet', 'ndjson'),
+                                  partition=args.partition, chunk_size=args.chunk_size)
+    exported = {}
+    try:
+        for sender, df in _cli_fetch_in_order(analyzer, args, senders):
+            exported[sender] = writer.add_sender(df, sender)
+            df = None
+    finally:
+        manifest_path = writer.close()
+    results = {sender: manifest_path if exported.get(sender) else None for sender in senders}
     
-    # 通常の分析出力
-    print('\n=== 基本統計情報 ===')
-    print(f'総メール数: {len(df)}')
+    if args.bq_dataset and any(results.values()):
+        source_format = 'parquet' if 'parquet' in writer.formats else 'ndjson'
+        try:
+            loaded = load_export_to_bigquery(args.output_dir, args.bq_dataset, source_format=source_format)
+        except Exception as e:
+            print(f"BigQueryへの読み込みエラー: {e}", file=sys.stderr)
+            loaded = None
+        if loaded is None:
+            # 読み込みを指定された場合は、ファイルを出力できても失敗として扱う
+            return {sender: None for sender in senders}
+    return results
+
+def _cli_serve(args):
+    """serve: HTTPサービスを起動する（トークンは事前にコマンドラインで作成しておく）"""
+    def analyzer_factory():
+        analyzer = GmailAnalyzer(cache_dir=args.cache_dir, use_claude=not args.no_llm)
+        if not analyzer.authenticate(args.credentials, args.token, interactive=False):
+            raise AuthenticationError(f"有効なトークンがありません: {args.token}")
+        return analyzer
     
-    print('\n=== 月別メール数 ===')
-    print(df.groupby(df['date'].dt.strftime('%Y-%m')).size())
+    job_queue = ReportJobQueue(analyzer_factory, workers=args.workers, max_queue=args.max_queue,
+                               output_dir=args.output_dir)
+    app = create_app(job_queue)
+    try:
+        app.run(host=args.host, port=args.port, threaded=True)
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    finally:
+        job_queue.shutdown(wait=False)
+    return EXIT_OK
+
+def main(argv=None):
+    """コマンドラインから実行する（終了コードを返す）
+
+    サブコマンドを省略した従来の形式（--sender ... --max-results ... --output ...）は report として扱う。
+    引数なしで端末から実行した場合は送信者を入力してレポートを作成する。
+    """
+    parser = build_arg_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv:
+        if not (sys.stdin is not None and sys.stdin.isatty()):
+            parser.print_help(sys.stderr)
+            return EXIT_USAGE
+        sender_email = input('分析したい送信者のメールアドレスを入力してください: ').strip()
+        argv = ['report', '--sender', sender_email]
+    elif argv[0] not in ('fetch', 'analyze', 'report', 'export', 'serve', '-h', '--help'):
+        argv = ['report'] + argv
     
-    print('\n=== 時間帯別メール数 ===')
-    print(df.groupby('hour').size())
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return _cli_serve(args)
+    try:
+        senders = _read_senders(args)
+    except OSError as e:
+        print(f"送信者ファイルを読み込めません: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    if not senders:
+        parser.error('--sender または --senders-file で送信者を指定してください')
     
-    print('\n=== 曜日別メール数 ===')
-    weekday_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-    print(df.groupby('weekday').size().reindex(weekday_order))
+    use_claude = not getattr(args, 'no_llm', False)
+    analyzer = GmailAnalyzer(
+        cache_dir=args.cache_dir, use_claude=use_claude,
+        chart_format=getattr(args, 'format', 'png') if args.command == 'report' else 'png',
+        render_workers=getattr(args, 'render_workers', 0),
+        insight_timeout=getattr(args, 'insight_timeout', 30))
     
-    print('\n=== 直近5件のメール ===')
-    recent_emails = df.head(5)
-    for _, row in recent_emails.iterrows():
-        print(f"{row['date'].strftime('%Y-%m-%d %H:%M')} - {row['subject']}")
+    try:
+        if not analyzer.authenticate(args.credentials, args.token,
+                                     interactive=False if args.non_interactive else None):
+            return EXIT_AUTH
+        
+        handlers = {'fetch': _cli_fetch, 'analyze': _cli_analyze, 'report': _cli_report, 'export': _cli_export}
+        results = handlers[args.command](analyzer, args, senders)
+    except AuthenticationError as e:
+        print(f"認証エラー: {e}", file=sys.stderr)
+        return EXIT_AUTH
+    except QuotaExceededError as e:
+        print(f"クォータ超過: {e}", file=sys.stderr)
+        return EXIT_QUOTA
+    except KeyboardInterrupt:
+        print("中断しました", file=sys.stderr)
+        return EXIT_INTERRUPTED
     
-    # PDFレポートの生成
-    summary_report_path = analyzer.generate_comprehensive_pdf_report(df, sender)
-    print(f'\nPDFレポートが生成されました: {summary_report_path}')
+    failed = [sender for sender in senders if not results.get(sender)]
+    print(f"\n完了: {len(senders) - len(failed)}/{len(senders)}名の送信者を処理しました", file=sys.stderr)
+    if failed:
+        print(f"失敗: {', '.join(failed)}", file=sys.stderr)
+        return EXIT_FAILED
+    return EXIT_OK
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    sys.exit(main())
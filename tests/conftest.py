@@ -0,0 +1,51 @@
+import inspect
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeGmail  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def _isolated_env(monkeypatch):
+    # 実際のClaude APIやフォント設定に依存しないようにする
+    monkeypatch.delenv('ANTHROPIC_API_KEY', raising=False)
+    monkeypatch.delenv('ANTHROPIC_BASE_URL', raising=False)
+
+
+@pytest.fixture
+def fake_gmail():
+    return FakeGmail
+
+
+@pytest.fixture
+def analyzer_with(fake_gmail):
+    """FakeGmail に接続したアナライザーを作る"""
+    import gmail_analyzer
+
+    def make(service=None, **kwargs):
+        analyzer = gmail_analyzer.GmailAnalyzer(use_claude=False, **kwargs)
+        analyzer.service = service if service is not None else fake_gmail()
+        return analyzer
+    return make
+
+
+@pytest.fixture
+def claude_request_compat(monkeypatch):
+    """temperature を引数に持たないAnthropic SDKでは、同じ値をリクエスト本文に入れて送る"""
+    import gmail_analyzer
+
+    anthropic = pytest.importorskip('anthropic')
+    if 'temperature' in inspect.signature(anthropic.resources.messages.Messages.create).parameters:
+        return
+    build_request = gmail_analyzer.GmailAnalyzer._build_claude_request
+
+    def build_without_temperature(self, data_summary):
+        request = build_request(self, data_summary)
+        request['extra_body'] = {'temperature': request.pop('temperature')}
+        return request
+    monkeypatch.setattr(gmail_analyzer.GmailAnalyzer, '_build_claude_request', build_without_temperature)
@@ -0,0 +1,71 @@
+"""テスト用のGmail APIのスタブ（users().messages() の list / get のみ）"""
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import email.utils
+
+
+class _Request:
+    def __init__(self, func):
+        self.func = func
+
+    def execute(self, *args, **kwargs):
+        return self.func()
+
+
+class FakeGmail:
+    """messages.list / messages.get に応答するGmail APIのサービスオブジェクトの代わり
+
+    メッセージは2024-01-01（UTC）から step_hours 時間おきに count 件。
+    failing に含まれるIDの get は、healthy が False の間は失敗する。
+    """
+
+    def __init__(self, count=50, step_hours=7, failing=()):
+        self.ids = [f"m{i:05d}" for i in range(count)]
+        self.step_hours = step_hours
+        self.failing = set(failing)
+        self.healthy = False
+        self.calls = Counter()
+        self.queries = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, q=None, maxResults=100, pageToken=None, fields=None, **kwargs):
+        def run():
+            self.calls['list'] += 1
+            self.queries.append(q)
+            start = int(pageToken or 0)
+            ids = self.ids[start:start + min(maxResults, 500)]
+            result = {'resultSizeEstimate': len(self.ids)}
+            if ids:
+                result['messages'] = [{'id': msg_id, 'threadId': msg_id} for msg_id in ids]
+            if start + len(ids) < len(self.ids):
+                result['nextPageToken'] = str(start + len(ids))
+            return result
+        return _Request(run)
+
+    def get(self, userId, id, format='full', metadataHeaders=None, **kwargs):
+        def run():
+            self.calls['get'] += 1
+            if id in self.failing and not self.healthy:
+                raise RuntimeError(f"一時的なエラー: {id}")
+            return self.message(id)
+        return _Request(run)
+
+    def message(self, msg_id):
+        index = int(msg_id[1:])
+        sent = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=index * self.step_hours)
+        return {
+            'id': msg_id,
+            'threadId': msg_id,
+            'snippet': f"weekly newsletter item{index % 5} &amp; sale",
+            'payload': {'headers': [
+                {'name': 'Date', 'value': email.utils.format_datetime(sent)},
+                {'name': 'Subject', 'value': f"Weekly news {index % 3}"},
+                {'name': 'From', 'value': 'news@example.com'},
+                {'name': 'To', 'value': 'me@example.com'},
+            ]},
+        }
@@ -0,0 +1,193 @@
+import asyncio
+import datetime
+import email.utils
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import gmail_analyzer
+
+pytest.importorskip('httpx')
+pytest.importorskip('anthropic')
+
+
+class FakeRestServer:
+    """Gmail API（messages.list / messages.get）と Claude の messages API を返すローカルのHTTPサーバー
+
+    rate_limit_every 件目ごとのGETには429を返す。
+    """
+
+    def __init__(self, count=300, delay=0.02, rate_limit_every=0):
+        self.count = count
+        self.delay = delay
+        self.rate_limit_every = rate_limit_every
+        self.lock = threading.Lock()
+        self.gets = 0
+        self.rate_limited = 0
+        self.claude_requests = 0
+        self.active = 0
+        self.max_active = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def message(self, msg_id):
+        index = int(msg_id[1:])
+        date = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(hours=index * 7)
+        headers = {'Date': email.utils.format_datetime(date), 'Subject': f"お知らせ {index}",
+                   'From': 'news@example.com', 'To': 'me@example.com'}
+        return {'id': msg_id, 'threadId': msg_id, 'snippet': 'hello',
+                'payload': {'headers': [{'name': k, 'value': v} for k, v in headers.items()]}}
+
+    def _get(self, path, query):
+        parts = path.rstrip('/').split('/')
+        if parts[-1] == 'messages':
+            start = int(query.get('pageToken', ['0'])[0])
+            size = int(query.get('maxResults', ['100'])[0])
+            ids = [f"m{i:05d}" for i in range(start, min(self.count, start + size))]
+            result = {'resultSizeEstimate': self.count, 'messages': [{'id': i, 'threadId': i} for i in ids]}
+            if start + len(ids) < self.count:
+                result['nextPageToken'] = str(start + len(ids))
+            return result
+        return self.message(parts[-1])
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, payload, headers=()):
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with stub.lock:
+                    stub.gets += 1
+                    rate_limited = stub.rate_limit_every and stub.gets % stub.rate_limit_every == 0
+                    stub.rate_limited += bool(rate_limited)
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    time.sleep(stub.delay)
+                    if rate_limited:
+                        return self.send(429, {'error': {'code': 429, 'message': 'rate limited'}})
+                    return self.send(200, stub._get(url.path, parse_qs(url.query)))
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+                with stub.lock:
+                    stub.claude_requests += 1
+                text = '"insights": [{"observation": "非同期の考察", "suggestion": "そのまま送る"}]}'
+                self.send(200, {'id': 'msg_stub', 'type': 'message', 'role': 'assistant', 'model': body['model'],
+                                'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn',
+                                'stop_sequence': None, 'usage': {'input_tokens': 1, 'output_tokens': 1}})
+        return Handler
+
+
+@pytest.fixture
+def rest_server():
+    server = FakeRestServer(rate_limit_every=37)
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+
+def _async_analyzer(server, **analyzer_kwargs):
+    analyzer = gmail_analyzer.AsyncGmailAnalyzer(base_url=server.base_url, max_concurrency=8,
+                                                 claude_base_url=server.base_url, **analyzer_kwargs)
+    analyzer.backoff = 0.01
+    return analyzer
+
+
+def test_fetch_caps_concurrency_and_retries_rate_limits(rest_server):
+    async def run():
+        async with _async_analyzer(rest_server, use_claude=False) as analyzer:
+            return await analyzer.fetch('news@example.com', max_results=300)
+
+    df = asyncio.run(run())
+    assert len(df) == 300
+    assert df['message_id'].is_unique
+    assert rest_server.rate_limited > 0
+    assert 1 < rest_server.max_active <= 8
+
+
+def test_analyze_gets_insights_from_claude(rest_server, monkeypatch, claude_request_compat):
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'test-key')
+
+    async def run():
+        async with _async_analyzer(rest_server) as analyzer:
+            return await analyzer.analyze('news@example.com', max_results=50)
+
+    result = asyncio.run(run())
+    assert len(result['df']) == 50
+    assert sum(result['aggregates']['hourly']) == 50
+    assert result['insights'] == ['1. 非同期の考察: そのまま送る']
+    assert rest_server.claude_requests == 1
+
+
+def test_timeout_and_cancel_stop_requests(rest_server):
+    rest_server.delay = 0.1
+
+    async def run():
+        async with _async_analyzer(rest_server, use_claude=False) as analyzer:
+            with pytest.raises(asyncio.TimeoutError):
+                await analyzer.fetch('news@example.com', max_results=300, timeout=0.3)
+
+            task = asyncio.ensure_future(analyzer.fetch('news@example.com', max_results=300))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(run())
+    # 中断したリクエストの応答を待たずに終わり、サーバー側も処理中のものだけで止まる
+    gets = rest_server.gets
+    time.sleep(0.3)
+    assert rest_server.gets == gets
+    assert gets < 300
+
+
+def test_transport_errors_are_retried(rest_server):
+    import httpx
+
+    failures = []
+
+    async def run():
+        async with _async_analyzer(rest_server, use_claude=False) as analyzer:
+            client = analyzer._get_client()
+            get = client.get
+
+            async def flaky_get(url, **kwargs):
+                # 最初の2回は接続のタイムアウトにする
+                if len(failures) < 2:
+                    failures.append(url)
+                    raise httpx.ConnectTimeout('timed out')
+                return await get(url, **kwargs)
+
+            client.get = flaky_get
+            return await analyzer.fetch('news@example.com', max_results=20)
+
+    df = asyncio.run(run())
+    assert len(failures) == 2
+    assert len(df) == 20
@@ -0,0 +1,61 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import gmail_analyzer
+
+credentials_module = pytest.importorskip('google.oauth2.credentials')
+
+
+def _utcnow():
+    # google-authのexpiryはタイムゾーンなしのUTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _credentials(token, refresh_token, expiry):
+    return credentials_module.Credentials(token, refresh_token=refresh_token, client_id='client',
+                                          client_secret='secret', token_uri='https://oauth2.example.com/token',
+                                          scopes=gmail_analyzer.SCOPES, expiry=expiry)
+
+
+@pytest.fixture
+def rotating_refresh(monkeypatch):
+    """更新のたびにアクセストークンとリフレッシュトークンを新しくする"""
+    refreshed = []
+
+    def refresh(self, request):
+        refreshed.append(self.refresh_token)
+        self.token = f"access-{len(refreshed)}"
+        self.expiry = _utcnow() + timedelta(hours=1)
+        self._refresh_token = f"refresh-{len(refreshed)}"
+    monkeypatch.setattr(credentials_module.Credentials, 'refresh', refresh)
+    return refreshed
+
+
+def test_rotated_refresh_token_is_saved_and_shared(tmp_path, rotating_refresh):
+    token_path = tmp_path / 'token.json'
+    expired = _credentials('access-0', 'refresh-0', _utcnow() - timedelta(minutes=1))
+    token_path.write_text(expired.to_json())
+
+    manager = gmail_analyzer.CredentialManager(str(token_path), interactive=False)
+    manager._credentials = _credentials('access-0', 'refresh-0', _utcnow() - timedelta(minutes=1))
+    shared = manager._credentials
+    assert manager.get_credentials() is shared
+
+    assert rotating_refresh == ['refresh-0']
+    assert shared.token == 'access-1'
+    assert shared.refresh_token == 'refresh-1'
+    assert json.loads(token_path.read_text())['refresh_token'] == 'refresh-1'
+
+    # 保存したトークンがなくなっても、共有している認証情報は新しいリフレッシュトークンで更新する
+    token_path.unlink()
+    shared.expiry = _utcnow() - timedelta(minutes=1)
+    assert manager.get_credentials() is shared
+    assert rotating_refresh == ['refresh-0', 'refresh-1']
+    assert json.loads(token_path.read_text())['refresh_token'] == 'refresh-2'
+
+def test_token_within_margin_is_refreshed(tmp_path):
+    manager = gmail_analyzer.CredentialManager(str(tmp_path / 'token.json'), interactive=False, refresh_margin=300)
+    assert manager._needs_refresh(_credentials('a', 'r', _utcnow() + timedelta(minutes=2)))
+    assert not manager._needs_refresh(_credentials('a', 'r', _utcnow() + timedelta(minutes=10)))
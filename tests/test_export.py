@@ -0,0 +1,122 @@
+import datetime
+import importlib.util
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+import gmail_analyzer
+from fakes import FakeGmail
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+def _expected_dates(service, fmt='%Y-%m-%d'):
+    """FakeGmail のメールの送信日（日本時間）"""
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return {(start + datetime.timedelta(hours=i * service.step_hours)).astimezone(JST).strftime(fmt)
+            for i in range(len(service.ids))}
+
+
+def _export(analyzer_with, tmp_path, service, **kwargs):
+    analyzer = analyzer_with(service)
+    manifest_path = analyzer.export_for_bigquery(['news@example.com'], tmp_path / 'export',
+                                                 max_results=len(service.ids), **kwargs)
+    with open(manifest_path, encoding='utf-8') as f:
+        return Path(manifest_path).parent, json.load(f)
+
+
+def _read_ndjson(export_dir, files):
+    rows = []
+    for path in files:
+        with open(export_dir / path, encoding='utf-8') as f:
+            rows.extend(dict(json.loads(line), _partition=Path(path).parent.name) for line in f)
+    return rows
+
+
+def test_parquet_export_matches_schema_and_partitions(analyzer_with, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    import pyarrow as pa
+
+    service = FakeGmail(count=50)
+    export_dir, manifest = _export(analyzer_with, tmp_path, service)
+    files = manifest['tables']['messages']['files']['parquet']
+    assert manifest['senders'] == ['news@example.com']
+    assert manifest['tables']['messages']['rows'] == 50
+
+    # parquet/messages/<送信日>/part-NNNNN.parquet に分かれ、各ファイルの送信日はディレクトリと一致する
+    assert {Path(path).parent.name for path in files} == _expected_dates(service)
+    expected_types = {'STRING': pa.string(), 'INT64': pa.int64(), 'BOOL': pa.bool_(), 'DATE': pa.date32(),
+                      'TIMESTAMP': pa.timestamp('us', tz='UTC')}
+    message_ids = []
+    for path in files:
+        assert path.startswith('parquet/messages/') and path.endswith('/part-00000.parquet')
+        table = pq.read_table(export_dir / path)
+        assert table.schema.names == [field['name'] for field in gmail_analyzer.MESSAGE_EXPORT_SCHEMA]
+        for field in gmail_analyzer.MESSAGE_EXPORT_SCHEMA:
+            arrow_field = table.schema.field(field['name'])
+            assert arrow_field.type == expected_types[field['type']]
+            assert arrow_field.nullable == (field['mode'] != 'REQUIRED')
+        assert {d.isoformat() for d in table.column('sent_date').to_pylist()} == {Path(path).parent.name}
+        message_ids.extend(table.column('message_id').to_pylist())
+    assert sorted(message_ids) == service.ids
+    assert not list(export_dir.rglob('*.tmp'))
+
+    # NDJSONにも同じ行が同じパーティションで出力される
+    ndjson_files = manifest['tables']['messages']['files']['ndjson']
+    assert [path.replace('ndjson', 'parquet') for path in ndjson_files] == files
+    rows = _read_ndjson(export_dir, ndjson_files)
+    assert sorted(row['message_id'] for row in rows) == service.ids
+    assert all(row['sent_date'] == row['_partition'] for row in rows)
+    assert all(row['sent_at'].endswith('Z') for row in rows)
+
+
+def test_ndjson_only_without_pyarrow(analyzer_with, tmp_path, monkeypatch):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, 'find_spec',
+                        lambda name, *args: None if name == 'pyarrow' else find_spec(name, *args))
+
+    service = FakeGmail(count=30)
+    export_dir, manifest = _export(analyzer_with, tmp_path, service)
+    assert not (export_dir / 'parquet').exists()
+    for table in ('messages', 'aggregates'):
+        assert list(manifest['tables'][table]['files']) == ['ndjson']
+        with open(export_dir / manifest['tables'][table]['schema'], encoding='utf-8') as f:
+            assert json.load(f) == manifest['tables'][table]['fields']
+
+    rows = _read_ndjson(export_dir, manifest['tables']['messages']['files']['ndjson'])
+    assert len(rows) == 30
+    assert [name for name in rows[0] if name != '_partition'] == \
+        [field['name'] for field in gmail_analyzer.MESSAGE_EXPORT_SCHEMA]
+    aggregates = _read_ndjson(export_dir, manifest['tables']['aggregates']['files']['ndjson'])
+    hourly = [row for row in aggregates if row['dimension'] == 'hour']
+    assert sum(row['message_count'] for row in hourly) == 30
+
+
+def test_month_partitions(analyzer_with, tmp_path):
+    service = FakeGmail(count=200, step_hours=11)
+    export_dir, manifest = _export(analyzer_with, tmp_path, service, formats=('ndjson',), partition='month')
+    files = manifest['tables']['messages']['files']['ndjson']
+    assert {Path(path).parent.name for path in files} == _expected_dates(service, '%Y-%m')
+    assert manifest['tables']['messages']['partition_type'] == 'MONTH'
+    rows = _read_ndjson(export_dir, files)
+    assert len(rows) == 200
+    assert all(row['sent_date'][:7] == row['_partition'] for row in rows)
+
+
+def test_load_is_skipped_without_bigquery_library(analyzer_with, tmp_path, monkeypatch):
+    export_dir, _ = _export(analyzer_with, tmp_path, FakeGmail(count=10), formats=('ndjson',))
+    monkeypatch.setitem(sys.modules, 'google.cloud.bigquery', None)
+    assert gmail_analyzer.load_export_to_bigquery(export_dir, 'dataset', source_format='ndjson') is None
+
+
+def test_reexport_removes_previous_files(analyzer_with, tmp_path):
+    _export(analyzer_with, tmp_path, FakeGmail(count=50))
+    export_dir, manifest = _export(analyzer_with, tmp_path, FakeGmail(count=10), formats=('ndjson',))
+    
+    # 以前の出力のパーティション・Parquetのファイルは残らず、manifest のファイルだけになる
+    listed = {path for table in manifest['tables'].values() for paths in table['files'].values() for path in paths}
+    written = {path.relative_to(export_dir).as_posix() for path in export_dir.rglob('part-*')}
+    assert written == listed
+    assert len(_read_ndjson(export_dir, manifest['tables']['messages']['files']['ndjson'])) == 10
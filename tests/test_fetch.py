@@ -0,0 +1,136 @@
+import pytest
+
+import gmail_analyzer
+from fakes import FakeGmail
+
+
+def test_resume_refetches_messages_that_failed(tmp_path, analyzer_with):
+    service = FakeGmail(count=30, failing={'m00003', 'm00017'})
+    analyzer = analyzer_with(service)
+    checkpoint_dir = tmp_path / 'checkpoint'
+
+    df = analyzer.analyze_emails_from_sender('news@example.com', max_results=30, checkpoint_dir=checkpoint_dir)
+    assert len(df) == 30
+    assert (df['subject'] == '(取得エラー)').sum() == 2
+
+    # 復旧後に再開すると、失敗した2件だけを取得し直す
+    service.healthy = True
+    service.calls.clear()
+    resumed = analyzer.resume_analysis(checkpoint_dir)
+    assert service.calls['get'] == 2
+    assert len(resumed) == 30
+    assert not (resumed['subject'] == '(取得エラー)').any()
+    assert set(resumed['message_id']) == set(service.ids)
+
+
+def test_checkpoint_from_older_version_drops_error_records(tmp_path, analyzer_with):
+    service = FakeGmail(count=10)
+    analyzer = analyzer_with(service)
+    checkpoint_dir = tmp_path / 'checkpoint'
+    analyzer.analyze_emails_from_sender('news@example.com', max_results=10, checkpoint_dir=checkpoint_dir)
+
+    # 以前のバージョンは取得エラーの代わりのレコードも保存していた
+    checkpoint = gmail_analyzer.FetchCheckpoint(checkpoint_dir)
+    checkpoint.append_records([analyzer._error_record('m00099', 'news@example.com')])
+
+    service.calls.clear()
+    df = analyzer.resume_analysis(checkpoint_dir)
+    assert not (df['subject'] == '(取得エラー)').any()
+
+
+def test_run_fetch_plan_uses_planned_sampling(analyzer_with):
+    service = FakeGmail(count=300)
+    analyzer = analyzer_with(service)
+
+    plan = analyzer.plan_fetch(['news@example.com'], mode='sample', sample_size=20)
+    assert plan['senders'][0]['fetch_kwargs']['sample_size'] == 20
+
+    before = analyzer.quota.units_today
+    results = analyzer.run_fetch_plan(plan)
+    used = analyzer.quota.units_today - before
+
+    assert len(results['news@example.com']) == 20
+    assert service.calls['get'] == 20
+    assert used <= plan['senders'][0]['units']
+
+
+def test_run_fetch_plan_fetches_bodies_for_body_mode(analyzer_with):
+    analyzer = analyzer_with(FakeGmail(count=5))
+    plan = analyzer.plan_fetch(['news@example.com'], mode='body', max_results=5)
+    df = analyzer.run_fetch_plan(plan)['news@example.com']
+    assert 'body' in df.columns
+
+
+def test_plan_fetch_flags_sender_over_daily_limit(analyzer_with):
+    analyzer = analyzer_with(FakeGmail(count=300), quota=gmail_analyzer.QuotaAccountant(per_day_limit=1000))
+
+    plan = analyzer.plan_fetch(['news@example.com'], max_results=300)
+    assert plan['unschedulable'] == ['news@example.com']
+    assert plan['senders'][0]['over_daily_limit']
+    assert all('news@example.com' not in day for day in plan['days'])
+    assert analyzer.run_fetch_plan(plan) == {}
+
+
+def test_plan_fetch_moves_sender_to_next_day_when_today_is_used_up(analyzer_with):
+    quota = gmail_analyzer.QuotaAccountant(per_day_limit=1000)
+    analyzer = analyzer_with(FakeGmail(count=100), quota=quota)
+    quota.charge('get', 150)  # 本日分を使い切る直前
+
+    plan = analyzer.plan_fetch(['news@example.com'], max_results=100)
+    assert plan['days'][0] == []
+    assert plan['days'][1] == ['news@example.com']
+
+
+def test_sampling_estimates_exclude_failed_messages(analyzer_with):
+    failing = {f"m{i:05d}" for i in range(0, 400, 5)}
+    analyzer = analyzer_with(FakeGmail(count=400, failing=failing))
+    df = analyzer.analyze_emails_from_sender('news@example.com', sample_size=60, sampling_seed=3)
+    errors = int((df['subject'] == '(取得エラー)').sum())
+    assert 0 < errors < 60
+
+    # 取得に失敗したメッセージは0時にも標本の件数にも数えない
+    aggregates = analyzer._compute_chart_aggregates(df)
+    assert aggregates['sampling']['sample_size'] == 60 - errors
+    assert aggregates['sampling']['fetch_errors'] == errors
+    assert aggregates['sampling']['population'] == 400
+    assert sum(aggregates['hourly']) == 60 - errors
+    assert sum(aggregates['weekday']) == 60 - errors
+    assert sum(map(sum, aggregates['heatmap'])) == 60 - errors
+
+
+class QuotaLimitedGmail(FakeGmail):
+    """list を list_limit 回呼び出した後はクォータ超過で失敗する FakeGmail"""
+
+    def __init__(self, list_limit=None, **kwargs):
+        super().__init__(**kwargs)
+        self.list_limit = list_limit
+
+    def list(self, **kwargs):
+        if self.list_limit is not None and self.calls['list'] >= self.list_limit:
+            raise gmail_analyzer.QuotaExceededError("1日のクォータを使い切りました")
+        return super().list(**kwargs)
+
+
+@pytest.mark.parametrize('sampling', ['uniform', 'stratified'])
+def test_sampled_listing_resumes_from_saved_page(tmp_path, analyzer_with, sampling):
+    checkpoint_dir = tmp_path / 'checkpoint'
+    options = dict(sample_size=80, sampling=sampling, sampling_seed=7)
+    expected = analyzer_with(FakeGmail(count=2300)).analyze_emails_from_sender('news@example.com', **options)
+
+    # 見積もり＋2ページを一覧取得したところでクォータ超過
+    service = QuotaLimitedGmail(count=2300, list_limit=3)
+    analyzer = analyzer_with(service)
+    with pytest.raises(gmail_analyzer.QuotaExceededError):
+        analyzer.analyze_emails_from_sender('news@example.com', checkpoint_dir=checkpoint_dir, **options)
+    saved = gmail_analyzer.FetchCheckpoint(checkpoint_dir).load_sampling_state()
+    assert saved['population'] == 1000
+    assert saved['page_token'] == '1000'
+
+    # 再開すると見積もりからやり直さず、保存したページの続きだけを一覧取得する
+    service.list_limit = None
+    service.calls.clear()
+    df = analyzer.resume_analysis(checkpoint_dir)
+    assert service.calls['list'] == 3
+    assert sorted(df['message_id']) == sorted(expected['message_id'])
+    assert df.attrs['sampling'] == expected.attrs['sampling']
+    assert gmail_analyzer.FetchCheckpoint(checkpoint_dir).load_sampling_state() is None
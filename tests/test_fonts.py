@@ -0,0 +1,73 @@
+import os
+import shutil
+
+import matplotlib
+import pytest
+
+import gmail_analyzer
+
+# テスト用のフォントには日本語の文字がないため、文字がない旨の警告は無視する
+pytestmark = pytest.mark.filterwarnings('ignore:Glyph')
+
+
+@pytest.fixture
+def font_dir(tmp_path):
+    # matplotlib同梱のフォントを、標準の場所にはないフォントとして使う
+    source = os.path.join(matplotlib.get_data_path(), 'fonts', 'ttf', 'DejaVuSerif.ttf')
+    shutil.copy(source, tmp_path / 'DejaVuSerif.ttf')
+    return str(tmp_path)
+
+
+def _aggregates():
+    return {'hourly': list(range(24)), 'weekday': [1] * 7, 'monthly': [2] * 12,
+            'heatmap': [[1] * 24 for _ in range(7)], 'sampling': None}
+
+
+def _chart_font_in_process():
+    return gmail_analyzer.plt.rcParams['font.sans-serif'][0]
+
+
+def test_charts_use_font_from_font_dir(font_dir):
+    analyzer = gmail_analyzer.GmailAnalyzer(font_dir=font_dir, use_claude=False)
+    charts = analyzer._render_report_charts(_aggregates())
+    assert all(chart is not None for chart in charts.values())
+    assert _chart_font_in_process() == 'DejaVu Serif'
+
+
+def test_render_workers_use_font_from_font_dir(font_dir):
+    font_path = os.path.join(font_dir, 'DejaVuSerif.ttf')
+    pool = gmail_analyzer._get_render_pool(1)
+    try:
+        family = pool.submit(gmail_analyzer._render_with_font, font_path, _chart_font_in_process, ()).result()
+    finally:
+        gmail_analyzer._reset_render_pool()
+    assert family == 'DejaVu Serif'
+
+
+def _pdf_with_font(resolver):
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    assert resolver.add_to_pdf(pdf, 'Report')
+    pdf.add_page()
+    pdf.set_font('Report', '', 12)
+    pdf.cell(text='Newsletter report')
+    return pdf, bytes(pdf.output())
+
+
+def test_font_is_added_with_fpdf_add_font(font_dir):
+    resolver = gmail_analyzer.FontResolver(font_dir=font_dir)
+    pdf, output = _pdf_with_font(resolver)
+    assert set(pdf.fonts) >= {'report', 'reportB'}
+    assert str(pdf.fonts['report'].ttffile) == resolver.find_font_path()
+    # 登録済みのスタイルは追加し直さない
+    assert resolver.add_to_pdf(pdf, 'Report')
+    assert output.startswith(b'%PDF')
+
+
+def test_missing_font_is_reported(tmp_path, monkeypatch):
+    from fpdf import FPDF
+
+    monkeypatch.setattr(gmail_analyzer.FontResolver, 'DEFAULT_FONT_PATHS', [])
+    resolver = gmail_analyzer.FontResolver(font_dir=str(tmp_path))
+    assert not resolver.add_to_pdf(FPDF(), 'Report')
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import gmail_analyzer
+from fakes import FakeGmail
+
+pytest.importorskip('anthropic')
+
+
+class ClaudeStub:
+    """messages API の代わりに応答するローカルのHTTPサーバー
+
+    最初の rate_limited 件には429を返し、failing_sender を含む依頼には常に529を返す。
+    """
+
+    def __init__(self, rate_limited=3, failing_sender='broken@example.com', delay=0.1):
+        self.rate_limited = rate_limited
+        self.failing_sender = failing_sender
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = []  # (送信者, 返したステータス)
+        self.active = 0
+        self.max_active = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def status_counts(self, status):
+        return sum(1 for _, code in self.requests if code == status)
+
+    def _respond(self, body):
+        prompt = body['messages'][0]['content']
+        sender = next((s for s in prompt.split('"') if s.endswith('@example.com')), None)
+        with self.lock:
+            if sender == self.failing_sender:
+                status = 529
+            elif self.status_counts(429) < self.rate_limited:
+                status = 429
+            else:
+                status = 200
+            self.requests.append((sender, status))
+        if status == 429:
+            return status, {'type': 'error', 'error': {'type': 'rate_limit_error', 'message': 'slow down'}}
+        if status == 529:
+            return status, {'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'overloaded'}}
+        # アシスタントの応答は "{" の続きから始まる
+        text = '"insights": [{"observation": "' + sender + 'は朝に多い", "suggestion": "朝に送る"}]}'
+        return status, {'id': 'msg_stub', 'type': 'message', 'role': 'assistant', 'model': body['model'],
+                        'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn',
+                        'stop_sequence': None, 'usage': {'input_tokens': 1, 'output_tokens': 1}}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+                with stub.lock:
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    time.sleep(stub.delay)
+                    status, payload = stub._respond(body)
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(data)))
+                if status == 429:
+                    self.send_header('retry-after', '0.2')
+                self.end_headers()
+                self.wfile.write(data)
+        return Handler
+
+
+@pytest.fixture
+def claude_stub(monkeypatch, claude_request_compat):
+    stub = ClaudeStub()
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'test-key')
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+@pytest.fixture
+def claude_analyzer(analyzer_with, claude_stub):
+    analyzer = analyzer_with(FakeGmail(count=20), claude_base_url=claude_stub.base_url)
+    analyzer.use_claude = True
+    analyzer.claude_backoff = 0.01
+    return analyzer
+
+
+def test_insights_batch_caps_concurrency_and_retries_rate_limits(claude_analyzer, claude_stub):
+    df = claude_analyzer.analyze_emails_from_sender('news@example.com', max_results=20)
+    senders = [f"sender{i}@example.com" for i in range(8)]
+
+    started = time.monotonic()
+    results = claude_analyzer.generate_insights_batch([(s, df) for s in senders], max_concurrency=3)
+    elapsed = time.monotonic() - started
+
+    assert claude_stub.max_active == 3
+    # 429を受けた依頼は retry-after に従って待ってから再試行し、全員の考察が得られる
+    assert claude_stub.status_counts(429) == 3
+    assert claude_stub.status_counts(200) == len(senders)
+    assert elapsed >= 0.2
+    for sender in senders:
+        assert results[sender] == [f"1. {sender}は朝に多い: 朝に送る"]
+
+
+def test_insights_batch_falls_back_per_sender(claude_analyzer, claude_stub):
+    df = claude_analyzer.analyze_emails_from_sender('news@example.com', max_results=20)
+    senders = ['sender0@example.com', 'broken@example.com', 'sender1@example.com']
+
+    results = claude_analyzer.generate_insights_batch([(s, df) for s in senders], max_concurrency=2)
+
+    # 常に過負荷の送信者は再試行の上限まで試したあとデフォルトの考察になる
+    broken_attempts = [code for sender, code in claude_stub.requests if sender == 'broken@example.com']
+    assert broken_attempts == [529] * (claude_analyzer.claude_max_retries + 1)
+    assert results['broken@example.com'] == claude_analyzer._get_default_insights()
+    assert results['sender0@example.com'] == ['1. sender0@example.comは朝に多い: 朝に送る']
+    assert results['sender1@example.com'] == ['1. sender1@example.comは朝に多い: 朝に送る']
+
+
+def test_async_insights_share_retry_policy(claude_analyzer, claude_stub):
+    df = claude_analyzer.analyze_emails_from_sender('news@example.com', max_results=20)
+    claude_stub.rate_limited = 2
+
+    async def run():
+        async with gmail_analyzer.AsyncGmailAnalyzer(analyzer=claude_analyzer) as analyzer:
+            return await analyzer.generate_insights(df, 'sender0@example.com')
+
+    started = time.monotonic()
+    insights = asyncio.run(run())
+    elapsed = time.monotonic() - started
+
+    # 同期版と同じく retry-after に従い、待機の期限を分析ツールと共有する
+    assert claude_stub.status_counts(429) == 2
+    assert insights == ['1. sender0@example.comは朝に多い: 朝に送る']
+    assert elapsed >= 0.4
+    assert claude_analyzer._claude_retry_at > 0
@@ -0,0 +1,51 @@
+from fakes import FakeGmail
+
+
+def _run(analyzer, **kwargs):
+    events = []
+
+    def progress(event):
+        events.append(event)
+    df = analyzer.analyze_emails_from_sender('news@example.com', progress=progress, **kwargs)
+    return df, events
+
+
+def test_every_message_emits_fetched_or_error(analyzer_with, monkeypatch):
+    failing = {'m00010', 'm00100', 'm00201'}
+    analyzer = analyzer_with(FakeGmail(count=250, failing=failing))
+    # 途中経過の集計値は取得のたびに更新し、DataFrameから集計し直さない
+    monkeypatch.setattr(analyzer, '_compute_chart_aggregates', None)
+    df, events = _run(analyzer, max_results=250, partial_interval=100)
+    monkeypatch.undo()
+
+    per_message = [e for e in events if e['type'] in ('fetched', 'error')]
+    assert len(per_message) == 250
+    assert {e['message_id'] for e in per_message if e['type'] == 'error'} == failing
+    assert [e['fetched'] for e in per_message] == list(range(1, 251))
+
+    # 'aggregate' は100件ごとの 'fetched' / 'error' に続く追加のイベント（最後は完了時）
+    types = [e['type'] for e in events]
+    aggregates = [i for i, t in enumerate(types) if t == 'aggregate']
+    assert [events[i]['fetched'] for i in aggregates] == [100, 200, 250]
+    assert all(types[i - 1] in ('fetched', 'error') for i in aggregates[:2])
+    assert types[-1] == 'done'
+
+    final = events[aggregates[-1]]['aggregates']
+    expected = analyzer._compute_chart_aggregates(df)
+    for name in ('hourly', 'weekday', 'monthly', 'heatmap'):
+        assert final[name] == expected[name]
+    assert sum(final['hourly']) == 250 - len(failing)
+
+
+def test_resumed_fetch_counts_checkpointed_records(tmp_path, analyzer_with):
+    analyzer = analyzer_with(FakeGmail(count=120))
+    checkpoint_dir = tmp_path / 'checkpoint'
+    df, events = _run(analyzer, max_results=120, partial_interval=50, checkpoint_dir=checkpoint_dir,
+                      checkpoint_interval=10)
+    assert events[-1]['type'] == 'done'
+
+    # 取得済みの分も途中経過の集計値に含める
+    _, resumed = _run(analyzer, max_results=120, partial_interval=50, checkpoint_dir=checkpoint_dir)
+    assert not [e for e in resumed if e['type'] == 'fetched']
+    final = [e for e in resumed if e['type'] == 'aggregate'][-1]['aggregates']
+    assert final['hourly'] == analyzer._compute_chart_aggregates(df)['hourly']
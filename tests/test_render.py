@@ -0,0 +1,14 @@
+import gmail_analyzer
+
+
+def test_render_pool_is_recreated_when_size_changes():
+    try:
+        pool = gmail_analyzer._get_render_pool(1)
+        assert gmail_analyzer._get_render_pool(1) is pool
+
+        resized = gmail_analyzer._get_render_pool(2)
+        assert resized is not pool
+        assert resized._max_workers == 2
+        assert gmail_analyzer._get_render_pool(2) is resized
+    finally:
+        gmail_analyzer._reset_render_pool()
@@ -0,0 +1,147 @@
+import csv
+import io
+import json
+import threading
+import time
+
+import pytest
+
+import gmail_analyzer
+from fakes import FakeGmail
+
+pytest.importorskip('flask')
+
+# 起動時のグラフ描画では日本語フォントがない場合の警告が出るため無視する
+pytestmark = pytest.mark.filterwarnings('ignore:Glyph')
+
+
+class GatedGmail(FakeGmail):
+    """gate が開くまで messages.list の応答を止める FakeGmail"""
+
+    def __init__(self, gate, **kwargs):
+        super().__init__(**kwargs)
+        self.gate = gate
+
+    def list(self, **kwargs):
+        assert self.gate.wait(10)
+        return super().list(**kwargs)
+
+
+@pytest.fixture
+def service(tmp_path):
+    gate = threading.Event()
+
+    def analyzer_factory():
+        analyzer = gmail_analyzer.GmailAnalyzer(use_claude=False)
+        analyzer.service = GatedGmail(gate, count=40)
+        return analyzer
+
+    job_queue = gmail_analyzer.ReportJobQueue(analyzer_factory=analyzer_factory, workers=1, max_queue=1,
+                                              output_dir=tmp_path / 'reports')
+    app = gmail_analyzer.create_app(job_queue)
+    yield app.test_client(), gate
+    gate.set()
+    job_queue.shutdown()
+
+
+def _wait_for(client, job_id, statuses, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        body = client.get(f"/jobs/{job_id}").get_json()
+        if body['status'] in statuses:
+            return body
+        time.sleep(0.05)
+    raise AssertionError(f"ジョブ {job_id} が {statuses} になりませんでした")
+
+
+def test_jobs_are_queued_deduplicated_and_rejected_when_full(service):
+    client, gate = service
+
+    response = client.post('/jobs', json={'senders': ['news@example.com'], 'format': 'csv', 'max_results': 40})
+    assert response.status_code == 202
+    job = response.get_json()
+    assert response.headers['Location'].endswith(f"/jobs/{job['id']}")
+    # ワーカーは gate が開くまでこのジョブを処理し続ける
+    _wait_for(client, job['id'], {'running'})
+
+    # 同じ内容のジョブは新しく登録せず、同じジョブを返す
+    duplicate = client.post('/jobs', json={'sender': ' news@example.com ', 'format': 'csv', 'max_results': 40})
+    assert duplicate.status_code == 200
+    assert duplicate.get_json()['id'] == job['id']
+
+    queued = client.post('/jobs', json={'senders': ['news@example.com'], 'format': 'json', 'max_results': 40})
+    assert queued.status_code == 202
+    assert queued.get_json()['status'] == 'queued'
+
+    full = client.post('/jobs', json={'senders': ['other@example.com'], 'format': 'csv'})
+    assert full.status_code == 503
+    assert full.headers['Retry-After'] == '30'
+
+    assert client.get(f"/jobs/{job['id']}/artifact").status_code == 409
+    assert client.get('/health').get_json()['queued'] == 1
+    gate.set()
+
+    done = _wait_for(client, job['id'], {'done', 'failed'})
+    assert done['status'] == 'done'
+    assert done['artifact_url'].endswith(f"/jobs/{job['id']}/artifact")
+    artifact = client.get(f"/jobs/{job['id']}/artifact")
+    assert artifact.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(artifact.get_data(as_text=True))))
+    assert len(rows) == 40
+    assert {row['sender'] for row in rows} == {'news@example.com'}
+
+    summary_job = _wait_for(client, queued.get_json()['id'], {'done', 'failed'})
+    assert summary_job['status'] == 'done'
+    summaries = json.loads(client.get(f"/jobs/{summary_job['id']}/artifact").get_data())
+    assert [s['sender'] for s in summaries] == ['news@example.com']
+
+
+@pytest.mark.parametrize('payload', [
+    {},
+    {'senders': []},
+    {'senders': ['news@example.com'], 'format': 'xlsx'},
+    {'senders': ['news@example.com'], 'max_results': 0},
+    ['news@example.com'],
+])
+def test_invalid_jobs_are_rejected(service, payload):
+    client, _ = service
+    response = client.post('/jobs', json=payload)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_unknown_job_is_not_found(service):
+    client, _ = service
+    assert client.get('/jobs/unknown').status_code == 404
+    assert client.get('/jobs/unknown/artifact').status_code == 404
+
+
+def test_job_state_is_published_atomically(tmp_path):
+    def analyzer_factory():
+        analyzer = gmail_analyzer.GmailAnalyzer(use_claude=False)
+        analyzer.service = FakeGmail(count=40)
+        return analyzer
+
+    job_queue = gmail_analyzer.ReportJobQueue(analyzer_factory=analyzer_factory, workers=1,
+                                              output_dir=tmp_path / 'reports').start()
+    try:
+        job, _ = job_queue.submit({'senders': ['news@example.com'], 'format': 'csv',
+                                   'max_results': 40})
+        assert job['status'] == 'queued'
+        
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            current = job_queue.get(job['id'])
+            # 完了した状態は必ず成果物と一緒に見える
+            assert current['status'] != 'done' or current['artifact']
+            if current['status'] in ('done', 'failed'):
+                break
+        assert current['status'] == 'done'
+        
+        # 返されるジョブはコピーで、呼び出し側が書き換えてもキューの状態は変わらない
+        current['artifact'] = None
+        current['failed_senders'].append('news@example.com')
+        assert job_queue.get(job['id'])['artifact']
+        assert job_queue.get(job['id'])['failed_senders'] == []
+    finally:
+        job_queue.shutdown()
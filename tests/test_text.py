@@ -0,0 +1,22 @@
+import pandas as pd
+import pytest
+
+pytestmark = pytest.mark.filterwarnings('ignore:Glyph')
+
+
+def test_long_mail_ratio_is_unavailable_for_snippets(analyzer_with):
+    analyzer = analyzer_with()
+    df = analyzer.analyze_emails_from_sender('news@example.com', max_results=20)
+    _, stats = analyzer._analyze_text_content(df)
+    # スニペットだけでは1000文字を超えないため、0%ではなく算出しない
+    assert stats['長文率'] is None
+    assert stats['平均文字数'] > 0
+
+
+def test_long_mail_ratio_uses_body_lengths(analyzer_with):
+    analyzer = analyzer_with()
+    df = analyzer.analyze_emails_from_sender('news@example.com', max_results=4)
+    df['body'] = ['a' * 200, 'b' * 1500, 'c' * 300, 'd' * 3500]
+    df['content_length'] = df['body'].str.len()
+    _, stats = analyzer._analyze_text_content(df)
+    assert stats['長文率'] == pytest.approx(50.0)
@@ -0,0 +1,40 @@
+import gmail_analyzer
+from fakes import FakeGmail
+
+
+def _fake_analyzer():
+    """ワーカープロセスで使うアナライザー（FakeGmail から取得する）"""
+    analyzer = gmail_analyzer.GmailAnalyzer(use_claude=False)
+    analyzer.service = FakeGmail(count=20)
+    return analyzer
+
+
+class BrokenConnection:
+    """send で BrokenPipeError を送出する接続（それ以外は元の接続に委ねる）"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send(self, obj):
+        raise BrokenPipeError(32, 'Broken pipe')
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def test_broken_pipe_replaces_worker_and_redispatches(tmp_path):
+    with gmail_analyzer.WarmWorkerPool(workers=1, analyzer_factory=_fake_analyzer) as pool:
+        # 日本語フォントがない環境ではPDFの作成に失敗するため、ジョブが処理されたことだけを確かめる
+        first = pool.submit('news@example.com', output_path=str(tmp_path / 'first.pdf'), max_results=20)
+        first.exception(timeout=120)
+        
+        # ワーカーへのパイプが切れていても submit は例外を出さず、新しいワーカーで処理する
+        with pool._lock:
+            (worker_id, worker), = pool._workers.items()
+            worker['conn'] = BrokenConnection(worker['conn'])
+        second = pool.submit('news@example.com', output_path=str(tmp_path / 'second.pdf'), max_results=20)
+        second.exception(timeout=120)
+        assert pool.stats['replaced'] == 1
+        assert pool.stats['completed'] + pool.stats['failed'] == 2
+        assert list(pool._workers) != [worker_id]
+    assert not worker['process'].is_alive()